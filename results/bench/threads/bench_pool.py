@@ -0,0 +1,76 @@
+"""Scaling of the Rust backend with the size of its thread pool.
+
+Each graph of the CFI corpus is canonized on its own, from a single caller
+thread, so only the parallelism inside one canonization is measured; then
+the whole corpus goes through to_cgraph_batch. Both runs are repeated for
+1, 2, 4 and N pool threads, set with scott.set_num_threads.
+
+	python results/bench/threads/bench_pool.py [SIZE_MAX] [REPEAT]
+"""
+
+import os
+import sys
+import time
+
+import scott as st
+
+DIR_PATH = "./data/isotest/cfi-rigid-t2-dot/"
+SIZE_MIN = 16
+SIZE_MAX = int(sys.argv[1]) if len(sys.argv) > 1 else 96
+REPEAT = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+
+def load_graphs():
+	graphs = []
+	for filename in sorted(os.listdir(DIR_PATH)):
+		if not filename.endswith(".dot") or filename.startswith("."):
+			continue
+		problem_size = int(filename.split("-")[3])
+		if SIZE_MIN <= problem_size <= SIZE_MAX:
+			graphs.append(st.parse.from_dot(file_path=DIR_PATH + filename)[0])
+	return graphs * REPEAT
+
+
+def run_single(graphs):
+	start = time.perf_counter()
+	results = [str(st.canonize.to_cgraph(graph)) for graph in graphs]
+	return time.perf_counter() - start, results
+
+
+def run_batch(graphs):
+	start = time.perf_counter()
+	results = [str(cgraph) for cgraph in st.canonize.to_cgraph_batch(graphs)]
+	return time.perf_counter() - start, results
+
+
+def main():
+	graphs = load_graphs()
+	print("%d graphs (sizes %d-%d, x%d)" % (len(graphs), SIZE_MIN, SIZE_MAX, REPEAT))
+
+	cores = os.cpu_count() or 1
+	counts = sorted(set(c for c in (1, 2, 4, cores) if c <= cores))
+
+	reference = None
+	baselines = None
+	print("threads\tsingle_s\tsingle_speedup\tbatch_s\tbatch_speedup")
+	for threads in counts:
+		st.set_num_threads(threads)
+		single, single_results = run_single(graphs)
+		batch, batch_results = run_batch(graphs)
+		if reference is None:
+			reference = single_results
+			baselines = (single, batch)
+		if single_results != reference or batch_results != reference:
+			raise AssertionError("traces differ with %d threads" % threads)
+		print("%d\t%.3f\t%.2f\t%.3f\t%.2f" % (
+			threads,
+			single,
+			baselines[0] / single,
+			batch,
+			baselines[1] / batch,
+		))
+	st.set_num_threads(0)
+
+
+if __name__ == "__main__":
+	main()
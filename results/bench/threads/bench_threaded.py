@@ -0,0 +1,73 @@
+"""Threaded throughput of scott.canonize.to_cgraph on the CFI corpus.
+
+The Rust backend releases the GIL while canonizing, so a plain
+ThreadPoolExecutor should scale close to linearly with the worker count.
+
+	python results/bench/threads/bench_threaded.py [SIZE_MAX] [REPEAT]
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import scott as st
+
+DIR_PATH = "./data/isotest/cfi-rigid-t2-dot/"
+SIZE_MIN = 16
+SIZE_MAX = int(sys.argv[1]) if len(sys.argv) > 1 else 48
+REPEAT = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+
+def load_graphs():
+	graphs = []
+	for filename in sorted(os.listdir(DIR_PATH)):
+		if not filename.endswith(".dot") or filename.startswith("."):
+			continue
+		problem_size = int(filename.split("-")[3])
+		if SIZE_MIN <= problem_size <= SIZE_MAX:
+			graphs.append((filename, st.parse.from_dot(file_path=DIR_PATH + filename)[0]))
+	return graphs * REPEAT
+
+
+def canonize(item):
+	filename, graph = item
+	return filename, str(st.canonize.to_cgraph(graph))
+
+
+def run(graphs, workers):
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		results = list(pool.map(canonize, graphs))
+	return time.perf_counter() - start, results
+
+
+def main():
+	graphs = load_graphs()
+	print("%d graphs (sizes %d-%d, x%d)" % (len(graphs), SIZE_MIN, SIZE_MAX, REPEAT))
+
+	counts = [1, 2, 4, 8, os.cpu_count() or 1]
+	counts = sorted(set(c for c in counts if c <= (os.cpu_count() or 1)))
+
+	reference = None
+	baseline = None
+	print("workers\ttime_s\tgraphs_per_s\tspeedup\tefficiency")
+	for workers in counts:
+		elapsed, results = run(graphs, workers)
+		if reference is None:
+			reference = results
+			baseline = elapsed
+		elif results != reference:
+			raise AssertionError("traces differ with %d workers" % workers)
+		speedup = baseline / elapsed
+		print("%d\t%.3f\t%.2f\t%.2f\t%.2f" % (
+			workers,
+			elapsed,
+			len(graphs) / elapsed,
+			speedup,
+			speedup / workers,
+		))
+
+
+if __name__ == "__main__":
+	main()
@@ -4,6 +4,7 @@ from . import canonize
 from . import parse
 from . import graph
 from . import structs
+from .canonize import get_num_threads, set_num_threads
 
 try:
 	from importlib.metadata import version, PackageNotFoundError
@@ -17,4 +18,12 @@ try:
 except Exception:
 	__version__ = "unknown"
 
-__all__ = ["canonize", "parse", "graph", "structs", "__version__"]
+__all__ = [
+	"canonize",
+	"parse",
+	"graph",
+	"structs",
+	"set_num_threads",
+	"get_num_threads",
+	"__version__",
+]
@@ -1,8 +1,15 @@
 """Canonization shim: delegates to Rust or legacy Python backend."""
 
+import hashlib
+
 from ._backend import resolve_backend
 from .graph import Graph
 
+# Hash functions the Rust backend can stream the canonical trace into.
+_NATIVE_DIGESTS = frozenset(("md5", "xxh3", "xxh3_128", "xxh3-128", "xxh128"))
+# Those of them hashlib lacks.
+_NATIVE_ONLY_DIGESTS = _NATIVE_DIGESTS - {"md5"}
+
 
 def _as_rs_graph(graph, module):
 	if isinstance(graph, Graph):
@@ -14,6 +21,21 @@ def _as_rs_graph(graph, module):
 	return graph
 
 
+def _refined_rule(candidate_rule, refine, backend):
+	"""Append the colour-refinement attribute to ``candidate_rule``."""
+	if not refine:
+		return candidate_rule
+	if backend == "py":
+		raise ValueError("refine=True requires the Rust backend")
+	return "{} > $refine".format(candidate_rule)
+
+
+def _check_hash(hash, backend):
+	"""Only the Rust backend can hash magnets with anything but MD5."""
+	if backend == "py" and hash.lower() != "md5":
+		raise ValueError("hash={!r} requires the Rust backend".format(hash))
+
+
 def _as_legacy_graph(graph):
 	"""Convert a scott.graph.Graph to a scott_legacy Graph."""
 	if not isinstance(graph, Graph):
@@ -39,8 +61,24 @@ def to_cgraph(
 	allow_hashes=True,
 	compress=True,
 	compact=False,
+	refine=False,
+	hash="md5",
 ):
+	"""Canonize ``graph`` into a CGraph.
+
+	With ``refine=True`` the candidate rule is extended with ``$refine``:
+	among the best-scoring roots only the smallest stable colour class
+	(1-WL over labels and modalities) is kept, which usually leaves a
+	handful of candidates instead of every node of a given degree.
+
+	``hash`` selects the magnet hash: ``md5`` (default) or the faster,
+	non-cryptographic ``xxh3_128``. Traces built with another hash than MD5
+	are prefixed with their format (see ``trace_format``), so they never
+	collide with MD5 traces in an index.
+	"""
 	backend, module = resolve_backend()
+	candidate_rule = _refined_rule(candidate_rule, refine, backend)
+	_check_hash(hash, backend)
 	if backend == "py":
 		return module.canonize.to_cgraph(
 			_as_legacy_graph(graph),
@@ -58,7 +96,143 @@ def to_cgraph(
 		allow_hashes,
 		compress,
 		compact,
+		hash,
+	)
+
+
+def to_cgraph_batch(
+	graphs,
+	candidate_rule="$degree",
+	branch_rule="$depth > tree.parent_modality > $lexic",
+	allow_hashes=True,
+	compress=True,
+	compact=False,
+	refine=False,
+	hash="md5",
+):
+	"""Canonize a list of graphs, returning the results in input order.
+
+	The Rust backend releases the GIL and spreads the batch over its
+	thread pool. A graph that fails to canonize does not abort the batch:
+	its slot holds the raised exception instead of a CGraph.
+	"""
+	backend, module = resolve_backend()
+	candidate_rule = _refined_rule(candidate_rule, refine, backend)
+	_check_hash(hash, backend)
+	if backend == "py":
+		results = []
+		for graph in graphs:
+			try:
+				results.append(
+					to_cgraph(
+						graph,
+						candidate_rule=candidate_rule,
+						branch_rule=branch_rule,
+						allow_hashes=allow_hashes,
+						compress=compress,
+						compact=compact,
+					)
+				)
+			except Exception as err:
+				results.append(err)
+		return results
+	rs_graphs = [_as_rs_graph(graph, module) for graph in graphs]
+	return module.to_cgraph_batch(
+		rs_graphs,
+		candidate_rule,
+		branch_rule,
+		allow_hashes,
+		compress,
+		compact,
+		hash,
+	)
+
+
+def canonical_digest(
+	graph,
+	algorithm="md5",
+	candidate_rule="$degree",
+	branch_rule="$depth > tree.parent_modality > $lexic",
+	allow_hashes=True,
+	compress=True,
+	compact=False,
+	refine=False,
+	hash="md5",
+):
+	"""Digest of the canonical trace of ``graph``, as ``bytes``.
+
+	Two graphs get the same digest iff they get the same CGraph. For a
+	``hashlib`` algorithm it equals
+	``hashlib.new(algorithm, str(to_cgraph(graph, ...)).encode()).digest()``
+	for the same arguments; the Rust backend streams the trace straight
+	into ``md5`` instead of building the string, and any other ``hashlib``
+	algorithm hashes the materialised trace.
+
+	``xxh3_128`` (also ``xxh3``, ``xxh128``) is not in ``hashlib``: only the
+	Rust backend computes it, and the legacy backend raises ``ValueError``.
+	"""
+	backend, module = resolve_backend()
+	if backend == "py" and algorithm.lower() in _NATIVE_ONLY_DIGESTS:
+		raise ValueError("algorithm={!r} requires the Rust backend".format(algorithm))
+	if backend == "rs" and algorithm.lower() in _NATIVE_DIGESTS:
+		return module.canonical_digest_py(
+			_as_rs_graph(graph, module),
+			algorithm,
+			_refined_rule(candidate_rule, refine, backend),
+			branch_rule,
+			allow_hashes,
+			compress,
+			compact,
+			hash,
+		)
+	cgraph = to_cgraph(
+		graph,
+		candidate_rule=candidate_rule,
+		branch_rule=branch_rule,
+		allow_hashes=allow_hashes,
+		compress=compress,
+		compact=compact,
+		refine=refine,
+		hash=hash,
 	)
+	return hashlib.new(algorithm, str(cgraph).encode()).digest()
+
+
+def trace_format(hash="md5"):
+	"""Format of the traces built with magnet hash ``hash``, e.g. ``1+xxh3_128``.
+
+	MD5 traces are the original format and carry no stamp; any other hash
+	prefixes its traces with ``@<format>:``.
+	"""
+	backend, module = resolve_backend()
+	_check_hash(hash, backend)
+	if backend == "py":
+		return "1"
+	return module.trace_format(hash)
+
+
+def set_num_threads(n):
+	"""Size the thread pool the Rust backend canonizes on.
+
+	``0`` restores the default: ``SCOTT_NUM_THREADS`` when set, otherwise one
+	thread per core. Size it next to your own worker pools to avoid
+	oversubscribing the machine. The legacy backend always runs on the
+	calling thread and ignores it.
+	"""
+	n = int(n)
+	if n < 0:
+		raise ValueError("n must be >= 0, got {}".format(n))
+	backend, module = resolve_backend()
+	if backend == "rs":
+		module.set_num_threads(n)
+
+
+def get_num_threads():
+	"""Number of threads the backend canonizes on."""
+	backend, module = resolve_backend()
+	if backend == "py":
+		return 1
+	return module.get_num_threads()
 
 
 def scott_trace(
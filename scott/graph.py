@@ -1,18 +1,28 @@
+import array
+import sys
+from collections.abc import Mapping
+
+
 class Node:
+	__slots__ = ("id", "label")
+
 	def __init__(self, node_id, label=""):
 		self.id = str(node_id)
-		self.label = str(label)
+		# Labels repeat across nodes and graphs: share one string per label.
+		self.label = sys.intern(str(label))
 
 	def __repr__(self):
 		return "Node(id=%s, label=%s)" % (self.id, self.label)
 
 
 class Edge:
+	__slots__ = ("id", "id_a", "id_b", "modality")
+
 	def __init__(self, edge_id, node_a, node_b, modality="1"):
 		self.id = str(edge_id)
 		self.id_a = str(node_a.id) if isinstance(node_a, Node) else str(node_a)
 		self.id_b = str(node_b.id) if isinstance(node_b, Node) else str(node_b)
-		self.modality = str(modality)
+		self.modality = sys.intern(str(modality))
 
 	def __repr__(self):
 		return "Edge(id=%s, a=%s, b=%s, modality=%s)" % (
@@ -23,73 +33,274 @@ class Edge:
 		)
 
 
+class _RsView(Mapping):
+	"""Read-only mapping over the nodes or edges of a Rust graph.
+
+	Entries are made on first access and kept, so that a graph that is only
+	canonized never holds a Python object per node or edge. The owning
+	``Graph`` keeps ``_cache`` in step with its mutations.
+	"""
+
+	def __init__(self, rs_graph):
+		self._rs_graph = rs_graph
+		self._cache = {}
+
+	def __getitem__(self, key):
+		entry = self._cache.get(key)
+		if entry is None:
+			entry = self._make(key) if isinstance(key, str) else None
+			if entry is None:
+				raise KeyError(key)
+			self._cache[key] = entry
+		return entry
+
+	def __contains__(self, key):
+		return key in self._cache or (isinstance(key, str) and self._make(key) is not None)
+
+	def __repr__(self):
+		return "%s(%d)" % (type(self).__name__, len(self))
+
+
+class _NodeView(_RsView):
+	def _make(self, node_id):
+		label = self._rs_graph.node_label(node_id)
+		return None if label is None else Node(node_id, label)
+
+	def __iter__(self):
+		return iter(self._rs_graph.node_ids())
+
+	def __len__(self):
+		return self._rs_graph.node_count
+
+
+class _EdgeView(_RsView):
+	def _make(self, edge_id):
+		edge = self._rs_graph.edge(edge_id)
+		return None if edge is None else Edge(edge_id, *edge)
+
+	def __iter__(self):
+		return iter(self._rs_graph.edge_ids())
+
+	def __len__(self):
+		return self._rs_graph.edge_count
+
+
+def _entries(view):
+	"""The dict holding the entries of ``V`` or ``E`` already made."""
+	return view._cache if isinstance(view, _RsView) else view
+
+
 class Graph:
+	"""Graph with labelled nodes and edges.
+
+	Once a Rust graph backs it (it wraps one, or ``as_rs`` built one), every
+	mutation is pushed to that graph rather than rebuilding it. A graph
+	wrapping a Rust graph exposes ``V`` and ``E`` as read-only views over it.
+	"""
+
 	def __init__(self, rs_graph=None, id=""):
 		self.id = id
 		self._rs_graph = rs_graph
-		self.V = {}
-		self.E = {}
 		if rs_graph is not None:
-			self._load_from_rs()
+			self.V = _NodeView(rs_graph)
+			self.E = _EdgeView(rs_graph)
+		else:
+			self.V = {}
+			self.E = {}
+
+	@classmethod
+	def from_arrays(cls, src, dst, node_labels, edge_modalities=None, label_names=None, modality_names=None, id=""):
+		"""Build a graph from integer arrays.
 
-	def _load_from_rs(self):
-		self.V.clear()
-		self.E.clear()
-		for node_id, label in self._rs_graph.node_labels():
-			self.V[str(node_id)] = Node(node_id, label)
-		for edge_id, id_a, id_b, modality in self._rs_graph.edges():
-			self.E[str(edge_id)] = Edge(edge_id, id_a, id_b, modality)
+		Node ``i`` is named ``str(i)`` and labelled ``node_labels[i]``; edge
+		``k`` joins ``src[k]`` and ``dst[k]`` with modality
+		``edge_modalities[k]`` (``"1"`` when omitted). Labels and modalities
+		are integer codes, turned into names through ``label_names`` and
+		``modality_names`` when given. Any one-dimensional integer array
+		supporting the buffer protocol (NumPy, ``array.array``, ...) is handed
+		to the Rust backend as one block of bytes, without a Python object per
+		item; other sequences of integers are accepted too.
+		"""
+		from ._backend import resolve_backend
+		backend, module = resolve_backend()
+		if backend == "py":
+			return cls._from_lists(
+				_int_list(src, "src"),
+				_int_list(dst, "dst"),
+				_int_list(node_labels, "node_labels"),
+				None if edge_modalities is None else _int_list(edge_modalities, "edge_modalities"),
+				label_names,
+				modality_names,
+				id,
+			)
+		rs_graph = module.graph_from_arrays(
+			_int_array(src, "src"),
+			_int_array(dst, "dst"),
+			_int_array(node_labels, "node_labels"),
+			None if edge_modalities is None else _int_array(edge_modalities, "edge_modalities"),
+			None if label_names is None else [str(name) for name in label_names],
+			None if modality_names is None else [str(name) for name in modality_names],
+		)
+		return cls(rs_graph, id=id)
+
+	@classmethod
+	def _from_lists(cls, src, dst, node_labels, edge_modalities, label_names, modality_names, id):
+		if len(src) != len(dst) or (edge_modalities is not None and len(edge_modalities) != len(src)):
+			raise ValueError("edge arrays differ in length")
+		if edge_modalities is None:
+			edge_modalities = ["1"] * len(src)
+		elif modality_names is not None:
+			edge_modalities = [_name(modality_names, code, "modality") for code in edge_modalities]
+		if label_names is not None:
+			node_labels = [_name(label_names, code, "label") for code in node_labels]
+		graph = cls(id=id)
+		graph.add_nodes([Node(i, label) for i, label in enumerate(node_labels)])
+		for k, (a, b, modality) in enumerate(zip(src, dst, edge_modalities)):
+			if not (0 <= a < len(node_labels) and 0 <= b < len(node_labels)):
+				raise ValueError("edge %d joins %d and %d, but there are %d nodes" % (k, a, b, len(node_labels)))
+			graph.add_edge(Edge("e%d" % (k + 1), a, b, modality))
+		return graph
 
 	def _build_rs_graph(self):
 		from ._backend import resolve_backend
-		_, module = resolve_backend()
-		nodes = [(n.id, n.label) for n in self.V.values()]
-		edges = [(e.id_a, e.id_b, e.modality) for e in self.E.values()]
-		self._rs_graph = module.graph_from_edges(nodes, edges)
+		backend, module = resolve_backend()
+		if backend == "py":
+			raise ValueError("as_rs requires the Rust backend")
+		rs_graph = module.graph_from_edges([], [])
+		rs_graph.add_nodes([(n.id, n.label) for n in self.V.values()])
+		rs_graph.add_edges([(e.id, e.id_a, e.id_b, e.modality) for e in self.E.values()])
+		self._rs_graph = rs_graph
 
 	def add_node(self, node):
-		self.V[node.id] = node
-		self._rs_graph = None
+		_entries(self.V)[node.id] = node
+		if self._rs_graph is not None:
+			self._rs_graph.add_node(node.id, node.label)
 
 	def add_nodes(self, nodes):
+		nodes = list(nodes)
+		entries = _entries(self.V)
 		for node in nodes:
-			self.V[node.id] = node
-		self._rs_graph = None
+			entries[node.id] = node
+		if self._rs_graph is not None:
+			self._rs_graph.add_nodes([(node.id, node.label) for node in nodes])
+
+	def _add_endpoints(self, edge):
+		"""Add the ends of ``edge`` missing from ``V`` as nodes labelled
+		``"."``, where the Rust graph adds them, so that node order stays the
+		order of ``V``."""
+		for node_id in (edge.id_a, edge.id_b):
+			if node_id not in self.V:
+				_entries(self.V)[node_id] = Node(node_id, ".")
 
 	def add_edge(self, edge):
-		self.E[edge.id] = edge
-		self._rs_graph = None
+		"""Add ``edge``; ends missing from ``V`` are added labelled ``"."``
+		and take their label from a later ``add_node``."""
+		self._add_endpoints(edge)
+		_entries(self.E)[edge.id] = edge
+		if self._rs_graph is not None:
+			self._rs_graph.add_edge(edge.id, edge.id_a, edge.id_b, edge.modality)
 
 	def add_edges(self, edges):
+		edges = list(edges)
+		entries = _entries(self.E)
 		for edge in edges:
-			self.E[edge.id] = edge
-		self._rs_graph = None
+			self._add_endpoints(edge)
+			entries[edge.id] = edge
+		if self._rs_graph is not None:
+			self._rs_graph.add_edges([(edge.id, edge.id_a, edge.id_b, edge.modality) for edge in edges])
+
+	def remove_node(self, node_id):
+		"""Remove node ``node_id`` and the edges around it."""
+		node_id = str(node_id)
+		if node_id not in self.V:
+			raise KeyError(node_id)
+		if self._rs_graph is not None:
+			self._rs_graph.remove_node(node_id)
+		_entries(self.V).pop(node_id, None)
+		edges = _entries(self.E)
+		for edge_id in [e.id for e in edges.values() if node_id in (e.id_a, e.id_b)]:
+			del edges[edge_id]
+
+	def remove_edge(self, edge_id):
+		edge_id = str(edge_id)
+		if edge_id not in self.E:
+			raise KeyError(edge_id)
+		if self._rs_graph is not None:
+			self._rs_graph.remove_edge(edge_id)
+		_entries(self.E).pop(edge_id, None)
 
 	def as_rs(self):
 		if self._rs_graph is None:
 			self._build_rs_graph()
 		return self._rs_graph
 
-	def adjacency_matrix(self, canonic=False):
-		"""Return the adjacency matrix as a list of lists.
+	def adjacency_matrix(self, canonic=False, format="list", dtype="int32"):
+		"""Return the adjacency matrix.
 
 		If *canonic* is True, the node ordering is derived from the
 		canonical tree so that isomorphic graphs produce identical matrices.
+
+		*format* is ``"list"`` for a list of lists, ``"numpy"`` for a dense
+		NumPy array of *dtype* (``"int32"`` or ``"uint8"``), or ``"csr"`` for
+		the NumPy arrays ``(data, indices, indptr)`` that
+		``scipy.sparse.csr_matrix`` takes. The Rust backend builds the matrix
+		in one native call; only the last two formats need NumPy.
+
+		Values are the edge modalities as integers. The NumPy formats need
+		them to fit in *dtype*; ``"list"`` holds Python integers of any size,
+		and leaves the native call for the Python one when a value does not
+		fit in 32 bits.
 		"""
+		if format not in ("list", "numpy", "csr"):
+			raise ValueError("unknown matrix format %r" % (format,))
+		if dtype not in _ARRAY_CODES:
+			raise ValueError("unsupported dtype %r, expected int32 or uint8" % (dtype,))
+
+		backend, module = "py", None
+		if canonic or self._rs_graph is not None:
+			from ._backend import resolve_backend
+			backend, module = resolve_backend()
+
+		if backend == "py":
+			A = self._adjacency_rows(canonic, module)
+			return A if format == "list" else _matrix_from_rows(A, format, dtype)
+
+		if format == "list":
+			try:
+				size, values, _, _ = module.adjacency_matrix_py(self.as_rs(), canonic=canonic, dense=True)
+			except OverflowError:
+				return self._adjacency_rows(canonic, module)
+			values = array.array(_ARRAY_CODES["int32"], values)
+			return [values[i * size:(i + 1) * size].tolist() for i in range(size)]
+		size, values, indices, indptr = module.adjacency_matrix_py(
+			self.as_rs(),
+			canonic=canonic,
+			dense=format != "csr",
+			dtype=dtype,
+		)
+		np = _numpy()
+		if format == "numpy":
+			return np.frombuffer(values, dtype=dtype).reshape(size, size)
+		return (
+			np.frombuffer(values, dtype=dtype),
+			np.frombuffer(indices, dtype=np.int32),
+			np.frombuffer(indptr, dtype=np.int64),
+		)
+
+	def _adjacency_rows(self, canonic, module):
+		"""Adjacency matrix as a list of lists, built in Python."""
 		N = len(self.V)
 
 		if canonic:
-			from ._backend import resolve_backend
-			_, module = resolve_backend()
-			rs_graph = self.as_rs()
-			node_order = module.canonical_node_order_py(rs_graph)
+			node_order = module.canonical_node_order_py(self.as_rs())
 		else:
 			node_order = sorted(self.V.keys())
+		positions = {node_id: i for i, node_id in enumerate(node_order)}
 
 		A = [[0] * N for _ in range(N)]
 		for edge in self.E.values():
-			i = node_order.index(self.V[edge.id_a].id)
-			j = node_order.index(self.V[edge.id_b].id)
+			i = positions[self.V[edge.id_a].id]
+			j = positions[self.V[edge.id_b].id]
 			mod = _str_to_int(edge.modality)
 			A[i][j] = mod
 			A[j][i] = mod
@@ -102,6 +313,168 @@ class Graph:
 		return "Graph(nodes=%d, edges=%d)" % (len(self.V), len(self.E))
 
 
+class GraphBatch:
+	"""Many graphs held in flat arrays rather than Node and Edge objects.
+
+	Graph ``i`` owns nodes ``node_offsets[i]:node_offsets[i + 1]`` and edges
+	``edge_offsets[i]:edge_offsets[i + 1]``. A node is stored as a code into
+	``labels``, an edge as the positions of its ends within its graph and a
+	code into ``modalities``; node and edge ids are not kept. Indexing the
+	batch gives a ``Graph`` built with ``Graph.from_arrays``.
+	"""
+
+	def __init__(self, graphs=()):
+		self.ids = []
+		self.labels = []
+		self.modalities = []
+		self.node_offsets = array.array("q", [0])
+		self.edge_offsets = array.array("q", [0])
+		self.node_labels = array.array("I")
+		self.src = array.array("I")
+		self.dst = array.array("I")
+		self.edge_modalities = array.array("I")
+		self._label_codes = {}
+		self._modality_codes = {}
+		self.extend(graphs)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("graph index out of range")
+		nodes = slice(self.node_offsets[index], self.node_offsets[index + 1])
+		edges = slice(self.edge_offsets[index], self.edge_offsets[index + 1])
+		return Graph.from_arrays(
+			self.src[edges],
+			self.dst[edges],
+			self.node_labels[nodes],
+			self.edge_modalities[edges],
+			label_names=self.labels,
+			modality_names=self.modalities,
+			id=self.ids[index],
+		)
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self[index]
+
+	def __repr__(self):
+		return "GraphBatch(graphs=%d, nodes=%d, edges=%d)" % (
+			len(self),
+			len(self.node_labels),
+			len(self.src),
+		)
+
+	def append(self, graph):
+		"""Store ``graph``; its Node and Edge objects are not kept."""
+		if isinstance(graph.V, _RsView):
+			# Read the Rust graph in bulk rather than through the views.
+			nodes = graph.as_rs().node_labels()
+			edges = [edge[1:] for edge in graph.as_rs().edges()]
+		else:
+			nodes = [(node.id, node.label) for node in graph.V.values()]
+			edges = [(edge.id_a, edge.id_b, edge.modality) for edge in graph.E.values()]
+		positions = {}
+		for node_id, label in nodes:
+			positions[node_id] = len(positions)
+			self.node_labels.append(_code(self._label_codes, self.labels, label))
+		for id_a, id_b, modality in edges:
+			for node_id in (id_a, id_b):
+				if node_id not in positions:
+					# Same placeholder as the Rust graph uses for an unknown end.
+					positions[node_id] = len(positions)
+					self.node_labels.append(_code(self._label_codes, self.labels, "."))
+			self.src.append(positions[id_a])
+			self.dst.append(positions[id_b])
+			self.edge_modalities.append(_code(self._modality_codes, self.modalities, modality))
+		self.ids.append(getattr(graph, "id", ""))
+		self.node_offsets.append(len(self.node_labels))
+		self.edge_offsets.append(len(self.src))
+
+	def extend(self, graphs):
+		for graph in graphs:
+			self.append(graph)
+
+
+def _code(codes, names, name):
+	"""Code of ``name`` in the table ``names``, added if new."""
+	code = codes.get(name)
+	if code is None:
+		code = codes[name] = len(names)
+		names.append(name)
+	return code
+
+
+# struct format characters of the integer types, mapped to their signedness.
+_INT_FORMATS = {c: c.islower() for c in "bBhHiIlLqQnN"}
+
+
+def _int_view(values, name):
+	"""``values`` as a one-dimensional integer memoryview."""
+	try:
+		view = memoryview(values)
+	except TypeError:
+		view = memoryview(array.array("q", values))
+	fmt = view.format
+	if fmt[:1] in "@=<>!":
+		order, fmt = fmt[0], fmt[1:]
+		if order in "<>!" and (order == "<") != (sys.byteorder == "little"):
+			raise ValueError("%s is not in native byte order" % name)
+	if fmt not in _INT_FORMATS:
+		raise TypeError("%s must hold integers, got format %r" % (name, view.format))
+	if view.ndim > 1:
+		raise ValueError("%s must be one-dimensional" % name)
+	return view
+
+
+def _int_array(values, name):
+	"""``values`` as ``(bytes, itemsize, signed)``, in native byte order."""
+	view = _int_view(values, name)
+	return view.tobytes(), view.itemsize, _INT_FORMATS[view.format.lstrip("@=<>!")]
+
+
+def _int_list(values, name):
+	return _int_view(values, name).tolist()
+
+
+def _name(names, code, what):
+	if not 0 <= code < len(names):
+		raise ValueError("%s code %d has no name (%d names)" % (what, code, len(names)))
+	return str(names[code])
+
+
+# array.array type codes of the matrix dtypes.
+_ARRAY_CODES = {"int32": "i", "uint8": "B"}
+
+
+def _numpy():
+	try:
+		import numpy
+	except ImportError:
+		raise ImportError(
+			"numpy is required for the 'numpy' and 'csr' matrix formats. "
+			"Install it with: pip install scott-trace[numpy]"
+		)
+	return numpy
+
+
+def _matrix_from_rows(A, format, dtype):
+	"""``A``, a list of lists, in the NumPy ``format``."""
+	np = _numpy()
+	if dtype == "uint8" and any(not 0 <= value <= 255 for row in A for value in row):
+		raise ValueError("matrix values do not fit in uint8")
+	dense = np.array(A, dtype=dtype).reshape(len(A), len(A))
+	if format == "numpy":
+		return dense
+	rows, indices = np.nonzero(dense)
+	indptr = np.zeros(len(A) + 1, dtype=np.int64)
+	np.cumsum(np.count_nonzero(dense, axis=1), out=indptr[1:])
+	return dense[rows, indices], indices.astype(np.int32), indptr
+
+
 def _str_to_int(val):
 	try:
 		return int(val)
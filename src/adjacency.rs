@@ -0,0 +1,238 @@
+//! Adjacency matrices of graphs, in a given or canonical node order.
+//!
+//! Matrices are built and stabilized as sorted sparse rows, so that neither
+//! step needs the dense N x N matrix, and are handed out either as CSR
+//! arrays or densely, row-major.
+
+use std::cmp::Ordering;
+use std::collections::HashMap;
+use std::num::IntErrorKind;
+
+use crate::canonize::canonical_node_order_with_hash;
+use crate::digest::DigestAlgorithm;
+use crate::error::{ScottError, ScottResult};
+use crate::graph::{Graph, GraphWrap};
+
+/// Square adjacency matrix, one sorted row of `(column, value)` per node,
+/// without zero entries.
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub struct Adjacency {
+	rows: Vec<Vec<(u32, i32)>>,
+}
+
+impl Adjacency {
+	/// Matrix of `graph` with node `order[i]` on row and column `i`; nodes
+	/// missing from `order` take the rows after it. The value of an edge is
+	/// its modality as an integer, see `modality_value`.
+	pub fn from_order(graph: &GraphWrap, order: &[String]) -> ScottResult<Self> {
+		let size = graph.graph.node_count();
+		let mut positions: HashMap<&str, u32> = HashMap::with_capacity(size);
+		for id in order {
+			if graph.node_index(id).is_some() && !positions.contains_key(id.as_str()) {
+				positions.insert(id.as_str(), positions.len() as u32);
+			}
+		}
+		for index in graph.graph.node_indices() {
+			let id = graph.graph[index].id.as_str();
+			if !positions.contains_key(id) {
+				positions.insert(id, positions.len() as u32);
+			}
+		}
+
+		let mut rows = vec![Vec::new(); size];
+		for edge_index in graph.graph.edge_indices() {
+			let Some((a, b)) = graph.graph.edge_endpoints(edge_index) else {
+				continue;
+			};
+			let i = positions[graph.graph[a].id.as_str()];
+			let j = positions[graph.graph[b].id.as_str()];
+			let value = modality_value(&graph.graph[edge_index].modality)?;
+			rows[i as usize].push((j, value));
+			if i != j {
+				rows[j as usize].push((i, value));
+			}
+		}
+		for row in &mut rows {
+			// A later edge between the same nodes overrides an earlier one.
+			row.reverse();
+			row.sort_by_key(|(column, _)| *column);
+			row.dedup_by_key(|(column, _)| *column);
+			row.retain(|(_, value)| *value != 0);
+		}
+		Ok(Self { rows })
+	}
+
+	pub fn size(&self) -> usize {
+		self.rows.len()
+	}
+
+	/// Resolve the ties left by the node order: rows are sorted, and the
+	/// permutation applied to rows and columns alike, until the order of the
+	/// rows no longer changes or `size` rounds have passed.
+	pub fn stabilize(&mut self) {
+		let size = self.size();
+		for _ in 0..size {
+			let mut permutation: Vec<u32> = (0..size as u32).collect();
+			permutation.sort_by(|a, b| cmp_rows(&self.rows[*a as usize], &self.rows[*b as usize]));
+			if permutation.iter().enumerate().all(|(i, old)| i as u32 == *old) {
+				break;
+			}
+			let mut position = vec![0u32; size];
+			for (new, old) in permutation.iter().enumerate() {
+				position[*old as usize] = new as u32;
+			}
+			let mut rows = Vec::with_capacity(size);
+			for old in &permutation {
+				let mut row: Vec<(u32, i32)> = self.rows[*old as usize]
+					.iter()
+					.map(|(column, value)| (position[*column as usize], *value))
+					.collect();
+				row.sort_unstable_by_key(|(column, _)| *column);
+				rows.push(row);
+			}
+			self.rows = rows;
+		}
+	}
+
+	/// CSR arrays `(data, indices, indptr)`.
+	pub fn to_csr(&self) -> (Vec<i32>, Vec<i32>, Vec<i64>) {
+		let nnz = self.rows.iter().map(Vec::len).sum();
+		let mut data = Vec::with_capacity(nnz);
+		let mut indices = Vec::with_capacity(nnz);
+		let mut indptr = Vec::with_capacity(self.size() + 1);
+		indptr.push(0);
+		for row in &self.rows {
+			for (column, value) in row {
+				indices.push(*column as i32);
+				data.push(*value);
+			}
+			indptr.push(indices.len() as i64);
+		}
+		(data, indices, indptr)
+	}
+
+	/// Dense row-major values.
+	pub fn to_dense(&self) -> Vec<i32> {
+		let size = self.size();
+		let mut dense = vec![0; size * size];
+		for (i, row) in self.rows.iter().enumerate() {
+			for (column, value) in row {
+				dense[i * size + *column as usize] = *value;
+			}
+		}
+		dense
+	}
+}
+
+/// Rows compare as their dense forms would, column by column.
+fn cmp_rows(a: &[(u32, i32)], b: &[(u32, i32)]) -> Ordering {
+	let (mut i, mut k) = (0, 0);
+	loop {
+		let ordering = match (a.get(i), b.get(k)) {
+			(None, None) => return Ordering::Equal,
+			(Some((ca, va)), Some((cb, vb))) if ca == cb => {
+				i += 1;
+				k += 1;
+				va.cmp(vb)
+			}
+			// The other row is zero at the smaller column.
+			(Some((ca, va)), Some((cb, _))) if ca < cb => va.cmp(&0),
+			(Some(_), Some((_, vb))) => 0.cmp(vb),
+			(Some((_, va)), None) => va.cmp(&0),
+			(None, Some((_, vb))) => 0.cmp(vb),
+		};
+		if ordering != Ordering::Equal {
+			return ordering;
+		}
+	}
+}
+
+/// Integer value of a modality, as `scott.graph._str_to_int` reads it: the
+/// integer it spells in Python's syntax, or else the sum of its code points.
+/// A value beyond 32 bits is a `ScottError::OutOfRange`.
+pub fn modality_value(modality: &str) -> ScottResult<i32> {
+	let out_of_range = || ScottError::OutOfRange(format!("modality {} does not fit in 32 bits", modality));
+	let value = match python_int_digits(modality) {
+		Some(digits) => digits.parse::<i64>().map_err(|err| match err.kind() {
+			IntErrorKind::PosOverflow | IntErrorKind::NegOverflow => out_of_range(),
+			_ => ScottError::Parse(format!("modality {}: {}", modality, err)),
+		})?,
+		None => modality.chars().map(|c| c as i64).sum(),
+	};
+	i32::try_from(value).map_err(|_| out_of_range())
+}
+
+/// `text` as a sign and ASCII digits, if Python's `int` would read it as a
+/// decimal integer: surrounding whitespace, an optional sign, and single
+/// underscores between digits.
+fn python_int_digits(text: &str) -> Option<String> {
+	let text = text.trim();
+	let (sign, body) = match text.strip_prefix('-') {
+		Some(body) => ("-", body),
+		None => ("", text.strip_prefix('+').unwrap_or(text)),
+	};
+	let mut digits = String::with_capacity(text.len());
+	digits.push_str(sign);
+	for group in body.split('_') {
+		if group.is_empty() || !group.bytes().all(|byte| byte.is_ascii_digit()) {
+			return None;
+		}
+		digits.push_str(group);
+	}
+	Some(digits)
+}
+
+/// Adjacency matrix of `graph` in node id order, or in canonical order,
+/// stabilized, when `canonic`.
+pub fn adjacency_matrix(
+	graph: &Graph,
+	canonic: bool,
+	candidate_rule: &str,
+	branch_rule: &str,
+	allow_hashes: bool,
+	compact: bool,
+	hash: DigestAlgorithm,
+) -> ScottResult<Adjacency> {
+	let wrap = graph.as_wrap();
+	if !canonic {
+		let mut order: Vec<String> = wrap.graph.node_indices().map(|index| wrap.graph[index].id.clone()).collect();
+		order.sort_unstable();
+		return Adjacency::from_order(wrap, &order);
+	}
+	let order = canonical_node_order_with_hash(graph, candidate_rule, branch_rule, allow_hashes, compact, hash)?;
+	let mut adjacency = Adjacency::from_order(wrap, &order)?;
+	adjacency.stabilize();
+	Ok(adjacency)
+}
+
+#[cfg(test)]
+mod tests {
+	use super::*;
+
+	#[test]
+	fn modalities_read_as_python_ints() {
+		// Values of `scott.graph._str_to_int`.
+		let cases = [
+			("12", 12),
+			("+5", 5),
+			(" -7 ", -7),
+			("1_000", 1000),
+			("0_7", 7),
+			("-2147483648", -2147483648),
+			("1__0", 287),
+			("_1", 144),
+			("1_", 144),
+			("+_1", 187),
+			("--1", 139),
+			("1.5", 148),
+			("abc", 294),
+			("", 0),
+		];
+		for (modality, value) in cases {
+			assert_eq!(modality_value(modality).unwrap(), value, "{:?}", modality);
+		}
+		for modality in ["2147483648", "99999999999999999999", "-9223372036854775809"] {
+			assert!(matches!(modality_value(modality), Err(ScottError::OutOfRange(_))), "{:?}", modality);
+		}
+	}
+}
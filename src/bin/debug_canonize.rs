@@ -1,6 +1,8 @@
 use std::collections::{BTreeMap, HashSet, VecDeque};
 
-use scott::dag::{to_dag_with_mode, InboundMode};
+use scott::dag::{dag_counts, to_dag_with_mode, InboundMode};
+use scott::digest::DigestAlgorithm;
+use scott::graph::NodeSet;
 use scott::parse::from_dot;
 use scott::tree::{to_tree_string, to_tree_string_with_depth};
 use serde_json::Value;
@@ -32,31 +34,31 @@ fn main() {
 	emit("ids_ignore", vec![("nodes", set_string(&ids_ignore))]);
 
 	let ids_ignore = if candidates.iter().all(|id| is_leaf(&graph_wrap, id)) {
-		HashSet::new()
+		NodeSet::new()
 	} else {
-		ids_ignore
+		graph_wrap.node_set(&ids_ignore)
 	};
 
 	let mode = InboundMode::Duplicate;
-	let allow_hashes = true;
+	let magnet_hash = Some(DigestAlgorithm::Md5);
 
 	for id_candidate in &candidates {
-		let empty_ignore = HashSet::new();
-		let dag = to_dag_with_mode(&graph_wrap, id_candidate, &empty_ignore, mode, allow_hashes)
+		let empty_ignore = NodeSet::new();
+		let dag = to_dag_with_mode(&graph_wrap, id_candidate, &empty_ignore, mode, magnet_hash)
 			.expect("failed to build dag");
 		let tree = to_tree_string(&dag, id_candidate, &ids_ignore)
 			.expect("failed to build tree");
 		let tree_compact = compress_cgraph(&tree);
-		let (virtuals, mirrors) = count_special_nodes(&dag);
+		let counts = dag_counts(&dag);
 		emit(
 			"candidate_tree_restricted",
 			vec![
 				("candidate", Value::String(id_candidate.clone())),
 				("tree", Value::String(tree_compact)),
-				("dag_nodes", Value::Number(dag.graph.node_count().into())),
-				("dag_edges", Value::Number(dag.graph.edge_count().into())),
-				("dag_virtuals", Value::Number(virtuals.into())),
-				("dag_mirrors", Value::Number(mirrors.into())),
+				("dag_nodes", Value::Number(counts.nodes.into())),
+				("dag_edges", Value::Number(counts.edges.into())),
+				("dag_virtuals", Value::Number(counts.virtuals.into())),
+				("dag_mirrors", Value::Number(counts.mirrors.into())),
 			],
 		);
 	}
@@ -64,8 +66,8 @@ fn main() {
 	let mut elected = Vec::new();
 	let mut max_score: Option<(i32, String)> = None;
 	for id_candidate in &candidates {
-		let empty_ignore = HashSet::new();
-		let dag = to_dag_with_mode(&graph_wrap, id_candidate, &empty_ignore, mode, allow_hashes)
+		let empty_ignore = NodeSet::new();
+		let dag = to_dag_with_mode(&graph_wrap, id_candidate, &empty_ignore, mode, magnet_hash)
 			.expect("failed to build dag");
 		let (tree, depth) = to_tree_string_with_depth(&dag, id_candidate, &ids_ignore)
 			.expect("failed to build tree");
@@ -102,11 +104,11 @@ fn main() {
 		],
 	);
 
-	let empty_ignore = HashSet::new();
+	let empty_ignore = NodeSet::new();
 	let mut best_tree: Option<String> = None;
 	let mut best_root: Option<String> = None;
 	for id_candidate in &elected {
-		let dag = to_dag_with_mode(&graph_wrap, id_candidate, &empty_ignore, mode, allow_hashes)
+		let dag = to_dag_with_mode(&graph_wrap, id_candidate, &empty_ignore, mode, magnet_hash)
 			.expect("failed to build dag");
 		let tree = to_tree_string(&dag, id_candidate, &empty_ignore)
 			.expect("failed to build tree");
@@ -255,21 +257,6 @@ fn is_leaf(graph: &scott::graph::GraphWrap, id: &str) -> bool {
 	graph.graph.neighbors(index).count() == 1
 }
 
-fn count_special_nodes(graph: &scott::graph::GraphWrap) -> (usize, usize) {
-	let mut virtuals = 0usize;
-	let mut mirrors = 0usize;
-	for node_index in graph.graph.node_indices() {
-		let meta = &graph.graph[node_index].meta;
-		if meta.is_virtual {
-			virtuals += 1;
-		}
-		if meta.is_mirror {
-			mirrors += 1;
-		}
-	}
-	(virtuals, mirrors)
-}
-
 fn compress_cgraph(cgraph: &str) -> String {
 	let mut output = String::new();
 	let mut magnets: std::collections::HashMap<String, String> = std::collections::HashMap::new();
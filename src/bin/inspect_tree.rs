@@ -9,6 +9,7 @@ fn main() {
 	let dag = graph
 		.to_dag_skeleton("A", &ids_ignore)
 		.expect("failed to build dag skeleton");
+	let ids_ignore = dag.as_wrap().node_set(&ids_ignore);
 	let tree = to_tree_string(dag.as_wrap(), "A", &ids_ignore).expect("failed to build tree string");
 	println!("{tree}");
 }
@@ -1,13 +1,24 @@
-use std::collections::{HashSet, VecDeque};
+use std::borrow::Cow;
+use std::cmp::Ordering;
+use std::collections::{HashMap, VecDeque};
+use std::io::Write as _;
+
+use petgraph::graph::NodeIndex;
+use petgraph::visit::NodeIndexable;
 
 use crate::cgraph::CGraph;
-use crate::dag::{to_dag_with_mode, InboundMode};
+use crate::dag::{to_dag_above_depth, InboundMode};
+use crate::digest::DigestAlgorithm;
 use crate::error::{ScottError, ScottResult};
-use crate::graph::{Graph, GraphWrap};
-use crate::tree::{to_tree_node_order, to_tree_string, to_tree_string_with_depth};
+use crate::graph::{Graph, GraphWrap, NodeSet};
+use crate::pool;
+use crate::rule::{CandidateRule, ScoreValue};
+use crate::tree::{cmp_trees, to_tree, to_tree_node_order, Tree, TreeNode};
 
 #[cfg(feature = "parallel")]
 use rayon::prelude::*;
+#[cfg(feature = "parallel")]
+use std::sync::Mutex;
 
 pub fn to_cgraph(
 	_graph: &Graph,
@@ -17,271 +28,533 @@ pub fn to_cgraph(
 	_compress: bool,
 	_compact: bool,
 ) -> ScottResult<CGraph> {
-	let mut graph = _graph.as_wrap().clone();
+	to_cgraph_with_hash(
+		_graph,
+		_candidate_rule,
+		_branch_rule,
+		_allow_hashes,
+		_compress,
+		_compact,
+		DigestAlgorithm::Md5,
+	)
+}
+
+/// `to_cgraph` with magnets hashed by `hash` instead of MD5.
+///
+/// The trace is prefixed with the trace format of `hash` (see
+/// `DigestAlgorithm::trace_stamp`), so traces built with different magnet
+/// hashes never compare equal. MD5 traces are left unstamped.
+pub fn to_cgraph_with_hash(
+	graph: &Graph,
+	candidate_rule: &str,
+	branch_rule: &str,
+	allow_hashes: bool,
+	compress: bool,
+	compact: bool,
+	hash: DigestAlgorithm,
+) -> ScottResult<CGraph> {
+	let magnet_hash = allow_hashes.then_some(hash);
+	let mut output = trace_stamp(magnet_hash).as_bytes().to_vec();
+	if let Some(tree) = canonical_tree(graph, candidate_rule, branch_rule, magnet_hash, compact)? {
+		if !compress {
+			output.reserve(tree.len());
+		}
+		write_trace(&tree, compress, |bytes| output.extend_from_slice(bytes));
+	}
+	let trace = String::from_utf8(output).map_err(|err| ScottError::Parse(format!("trace is not valid UTF-8: {}", err)))?;
+	Ok(CGraph::new(trace))
+}
+
+/// Digest of the string `to_cgraph_with_hash` would return with the same arguments.
+///
+/// The canonical tree is streamed into the hasher, through the magnet
+/// compression when `compress` is set, so the trace is never built.
+#[allow(clippy::too_many_arguments)]
+pub fn canonical_digest(
+	graph: &Graph,
+	candidate_rule: &str,
+	branch_rule: &str,
+	allow_hashes: bool,
+	compress: bool,
+	compact: bool,
+	hash: DigestAlgorithm,
+	algorithm: DigestAlgorithm,
+) -> ScottResult<Vec<u8>> {
+	let magnet_hash = allow_hashes.then_some(hash);
+	let mut hasher = algorithm.hasher();
+	hasher.update(trace_stamp(magnet_hash).as_bytes());
+	if let Some(tree) = canonical_tree(graph, candidate_rule, branch_rule, magnet_hash, compact)? {
+		write_trace(&tree, compress, |bytes| hasher.update(bytes));
+	}
+	Ok(hasher.finish().to_vec())
+}
+
+/// Stream the trace of `tree` into `sink`, numbering its magnets on the way
+/// when `compress` is set.
+fn write_trace(tree: &TreeNode, compress: bool, mut sink: impl FnMut(&[u8])) {
+	if compress {
+		let mut compressor = Compressor::new(sink);
+		tree.write(&mut |bytes| compressor.feed(bytes));
+	} else {
+		tree.write(&mut sink);
+	}
+}
+
+fn trace_stamp(magnet_hash: Option<DigestAlgorithm>) -> &'static str {
+	magnet_hash.map(DigestAlgorithm::trace_stamp).unwrap_or("")
+}
+
+/// Smallest tree of the elected candidates, before any compression.
+fn canonical_tree(
+	graph: &Graph,
+	candidate_rule: &str,
+	branch_rule: &str,
+	magnet_hash: Option<DigestAlgorithm>,
+	compact: bool,
+) -> ScottResult<Option<Tree>> {
+	pool::install(|| {
+		let elected = elect(graph, candidate_rule, branch_rule, magnet_hash, compact)?;
+		Ok(best_tree(&elected)?.map(|(tree, _, _)| tree))
+	})
+}
+
+/// Elected candidates, each with the DAG it was scored on.
+type Elected<'g> = Vec<(String, Cow<'g, GraphWrap>)>;
+
+/// Score, prune and elect the root candidates of `graph`.
+fn elect<'g>(
+	graph: &'g Graph,
+	candidate_rule: &str,
+	_branch_rule: &str,
+	magnet_hash: Option<DigestAlgorithm>,
+	compact: bool,
+) -> ScottResult<Elected<'g>> {
+	let graph = graph.as_wrap();
 	if graph.graph.node_count() == 0 {
-		return Ok(CGraph::new(String::new()));
+		return Ok(Vec::new());
 	}
 
-	let candidate_scores = score_candidates(&graph, _candidate_rule)?;
-	let candidates = select_candidates(&candidate_scores);
-	let unmastered = prune_graph(&mut graph, &candidates);
+	let candidate_scores = score_candidates(graph, candidate_rule)?;
+	let candidates = select_candidates(graph, &candidate_scores);
+	let unmastered = prune_graph(graph, &candidates);
 
-	let ids_ignore = if candidates.iter().all(|id| is_leaf(&graph, id)) {
-		HashSet::new()
+	let ids_ignore = if candidates.iter().all(|id| is_leaf(graph, id)) {
+		NodeSet::new()
 	} else {
 		unmastered
 	};
 
-	let mode = if _compact {
+	if is_forest(graph) {
+		return elect_forest_candidates(graph, &candidates, &ids_ignore);
+	}
+
+	let mode = if compact {
 		InboundMode::Elect
 	} else {
 		InboundMode::Duplicate
 	};
 
-	let candidate_results = collect_candidate_scores(
-		&graph,
-		&candidates,
-		&ids_ignore,
-		mode,
-		_allow_hashes,
-	)?;
-	let mut elected = Vec::new();
-	let mut max_score: Option<(i32, String)> = None;
-	for (id_candidate, depth, tree) in candidate_results {
-		let score = (depth, tree.clone());
-		match max_score {
-			Some(ref best) if score == *best => {
-				elected.push(id_candidate);
-			}
-			Some(ref best) if score > *best => {
-				max_score = Some(score);
-				elected.clear();
-				elected.push(id_candidate);
-			}
-			None => {
-				max_score = Some(score);
-				elected.push(id_candidate);
-			}
-			_ => {}
-		}
-	}
-
-	let best_tree = collect_best_tree(&graph, &elected, mode, _allow_hashes)?;
+	Ok(elect_candidates(graph, &candidates, &ids_ignore, mode, magnet_hash)?
+		.into_iter()
+		.map(|(id_candidate, dag)| (id_candidate, Cow::Owned(dag)))
+		.collect())
+}
 
-	let output = best_tree.unwrap_or_default();
-	if _compress {
-		Ok(CGraph::new(compress_cgraph(&output)))
-	} else {
-		Ok(CGraph::new(output))
+/// Canonize every graph of `graphs`, returning one result per input, in order.
+///
+/// A failing graph yields its own `Err` without aborting the rest of the
+/// batch. With the `parallel` feature the graphs are spread over the pool of
+/// `crate::pool`; if that pool cannot be built, every item carries the error.
+pub fn to_cgraph_batch(
+	graphs: &[&Graph],
+	candidate_rule: &str,
+	branch_rule: &str,
+	allow_hashes: bool,
+	compress: bool,
+	compact: bool,
+	hash: DigestAlgorithm,
+) -> Vec<ScottResult<CGraph>> {
+	#[cfg(feature = "parallel")]
+	{
+		let batch = pool::install(|| {
+			Ok(graphs
+				.par_iter()
+				.map(|graph| {
+					to_cgraph_with_hash(
+						graph,
+						candidate_rule,
+						branch_rule,
+						allow_hashes,
+						compress,
+						compact,
+						hash,
+					)
+				})
+				.collect())
+		});
+		return batch.unwrap_or_else(|err| graphs.iter().map(|_| Err(err.clone())).collect());
+	}
+	#[cfg(not(feature = "parallel"))]
+	{
+		graphs
+			.iter()
+			.map(|graph| {
+				to_cgraph_with_hash(
+					graph,
+					candidate_rule,
+					branch_rule,
+					allow_hashes,
+					compress,
+					compact,
+					hash,
+				)
+			})
+			.collect()
 	}
 }
 
 
-fn score_candidates(graph: &GraphWrap, rule: &str) -> ScottResult<Vec<(String, Vec<i32>)>> {
-	let mut scores = Vec::with_capacity(graph.graph.node_count());
-	for node_index in graph.graph.node_indices() {
-		let id = graph.graph[node_index].id.clone();
-		let degree = graph.graph.neighbors(node_index).count() as i32;
-		let score = match rule {
-			"$degree" => vec![degree],
-			_ => {
-				return Err(ScottError::Unsupported(format!(
-					"candidate rule '{}' not implemented",
-					rule
-				)))
-			}
-		};
-		scores.push((id, score));
-	}
-	Ok(scores)
+fn score_candidates(graph: &GraphWrap, rule: &str) -> ScottResult<Vec<(NodeIndex, Vec<ScoreValue>)>> {
+	let rule = CandidateRule::parse(rule)?;
+	Ok(rule.score_nodes(graph))
 }
 
-fn select_candidates(scores: &[(String, Vec<i32>)]) -> Vec<String> {
+fn select_candidates(graph: &GraphWrap, scores: &[(NodeIndex, Vec<ScoreValue>)]) -> Vec<String> {
 	let mut candidates = Vec::with_capacity(scores.len());
-	let mut max_score: Option<Vec<i32>> = None;
-	for (id, score) in scores {
+	let mut max_score: Option<&Vec<ScoreValue>> = None;
+	for (node_index, score) in scores {
 		match max_score {
-			Some(ref max) if score == max => {
-				candidates.push(id.clone());
+			Some(max) if score == max => {
+				candidates.push(*node_index);
 			}
-			Some(ref max) if score > max => {
-				max_score = Some(score.clone());
+			Some(max) if score > max => {
+				max_score = Some(score);
 				candidates.clear();
-				candidates.push(id.clone());
+				candidates.push(*node_index);
 			}
 			None => {
-				max_score = Some(score.clone());
-				candidates.push(id.clone());
+				max_score = Some(score);
+				candidates.push(*node_index);
 			}
 			_ => {}
 		}
 	}
 	candidates
+		.into_iter()
+		.map(|node_index| graph.graph[node_index].id.clone())
+		.collect()
 }
 
-fn collect_candidate_scores(
+/// `(depth, tree)` of a candidate, ordered as `(depth, tree string)`.
+type ElectionKey = (i32, Tree);
+
+fn cmp_keys(a: &ElectionKey, b: &ElectionKey) -> Ordering {
+	a.0.cmp(&b.0).then_with(|| cmp_trees(&a.1, &b.1))
+}
+
+/// Candidates whose `(depth, tree)` score is maximal, in `candidates` order,
+/// each with the DAG it was scored on.
+///
+/// Only candidates tied with the best key seen so far keep their DAG. Keys
+/// are compared on the hash-consed trees, so no tree string is built. The
+/// DAGs are built without an ignore set, so the elected ones serve the final
+/// tree string as they are.
+///
+/// In `InboundMode::Elect` the depth of a candidate is known from its floors,
+/// so a candidate shallower than the best one so far is dropped before any
+/// of its bounds is fixed, see `to_dag_above_depth`. In
+/// `InboundMode::Duplicate` every candidate is rewritten.
+fn elect_candidates(
 	graph: &GraphWrap,
 	candidates: &[String],
-	ids_ignore: &HashSet<String>,
+	ids_ignore: &NodeSet,
 	mode: InboundMode,
-	allow_hashes: bool,
-) -> ScottResult<Vec<(String, i32, String)>> {
+	magnet_hash: Option<DigestAlgorithm>,
+) -> ScottResult<Vec<(String, GraphWrap)>> {
 	#[cfg(feature = "parallel")]
 	{
-		let empty_ignore = HashSet::new();
-		let results: Vec<ScottResult<(String, i32, String)>> = candidates
+		let empty_ignore = NodeSet::new();
+		let incumbent: Mutex<Option<ElectionKey>> = Mutex::new(None);
+		let results: Vec<ScottResult<Option<(usize, ElectionKey, GraphWrap)>>> = candidates
 			.par_iter()
-			.map(|id_candidate| {
-				let dag = to_dag_with_mode(graph, id_candidate, &empty_ignore, mode, allow_hashes)?;
-				let (tree, depth) =
-					to_tree_string_with_depth(&dag, id_candidate, ids_ignore)
-						.map_err(ScottError::Parse)?;
-				Ok((id_candidate.clone(), depth, tree))
+			.enumerate()
+			.map(|(position, id_candidate)| {
+				// The incumbent only ever grows, so a stale depth is still a
+				// sound bound.
+				let min_depth = incumbent_depth(&incumbent);
+				let dag = match to_dag_above_depth(graph, id_candidate, &empty_ignore, mode, magnet_hash, min_depth)? {
+					Some(dag) => dag,
+					None => return Ok(None),
+				};
+				let key = election_key(&dag, id_candidate, ids_ignore)?;
+				let mut best = incumbent.lock().unwrap_or_else(|poisoned| poisoned.into_inner());
+				match best.as_ref().map(|current| cmp_keys(&key, current)) {
+					Some(Ordering::Less) => return Ok(None),
+					Some(Ordering::Equal) => {}
+					_ => *best = Some(key.clone()),
+				}
+				Ok(Some((position, key, dag)))
 			})
 			.collect();
-		let mut output = Vec::with_capacity(results.len());
+		let mut survivors = Vec::with_capacity(results.len());
 		for item in results {
-			output.push(item?);
+			if let Some(survivor) = item? {
+				survivors.push(survivor);
+			}
 		}
-		return Ok(output);
+		let best = match incumbent.into_inner().unwrap_or_else(|poisoned| poisoned.into_inner()) {
+			Some(best) => best,
+			None => return Ok(Vec::new()),
+		};
+		let mut leaders: Vec<(usize, GraphWrap)> = survivors
+			.into_iter()
+			.filter(|(_, key, _)| cmp_keys(key, &best) == Ordering::Equal)
+			.map(|(position, _, dag)| (position, dag))
+			.collect();
+		leaders.sort_by_key(|(position, _)| *position);
+		return Ok(leaders
+			.into_iter()
+			.map(|(position, dag)| (candidates[position].clone(), dag))
+			.collect());
 	}
 	#[cfg(not(feature = "parallel"))]
 	{
-		let empty_ignore = HashSet::new();
-		let mut output = Vec::with_capacity(candidates.len());
+		let empty_ignore = NodeSet::new();
+		let mut best: Option<ElectionKey> = None;
+		let mut elected: Vec<(String, GraphWrap)> = Vec::new();
 		for id_candidate in candidates {
-			let dag = to_dag_with_mode(graph, id_candidate, &empty_ignore, mode, allow_hashes)?;
-			let (tree, depth) =
-				to_tree_string_with_depth(&dag, id_candidate, ids_ignore)
-					.map_err(ScottError::Parse)?;
-			output.push((id_candidate.clone(), depth, tree));
+			let min_depth = best.as_ref().map_or(0, |(depth, _)| *depth);
+			let dag = match to_dag_above_depth(graph, id_candidate, &empty_ignore, mode, magnet_hash, min_depth)? {
+				Some(dag) => dag,
+				None => continue,
+			};
+			let key = election_key(&dag, id_candidate, ids_ignore)?;
+			match best.as_ref().map(|current| cmp_keys(&key, current)) {
+				Some(Ordering::Less) => {}
+				Some(Ordering::Equal) => elected.push((id_candidate.clone(), dag)),
+				_ => {
+					best = Some(key);
+					elected.clear();
+					elected.push((id_candidate.clone(), dag));
+				}
+			}
+		}
+		Ok(elected)
+	}
+}
+
+#[cfg(feature = "parallel")]
+fn incumbent_depth(incumbent: &Mutex<Option<ElectionKey>>) -> i32 {
+	let best = incumbent.lock().unwrap_or_else(|poisoned| poisoned.into_inner());
+	best.as_ref().map_or(0, |(depth, _)| *depth)
+}
+
+/// `elect_candidates` for a forest, skipping the DAG rewrite.
+///
+/// A forest has no bound to fix: the DAG of a candidate is just its own
+/// tree, so the graph stands in for every DAG and is never copied. The
+/// depth of every candidate comes from `forest_depths` in one linear pass,
+/// and only the deepest candidates have their tree built and compared.
+fn elect_forest_candidates<'g>(
+	graph: &'g GraphWrap,
+	candidates: &[String],
+	ids_ignore: &NodeSet,
+) -> ScottResult<Elected<'g>> {
+	let depths = forest_depths(graph, ids_ignore);
+	let depth_of = |id: &String| graph.node_index(id).map_or(0, |index| depths[index.index()]);
+	let deepest = candidates.iter().map(depth_of).max().unwrap_or(0);
+
+	let mut best: Option<ElectionKey> = None;
+	let mut elected: Elected<'g> = Vec::new();
+	for id_candidate in candidates.iter().filter(|id| depth_of(id) == deepest) {
+		let key = election_key(graph, id_candidate, ids_ignore)?;
+		match best.as_ref().map(|current| cmp_keys(&key, current)) {
+			Some(Ordering::Less) => {}
+			Some(Ordering::Equal) => elected.push((id_candidate.clone(), Cow::Borrowed(graph))),
+			_ => {
+				best = Some(key);
+				elected.clear();
+				elected.push((id_candidate.clone(), Cow::Borrowed(graph)));
+			}
+		}
+	}
+	Ok(elected)
+}
+
+/// Depth of the tree of every node of a forest, by node index, with the
+/// nodes of `ids_ignore` cut out: one more than its eccentricity in what is
+/// left of its tree. Every node is farthest from one end of a diameter, and
+/// two sweeps of each tree find those ends.
+fn forest_depths(graph: &GraphWrap, ids_ignore: &NodeSet) -> Vec<i32> {
+	let node_bound = graph.graph.node_bound();
+	let mut depths = vec![0; node_bound];
+	let mut from_start = vec![-1; node_bound];
+	let mut from_a = vec![-1; node_bound];
+	let mut from_b = vec![-1; node_bound];
+	for start in graph.graph.node_indices() {
+		if from_start[start.index()] >= 0 || ids_ignore.contains(graph.graph[start].key) {
+			continue;
+		}
+		let (a, _) = sweep(graph, start, ids_ignore, &mut from_start);
+		let (b, _) = sweep(graph, a, ids_ignore, &mut from_a);
+		let (_, tree) = sweep(graph, b, ids_ignore, &mut from_b);
+		for node_index in tree {
+			let slot = node_index.index();
+			depths[slot] = 1 + std::cmp::max(from_a[slot], from_b[slot]);
 		}
-		Ok(output)
 	}
+	depths
 }
 
-fn collect_best_tree(
+/// Distances from `start` within its tree, written into `distances`, with
+/// the farthest node and the nodes reached, in order.
+fn sweep(
 	graph: &GraphWrap,
-	elected: &[String],
-	mode: InboundMode,
-	allow_hashes: bool,
-) -> ScottResult<Option<String>> {
-	#[cfg(feature = "parallel")]
-	{
-		let empty_ignore = HashSet::new();
-		let results: Vec<ScottResult<String>> = elected
-			.par_iter()
-			.map(|id_candidate| {
-				let dag = to_dag_with_mode(graph, id_candidate, &empty_ignore, mode, allow_hashes)?;
-				let tree = to_tree_string(&dag, id_candidate, &empty_ignore)
-					.map_err(ScottError::Parse)?;
-				Ok(tree)
-			})
-			.collect();
-		let mut best_tree: Option<String> = None;
-		for item in results {
-			let tree = item?;
-			match best_tree {
-				Some(ref current) if tree < *current => best_tree = Some(tree),
-				None => best_tree = Some(tree),
-				_ => {}
+	start: NodeIndex,
+	ids_ignore: &NodeSet,
+	distances: &mut [i32],
+) -> (NodeIndex, Vec<NodeIndex>) {
+	let mut reached = vec![start];
+	distances[start.index()] = 0;
+	let mut next = 0;
+	while let Some(&node_index) = reached.get(next) {
+		next += 1;
+		for neighbor in graph.graph.neighbors(node_index) {
+			if distances[neighbor.index()] >= 0 || ids_ignore.contains(graph.graph[neighbor].key) {
+				continue;
 			}
+			distances[neighbor.index()] = distances[node_index.index()] + 1;
+			reached.push(neighbor);
 		}
-		return Ok(best_tree);
 	}
-	#[cfg(not(feature = "parallel"))]
-	{
-		let empty_ignore = HashSet::new();
-		let mut best_tree: Option<String> = None;
-		for id_candidate in elected {
-			let dag = to_dag_with_mode(graph, id_candidate, &empty_ignore, mode, allow_hashes)?;
-			let tree = to_tree_string(&dag, id_candidate, &empty_ignore)
-				.map_err(ScottError::Parse)?;
-			match best_tree {
-				Some(ref current) if tree < *current => best_tree = Some(tree),
-				None => best_tree = Some(tree),
-				_ => {}
+	let farthest = *reached.last().unwrap_or(&start);
+	(farthest, reached)
+}
+
+fn is_forest(graph: &GraphWrap) -> bool {
+	if graph.graph.edge_count() >= graph.graph.node_count() {
+		return false;
+	}
+	let mut parents: Vec<usize> = (0..graph.graph.node_bound()).collect();
+	for edge_index in graph.graph.edge_indices() {
+		if let Some((a, b)) = graph.graph.edge_endpoints(edge_index) {
+			let root_a = find_root(&mut parents, a.index());
+			let root_b = find_root(&mut parents, b.index());
+			if root_a == root_b {
+				return false;
 			}
+			parents[root_a] = root_b;
 		}
-		Ok(best_tree)
 	}
+	true
 }
 
-fn prune_graph(graph: &mut GraphWrap, candidates: &[String]) -> HashSet<String> {
-	let mut candidates_set = HashSet::with_capacity(candidates.len());
-	for id in candidates {
-		candidates_set.insert(id.clone());
+/// Union-find lookup, halving the path on the way.
+fn find_root(parents: &mut [usize], mut node: usize) -> usize {
+	while parents[node] != node {
+		parents[node] = parents[parents[node]];
+		node = parents[node];
+	}
+	node
+}
+
+fn election_key(dag: &GraphWrap, id_candidate: &str, ids_ignore: &NodeSet) -> ScottResult<ElectionKey> {
+	let tree = to_tree(dag, id_candidate, ids_ignore).map_err(ScottError::Parse)?;
+	Ok((tree.depth(), tree))
+}
+
+/// Smallest tree among the elected candidates, with the DAG it came from.
+fn best_tree<'a>(elected: &'a [(String, Cow<'_, GraphWrap>)]) -> ScottResult<Option<(Tree, &'a str, &'a GraphWrap)>> {
+	let empty_ignore = NodeSet::new();
+	#[cfg(feature = "parallel")]
+	let results: Vec<ScottResult<Tree>> = elected
+		.par_iter()
+		.map(|(id_candidate, dag)| to_tree(dag, id_candidate, &empty_ignore).map_err(ScottError::Parse))
+		.collect();
+	#[cfg(not(feature = "parallel"))]
+	let results: Vec<ScottResult<Tree>> = elected
+		.iter()
+		.map(|(id_candidate, dag)| to_tree(dag, id_candidate, &empty_ignore).map_err(ScottError::Parse))
+		.collect();
+
+	let mut best: Option<(Tree, &str, &GraphWrap)> = None;
+	for (item, (id_candidate, dag)) in results.into_iter().zip(elected) {
+		let tree = item?;
+		match best {
+			Some((ref current, _, _)) if cmp_trees(&tree, current) != Ordering::Less => {}
+			_ => best = Some((tree, id_candidate, dag)),
+		}
 	}
+	Ok(best)
+}
 
-	let node_indices: Vec<_> = graph.graph.node_indices().collect();
-	for node_index in node_indices {
-		if let Some(node) = graph.graph.node_weight_mut(node_index) {
-			node.meta.master = None;
-			node.meta.master_attempts.clear();
+/// Spread a message from every candidate; nodes reached by more than one
+/// candidate end up without a master. Returns the keys of those nodes.
+fn prune_graph(graph: &GraphWrap, candidates: &[String]) -> NodeSet {
+	let node_bound = graph.graph.node_bound();
+	let mut is_candidate = vec![false; node_bound];
+	for id in candidates {
+		if let Some(index) = graph.node_index(id) {
+			is_candidate[index.index()] = true;
 		}
 	}
 
-	for id_candidate in candidates {
+	// Messages are candidate positions.
+	let mut master: Vec<Option<u32>> = vec![None; node_bound];
+	let mut master_attempts: Vec<Vec<u32>> = vec![Vec::new(); node_bound];
+
+	for (msg, id_candidate) in candidates.iter().enumerate() {
+		let msg = msg as u32;
 		let start_index = match graph.node_index(id_candidate) {
 			Some(index) => index,
 			None => continue,
 		};
 		let mut queue = VecDeque::with_capacity(graph.graph.node_count());
-		queue.push_back((start_index, None, id_candidate.clone()));
-		while let Some((from, origin, msg)) = queue.pop_front() {
-			let neighbors: Vec<_> = graph.graph.neighbors(from).collect();
-			for neighbor in neighbors {
+		queue.push_back((start_index, None));
+		while let Some((from, origin)) = queue.pop_front() {
+			for neighbor in graph.graph.neighbors(from) {
 				if Some(neighbor) == origin {
 					continue;
 				}
-				let neighbor_id = graph.graph[neighbor].id.clone();
-				if candidates_set.contains(&neighbor_id) {
+				let slot = neighbor.index();
+				if is_candidate[slot] {
 					continue;
 				}
 
-				let should_broadcast;
-				{
-					let meta = &mut graph.graph[neighbor].meta;
-					match &meta.master {
-						Some(master) => {
-							if master == &msg {
-								continue;
-							}
-							meta.master = None;
-							if meta.master_attempts.iter().any(|m| m == &msg) {
-								continue;
-							}
-							meta.master_attempts.push(msg.clone());
-							should_broadcast = true;
+				let attempts = &mut master_attempts[slot];
+				match master[slot] {
+					Some(current) => {
+						if current == msg {
+							continue;
 						}
-						None => {
-							if !meta.master_attempts.is_empty() {
-								if meta.master_attempts.iter().any(|m| m == &msg) {
-									continue;
-								}
-								meta.master_attempts.push(msg.clone());
-								should_broadcast = true;
-							} else {
-								meta.master = Some(msg.clone());
-								meta.master_attempts.push(msg.clone());
-								should_broadcast = true;
+						master[slot] = None;
+						if attempts.contains(&msg) {
+							continue;
+						}
+						attempts.push(msg);
+					}
+					None => {
+						if !attempts.is_empty() {
+							if attempts.contains(&msg) {
+								continue;
 							}
+							attempts.push(msg);
+						} else {
+							master[slot] = Some(msg);
+							attempts.push(msg);
 						}
 					}
 				}
-
-				if should_broadcast {
-					queue.push_back((neighbor, Some(from), msg.clone()));
-				}
+				queue.push_back((neighbor, Some(from)));
 			}
 		}
 	}
 
-	let mut unmastered = HashSet::with_capacity(graph.graph.node_count());
+	let mut unmastered = NodeSet::with_bound(graph.key_bound());
 	for node_index in graph.graph.node_indices() {
-		let node = &graph.graph[node_index];
-		if node.meta.master.is_none() && !node.meta.master_attempts.is_empty() {
-			unmastered.insert(node.id.clone());
+		let slot = node_index.index();
+		if master[slot].is_none() && !master_attempts[slot].is_empty() {
+			unmastered.insert(graph.graph[node_index].key);
 		}
 	}
 	unmastered
@@ -295,46 +568,86 @@ fn is_leaf(graph: &GraphWrap, id: &str) -> bool {
 	graph.graph.neighbors(index).count() == 1
 }
 
-fn compress_cgraph(cgraph: &str) -> String {
-	let mut output = String::new();
-	let mut magnets: std::collections::HashMap<String, String> = std::collections::HashMap::new();
-	let mut magnet = String::new();
-	let mut in_magnet = false;
-	let mut cpt = 0usize;
-	let mut depth = 0usize;
-
-	for ch in cgraph.chars() {
-		if !in_magnet {
-			output.push(ch);
-			if ch == '{' {
-				in_magnet = true;
-			}
-			continue;
+/// Streaming magnet compression: the content of every outermost `{...}` is
+/// replaced by `$N`, distinct magnets being numbered in order of appearance.
+///
+/// Fed with the pieces of a tree string, so magnets are numbered as the
+/// tree is emitted. A magnet lying within one piece, as every magnet of a
+/// label does, is keyed on that piece and never copied; only one cut across
+/// pieces is gathered into `magnet`. Braces are ASCII, so pieces may be cut
+/// anywhere, even inside a multi-byte character.
+struct Compressor<'t, F: FnMut(&[u8])> {
+	sink: F,
+	magnets: HashMap<Cow<'t, [u8]>, usize>,
+	magnet: Vec<u8>,
+	number: Vec<u8>,
+	in_magnet: bool,
+	depth: usize,
+}
+
+impl<'t, F: FnMut(&[u8])> Compressor<'t, F> {
+	fn new(sink: F) -> Self {
+		Self {
+			sink,
+			magnets: HashMap::new(),
+			magnet: Vec::new(),
+			number: Vec::new(),
+			in_magnet: false,
+			depth: 0,
 		}
+	}
 
-		if ch == '{' {
-			depth += 1;
-			magnet.push(ch);
-		} else if ch == '}' {
-			if depth == 0 {
-				in_magnet = false;
-				let entry = magnets.entry(magnet.clone()).or_insert_with(|| {
-					cpt += 1;
-					format!("${}", cpt)
-				});
-				output.push_str(entry);
-				output.push('}');
-				magnet.clear();
-			} else {
-				depth -= 1;
-				magnet.push(ch);
+	fn feed(&mut self, mut bytes: &'t [u8]) {
+		while !bytes.is_empty() {
+			if !self.in_magnet {
+				match bytes.iter().position(|byte| *byte == b'{') {
+					Some(pos) => {
+						(self.sink)(&bytes[..=pos]);
+						self.in_magnet = true;
+						bytes = &bytes[pos + 1..];
+					}
+					None => {
+						(self.sink)(bytes);
+						return;
+					}
+				}
+				continue;
 			}
-		} else {
-			magnet.push(ch);
+
+			let mut end = None;
+			for (pos, byte) in bytes.iter().enumerate() {
+				match byte {
+					b'{' => self.depth += 1,
+					b'}' if self.depth == 0 => {
+						end = Some(pos);
+						break;
+					}
+					b'}' => self.depth -= 1,
+					_ => {}
+				}
+			}
+			let pos = match end {
+				Some(pos) => pos,
+				None => {
+					self.magnet.extend_from_slice(bytes);
+					return;
+				}
+			};
+			let key = if self.magnet.is_empty() {
+				Cow::Borrowed(&bytes[..pos])
+			} else {
+				self.magnet.extend_from_slice(&bytes[..pos]);
+				Cow::Owned(std::mem::take(&mut self.magnet))
+			};
+			let next = self.magnets.len() + 1;
+			let number = *self.magnets.entry(key).or_insert(next);
+			self.number.clear();
+			let _ = write!(self.number, "${}}}", number);
+			(self.sink)(&self.number);
+			self.in_magnet = false;
+			bytes = &bytes[pos + 1..];
 		}
 	}
-
-	output
 }
 
 pub fn canonical_node_order(
@@ -344,76 +657,34 @@ pub fn canonical_node_order(
 	_allow_hashes: bool,
 	_compact: bool,
 ) -> ScottResult<Vec<String>> {
-	let mut graph = _graph.as_wrap().clone();
-	if graph.graph.node_count() == 0 {
-		return Ok(Vec::new());
-	}
-
-	let candidate_scores = score_candidates(&graph, _candidate_rule)?;
-	let candidates = select_candidates(&candidate_scores);
-	let unmastered = prune_graph(&mut graph, &candidates);
-
-	let ids_ignore = if candidates.iter().all(|id| is_leaf(&graph, id)) {
-		HashSet::new()
-	} else {
-		unmastered
-	};
-
-	let mode = if _compact {
-		InboundMode::Elect
-	} else {
-		InboundMode::Duplicate
-	};
-
-	let candidate_results = collect_candidate_scores(
-		&graph,
-		&candidates,
-		&ids_ignore,
-		mode,
+	canonical_node_order_with_hash(
+		_graph,
+		_candidate_rule,
+		_branch_rule,
 		_allow_hashes,
-	)?;
-	let mut elected = Vec::new();
-	let mut max_score: Option<(i32, String)> = None;
-	for (id_candidate, depth, tree) in candidate_results {
-		let score = (depth, tree.clone());
-		match max_score {
-			Some(ref best) if score == *best => {
-				elected.push(id_candidate);
-			}
-			Some(ref best) if score > *best => {
-				max_score = Some(score);
-				elected.clear();
-				elected.push(id_candidate);
-			}
-			None => {
-				max_score = Some(score);
-				elected.push(id_candidate);
-			}
-			_ => {}
-		}
-	}
+		_compact,
+		DigestAlgorithm::Md5,
+	)
+}
 
-	// Pick the best elected candidate (same logic as collect_best_tree)
-	let empty_ignore = HashSet::new();
-	let mut best: Option<(String, Vec<String>)> = None;
-	for id_candidate in &elected {
-		let dag = to_dag_with_mode(&graph, id_candidate, &empty_ignore, mode, _allow_hashes)?;
-		let tree = to_tree_string(&dag, id_candidate, &empty_ignore)
-			.map_err(ScottError::Parse)?;
-		let order = to_tree_node_order(&dag, id_candidate, &empty_ignore)
-			.map_err(ScottError::Parse)?;
-		match best {
-			Some((ref current_tree, _)) if tree < *current_tree => {
-				best = Some((tree, order));
-			}
-			None => {
-				best = Some((tree, order));
+/// `canonical_node_order` with magnets hashed by `hash` instead of MD5.
+pub fn canonical_node_order_with_hash(
+	graph: &Graph,
+	candidate_rule: &str,
+	branch_rule: &str,
+	allow_hashes: bool,
+	compact: bool,
+	hash: DigestAlgorithm,
+) -> ScottResult<Vec<String>> {
+	pool::install(|| {
+		let elected = elect(graph, candidate_rule, branch_rule, allow_hashes.then_some(hash), compact)?;
+		match best_tree(&elected)? {
+			Some((_, id_candidate, dag)) => {
+				to_tree_node_order(dag, id_candidate, &NodeSet::new()).map_err(ScottError::Parse)
 			}
-			_ => {}
+			None => Ok(Vec::new()),
 		}
-	}
-
-	Ok(best.map(|(_, order)| order).unwrap_or_default())
+	})
 }
 
 pub fn is_isomorphic(
@@ -429,3 +700,343 @@ pub fn is_isomorphic(
 	let right_c = to_cgraph(right, candidate_rule, branch_rule, allow_hashes, compress, compact)?;
 	Ok(left_c == right_c)
 }
+
+#[cfg(test)]
+mod tests {
+	use super::*;
+	use crate::dag::to_dag_with_mode;
+
+	fn graph_from(edges: &[(&str, &str)]) -> GraphWrap {
+		let mut graph = GraphWrap::new();
+		for (from, to) in edges {
+			graph.add_edge(from, to);
+		}
+		graph
+	}
+
+	/// The tail `a-b-c-d-e` hanging from the triangle `e-f-g`.
+	fn lollipop() -> GraphWrap {
+		graph_from(&[("a", "b"), ("b", "c"), ("c", "d"), ("d", "e"), ("e", "f"), ("f", "g"), ("g", "e")])
+	}
+
+	/// The tail of `lollipop`, a path.
+	fn lollipop_tail() -> GraphWrap {
+		graph_from(&[("a", "b"), ("b", "c"), ("c", "d"), ("d", "e")])
+	}
+
+	fn graphs() -> Vec<GraphWrap> {
+		vec![
+			lollipop(),
+			// A square with one diagonal and a tail, with both bound kinds.
+			graph_from(&[("a", "b"), ("b", "c"), ("c", "d"), ("d", "a"), ("a", "c"), ("d", "x"), ("x", "y")]),
+			// A 3x3 grid.
+			graph_from(&[
+				("0", "1"), ("1", "2"), ("3", "4"), ("4", "5"), ("6", "7"), ("7", "8"),
+				("0", "3"), ("3", "6"), ("1", "4"), ("4", "7"), ("2", "5"), ("5", "8"),
+			]),
+		]
+	}
+
+	fn node_ids(graph: &GraphWrap) -> Vec<String> {
+		let mut ids: Vec<String> = graph.graph.node_weights().map(|node| node.id.clone()).collect();
+		ids.sort();
+		ids
+	}
+
+	/// `elect_candidates` without any early exit: every DAG, every key.
+	fn elect_exhaustively(
+		graph: &GraphWrap,
+		candidates: &[String],
+		ids_ignore: &NodeSet,
+		mode: InboundMode,
+	) -> Vec<(String, String)> {
+		let keyed: Vec<(String, ElectionKey, GraphWrap)> = candidates
+			.iter()
+			.map(|id| {
+				let dag = to_dag_with_mode(graph, id, &NodeSet::new(), mode, None).unwrap();
+				(id.clone(), election_key(&dag, id, ids_ignore).unwrap(), dag)
+			})
+			.collect();
+		let best = keyed.iter().map(|(_, key, _)| key).max_by(|a, b| cmp_keys(a, b)).unwrap();
+		keyed
+			.iter()
+			.filter(|(_, key, _)| cmp_keys(key, best) == Ordering::Equal)
+			.map(|(id, _, dag)| (id.clone(), to_tree(dag, id, &NodeSet::new()).unwrap().render()))
+			.collect()
+	}
+
+	/// Pseudo-random forest: `size` nodes with two labels and two edge
+	/// modalities, each node but the first of a component hanging from an
+	/// earlier one.
+	fn random_forest(seed: u64, size: usize, components: usize) -> GraphWrap {
+		let mut state = seed;
+		let mut next = move |bound: usize| {
+			state = state.wrapping_mul(6364136223846793005).wrapping_add(1442695040888963407);
+			((state >> 33) as usize) % bound
+		};
+		let mut graph = GraphWrap::new();
+		for i in 0..size {
+			graph.ensure_node(&i.to_string(), if next(3) == 0 { "O" } else { "C" });
+		}
+		for i in 0..size {
+			if i % (size / components) != 0 {
+				let parent = i - 1 - next(i % (size / components));
+				let modality = if next(4) == 0 { "2" } else { "1" };
+				graph.add_edge_with_modality(&parent.to_string(), &i.to_string(), modality);
+			}
+		}
+		graph
+	}
+
+	/// Trace tree of the elected candidates, as `to_cgraph` would build it.
+	fn elected_trace(elected: &Elected<'_>) -> Option<(String, String)> {
+		best_tree(elected).unwrap().map(|(tree, id, _)| (id.to_string(), tree.render()))
+	}
+
+	#[test]
+	fn forest_shortcut_matches_the_general_election() {
+		let mut forests = vec![lollipop_tail(), graph_from(&[("a", "b"), ("c", "d"), ("c", "e"), ("f", "f2")])];
+		for seed in 0..40 {
+			forests.push(random_forest(seed, 12 + seed as usize % 20, 1 + seed as usize % 3));
+		}
+		for graph in &forests {
+			assert!(is_forest(graph));
+			for rule in ["$degree", "$label"] {
+				let candidates = select_candidates(graph, &score_candidates(graph, rule).unwrap());
+				let unmastered = prune_graph(graph, &candidates);
+				let ids_ignore = if candidates.iter().all(|id| is_leaf(graph, id)) {
+					NodeSet::new()
+				} else {
+					unmastered
+				};
+				let shortcut = elect_forest_candidates(graph, &candidates, &ids_ignore).unwrap();
+				for mode in [InboundMode::Duplicate, InboundMode::Elect] {
+					let general: Elected<'_> = elect_candidates(graph, &candidates, &ids_ignore, mode, None)
+						.unwrap()
+						.into_iter()
+						.map(|(id, dag)| (id, Cow::Owned(dag)))
+						.collect();
+					let ids = |elected: &Elected<'_>| elected.iter().map(|(id, _)| id.clone()).collect::<Vec<_>>();
+					assert_eq!(ids(&shortcut), ids(&general));
+					assert_eq!(elected_trace(&shortcut), elected_trace(&general));
+				}
+			}
+		}
+	}
+
+	#[test]
+	fn parallel_edges_and_self_loops_take_the_general_path() {
+		let mut parallel = lollipop_tail();
+		parallel.add_edge("b", "c");
+		let mut looped = lollipop_tail();
+		looped.add_edge("d", "d");
+		let trace = |graph: GraphWrap| {
+			let graph = Graph::from_wrap(graph);
+			to_cgraph(&graph, "$degree", "$depth > tree.parent_modality > $lexic", true, true, false)
+				.unwrap()
+				.to_string()
+		};
+		let path = trace(lollipop_tail());
+		for graph in [parallel, looped] {
+			assert!(!is_forest(&graph));
+			assert_ne!(trace(graph), path);
+		}
+	}
+
+	#[test]
+	fn elect_depth_is_known_before_the_rewrite() {
+		let empty_ignore = NodeSet::new();
+		for graph in graphs() {
+			for id in node_ids(&graph) {
+				let dag = to_dag_with_mode(&graph, &id, &empty_ignore, InboundMode::Elect, None).unwrap();
+				let depth = election_key(&dag, &id, &empty_ignore).unwrap().0;
+				let at_depth = to_dag_above_depth(&graph, &id, &empty_ignore, InboundMode::Elect, None, depth).unwrap();
+				assert_eq!(at_depth.map(|dag| to_tree(&dag, &id, &empty_ignore).unwrap().render()),
+					Some(to_tree(&dag, &id, &empty_ignore).unwrap().render()));
+				let below = to_dag_above_depth(&graph, &id, &empty_ignore, InboundMode::Elect, None, depth + 1).unwrap();
+				assert!(below.is_none(), "{} should be dropped", id);
+			}
+		}
+	}
+
+	#[test]
+	fn shallow_candidates_are_dropped_before_their_rewrite() {
+		// `a` is 7 deep: the tail, the triangle and the virtual nodes of its
+		// cobound `f-g`. `c` only reaches 5.
+		let graph = lollipop();
+		let empty_ignore = NodeSet::new();
+		let dag = to_dag_above_depth(&graph, "a", &empty_ignore, InboundMode::Elect, None, 0).unwrap().unwrap();
+		assert_eq!(election_key(&dag, "a", &empty_ignore).unwrap().0, 7);
+		assert!(to_dag_above_depth(&graph, "c", &empty_ignore, InboundMode::Elect, None, 7).unwrap().is_none());
+		// Duplicate DAGs are never bounded.
+		assert!(to_dag_above_depth(&graph, "c", &empty_ignore, InboundMode::Duplicate, None, 7).unwrap().is_some());
+	}
+
+	#[test]
+	fn early_exit_keeps_the_election() {
+		for graph in graphs() {
+			let ids = node_ids(&graph);
+			// Each node in turn is left out of the candidates and ignored.
+			let ignores = std::iter::once(None).chain(ids.iter().map(Some));
+			for ignored in ignores {
+				let candidates: Vec<String> = ids.iter().filter(|id| Some(*id) != ignored).cloned().collect();
+				let mut ids_ignore = NodeSet::new();
+				if let Some(id) = ignored {
+					ids_ignore.insert(graph.node_key(id).unwrap());
+				}
+				for mode in [InboundMode::Duplicate, InboundMode::Elect] {
+					let elected: Vec<(String, String)> = elect_candidates(&graph, &candidates, &ids_ignore, mode, None)
+						.unwrap()
+						.into_iter()
+						.map(|(id, dag)| {
+							let tree = to_tree(&dag, &id, &NodeSet::new()).unwrap().render();
+							(id, tree)
+						})
+						.collect();
+					assert_eq!(elected, elect_exhaustively(&graph, &candidates, &ids_ignore, mode));
+				}
+			}
+		}
+	}
+
+	/// The two-pass magnet compression `Compressor` replaced, over a whole
+	/// trace.
+	fn compress_cgraph(cgraph: &str) -> String {
+		let mut output = String::new();
+		let mut magnets: HashMap<String, String> = HashMap::new();
+		let mut magnet = String::new();
+		let mut in_magnet = false;
+		let mut cpt = 0usize;
+		let mut depth = 0usize;
+
+		for ch in cgraph.chars() {
+			if !in_magnet {
+				output.push(ch);
+				if ch == '{' {
+					in_magnet = true;
+				}
+				continue;
+			}
+
+			if ch == '{' {
+				depth += 1;
+				magnet.push(ch);
+			} else if ch == '}' {
+				if depth == 0 {
+					in_magnet = false;
+					let entry = magnets.entry(magnet.clone()).or_insert_with(|| {
+						cpt += 1;
+						format!("${}", cpt)
+					});
+					output.push_str(entry);
+					output.push('}');
+					magnet.clear();
+				} else {
+					depth -= 1;
+					magnet.push(ch);
+				}
+			} else {
+				magnet.push(ch);
+			}
+		}
+
+		output
+	}
+
+	/// Records of `data/golden_traces.json`, and the directory they live in.
+	fn golden_traces() -> (std::path::PathBuf, Vec<serde_json::Value>) {
+		let data = std::path::Path::new(env!("CARGO_MANIFEST_DIR")).join("data");
+		let golden = std::fs::read_to_string(data.join("golden_traces.json")).unwrap();
+		let golden: serde_json::Value = serde_json::from_str(&golden).unwrap();
+		(data, golden.as_array().unwrap().clone())
+	}
+
+	fn compressed(pieces: &[&[u8]]) -> Vec<u8> {
+		let mut output = Vec::new();
+		let mut compressor = Compressor::new(|bytes: &[u8]| output.extend_from_slice(bytes));
+		for piece in pieces {
+			compressor.feed(piece);
+		}
+		output
+	}
+
+	#[test]
+	fn compressor_matches_the_two_pass_compression() {
+		let (_, records) = golden_traces();
+		let mut traces: Vec<String> = [
+			"",
+			"no magnet",
+			"{}",
+			"{}{}",
+			"(a*{}:1, b*{x}:1, c*{}:1)r",
+			"(a*{x}:1, b*{y}:1, c*{x}:1, d#2{y}:1)r",
+			"(a*{_{x}_-1-_{y}_}:1, b*{_{x}_-1-_{y}_}:1, c*{{}}:1, d*{{{}{}}}:1)r",
+			"(é*{ça{é}}:1, ü*{ça{é}}:2)ø",
+			"{{}}tail{}",
+		]
+		.iter()
+		.map(|trace| trace.to_string())
+		.collect();
+		traces.extend(
+			records
+				.iter()
+				.filter(|record| !record["compress"].as_bool().unwrap())
+				.map(|record| record["trace"].as_str().unwrap().to_string()),
+		);
+
+		let mut next = {
+			let mut state = 7u64;
+			move |bound: usize| {
+				state = state.wrapping_mul(6364136223846793005).wrapping_add(1442695040888963407);
+				((state >> 33) as usize) % bound
+			}
+		};
+		for trace in &traces {
+			let bytes = trace.as_bytes();
+			let expected = compress_cgraph(trace).into_bytes();
+			assert_eq!(compressed(&[bytes]), expected, "{}", trace);
+			let byte_by_byte: Vec<&[u8]> = bytes.chunks(1).collect();
+			assert_eq!(compressed(&byte_by_byte), expected, "{}", trace);
+			if bytes.len() <= 256 {
+				for cut in 0..=bytes.len() {
+					assert_eq!(compressed(&[&bytes[..cut], &bytes[cut..]]), expected, "{} cut at {}", trace, cut);
+				}
+			}
+			for _ in 0..8 {
+				let mut pieces = Vec::new();
+				let mut rest = bytes;
+				while !rest.is_empty() {
+					let (piece, tail) = rest.split_at(next(rest.len().min(64)) + 1);
+					pieces.push(piece);
+					rest = tail;
+				}
+				assert_eq!(compressed(&pieces), expected, "{}", trace);
+			}
+		}
+
+		// The compressed golden traces are the uncompressed ones, compressed.
+		for record in records.iter().filter(|record| record["compress"].as_bool().unwrap()) {
+			let plain = records
+				.iter()
+				.find(|other| {
+					other["graph"] == record["graph"] && other["compact"] == record["compact"] && !other["compress"].as_bool().unwrap()
+				})
+				.unwrap();
+			assert_eq!(compress_cgraph(plain["trace"].as_str().unwrap()), record["trace"].as_str().unwrap());
+		}
+	}
+
+	#[test]
+	fn traces_match_the_golden_traces() {
+		let (data, records) = golden_traces();
+		for record in &records {
+			let path = data.join(record["graph"].as_str().unwrap());
+			let graph = crate::parse::from_dot(path.to_str().unwrap()).unwrap();
+			let (compress, compact) = (record["compress"].as_bool().unwrap(), record["compact"].as_bool().unwrap());
+			let trace = to_cgraph(&graph, "$degree", "$depth > tree.parent_modality > $lexic", true, compress, compact)
+				.unwrap()
+				.to_string();
+			assert_eq!(trace, record["trace"].as_str().unwrap(), "{} compress={} compact={}", path.display(), compress, compact);
+		}
+	}
+}
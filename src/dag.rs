@@ -1,14 +1,19 @@
 use std::cmp::Ordering;
-use std::collections::{HashMap, HashSet, VecDeque};
+use std::collections::{HashMap, VecDeque};
+use std::sync::{Arc, OnceLock};
 
 use petgraph::graph::{EdgeIndex, NodeIndex};
-use petgraph::visit::EdgeRef;
+use petgraph::visit::{EdgeRef, NodeIndexable};
 
+use crate::digest::DigestAlgorithm;
 use crate::error::{ScottError, ScottResult};
-use crate::graph::{EdgeData, GraphWrap, NodeMeta};
-use crate::tree::{to_tree_string, to_tree_string_for_magnet};
+use crate::graph::{EdgeData, GraphWrap, Magnet, MagnetKey, NodeMeta, NodeSet};
+use crate::tree::{cmp_trees, to_tree, MagnetTrees, Tree, TreeNode};
 use serde_json::Value;
 
+#[cfg(feature = "parallel")]
+use rayon::prelude::*;
+
 #[derive(Debug, Clone, Copy, PartialEq, Eq)]
 pub enum InboundMode {
 	Duplicate,
@@ -30,10 +35,8 @@ pub struct Inbound {
 
 #[derive(Debug, Clone)]
 struct CoboundScore {
-	magnet_lo: String,
-	magnet_hi: String,
-	magnet_lo_bytes: Option<[u8; 16]>,
-	magnet_hi_bytes: Option<[u8; 16]>,
+	magnet_lo: MagnetKey,
+	magnet_hi: MagnetKey,
 	modality: String,
 	edge_a: String,
 	edge_b: String,
@@ -48,8 +51,9 @@ struct CoboundEntry {
 #[derive(Debug, Clone)]
 struct InboundScore {
 	arity: usize,
-	main_magnet: String,
-	main_magnet_bytes: Option<[u8; 16]>,
+	main_magnet: MagnetKey,
+	/// Digests of the magnets of the inbound's parents, sorted. Only filled
+	/// in for inbounds tied on `(arity, main_magnet)` with the best one.
 	root_magnets: Vec<[u8; 16]>,
 	node_id: String,
 	edge_keys: Vec<(String, String)>,
@@ -70,26 +74,8 @@ impl CoboundScore {
 	}
 }
 
-fn cmp_magnet_keys(
-	a_str: &str,
-	a_bytes: Option<[u8; 16]>,
-	b_str: &str,
-	b_bytes: Option<[u8; 16]>,
-) -> Ordering {
-	match (a_bytes, b_bytes) {
-		(Some(a_bytes), Some(b_bytes)) => a_bytes.cmp(&b_bytes),
-		_ => a_str.cmp(b_str),
-	}
-}
-
 fn cmp_cobound_entry(a: &CoboundEntry, b: &CoboundEntry) -> Ordering {
-	let score_cmp = cmp_magnet_keys(
-		&a.score.magnet_lo,
-		a.score.magnet_lo_bytes,
-		&b.score.magnet_lo,
-		b.score.magnet_lo_bytes,
-	)
-	.reverse();
+	let score_cmp = b.score.magnet_lo.cmp(&a.score.magnet_lo);
 	if score_cmp != Ordering::Equal {
 		return score_cmp;
 	}
@@ -97,13 +83,7 @@ fn cmp_cobound_entry(a: &CoboundEntry, b: &CoboundEntry) -> Ordering {
 	if modality_cmp != Ordering::Equal {
 		return modality_cmp;
 	}
-	let magnet_cmp = cmp_magnet_keys(
-		&a.score.magnet_hi,
-		a.score.magnet_hi_bytes,
-		&b.score.magnet_hi,
-		b.score.magnet_hi_bytes,
-	)
-	.reverse();
+	let magnet_cmp = b.score.magnet_hi.cmp(&a.score.magnet_hi);
 	if magnet_cmp != Ordering::Equal {
 		return magnet_cmp;
 	}
@@ -114,34 +94,17 @@ fn cmp_cobound_entry(a: &CoboundEntry, b: &CoboundEntry) -> Ordering {
 	a.score.edge_b.cmp(&b.score.edge_b)
 }
 
-fn insert_top_cobound(top: &mut Vec<CoboundEntry>, entry: CoboundEntry, limit: usize) {
-	let mut idx = 0usize;
-	while idx < top.len() {
-		if cmp_cobound_entry(&entry, &top[idx]) == Ordering::Less {
-			break;
-		}
-		idx += 1;
-	}
-	top.insert(idx, entry);
-	if top.len() > limit {
-		top.pop();
-	}
+/// Inbound order up to the root magnets: highest arity, then highest magnet.
+fn cmp_inbound_prefix(a: &InboundScore, b: &InboundScore) -> Ordering {
+	b.arity
+		.cmp(&a.arity)
+		.then_with(|| b.main_magnet.cmp(&a.main_magnet))
 }
 
 fn cmp_inbound_entry(a: &InboundEntry, b: &InboundEntry) -> Ordering {
-	let arity_cmp = b.score.arity.cmp(&a.score.arity);
-	if arity_cmp != Ordering::Equal {
-		return arity_cmp;
-	}
-	let magnet_cmp = cmp_magnet_keys(
-		&a.score.main_magnet,
-		a.score.main_magnet_bytes,
-		&b.score.main_magnet,
-		b.score.main_magnet_bytes,
-	)
-	.reverse();
-	if magnet_cmp != Ordering::Equal {
-		return magnet_cmp;
+	let prefix_cmp = cmp_inbound_prefix(&a.score, &b.score);
+	if prefix_cmp != Ordering::Equal {
+		return prefix_cmp;
 	}
 	let roots_cmp = b.score.root_magnets.cmp(&a.score.root_magnets);
 	if roots_cmp != Ordering::Equal {
@@ -171,25 +134,79 @@ fn insert_top_inbound(top: &mut Vec<InboundEntry>, entry: InboundEntry, limit: u
 pub fn to_dag(
 	graph: &GraphWrap,
 	root_id: &str,
-	ids_ignore: &HashSet<String>,
+	ids_ignore: &NodeSet,
 ) -> ScottResult<GraphWrap> {
-	to_dag_with_mode(graph, root_id, ids_ignore, InboundMode::Duplicate, true)
+	to_dag_with_mode(graph, root_id, ids_ignore, InboundMode::Duplicate, Some(DigestAlgorithm::Md5))
 }
 
 pub fn to_dag_with_mode(
 	graph: &GraphWrap,
 	root_id: &str,
-	ids_ignore: &HashSet<String>,
+	ids_ignore: &NodeSet,
 	mode: InboundMode,
-	allow_hashes: bool,
+	magnet_hash: Option<DigestAlgorithm>,
 ) -> ScottResult<GraphWrap> {
+	let (mut dag, floors) = floored_graph(graph, root_id, ids_ignore)?;
+	rewrite_bounds(&mut dag, &floors, mode, magnet_hash)?;
+	Ok(dag)
+}
+
+/// `to_dag_with_mode`, or `None` as soon as the floors show that the tree of
+/// the DAG will be less than `min_depth` deep, before any bound is fixed.
+///
+/// Only `InboundMode::Elect` is bounded this way, see `elect_depth`: a
+/// duplicated inbound hangs a whole sub-DAG below each of its mirrors, whose
+/// depth is only known once it is built.
+pub fn to_dag_above_depth(
+	graph: &GraphWrap,
+	root_id: &str,
+	ids_ignore: &NodeSet,
+	mode: InboundMode,
+	magnet_hash: Option<DigestAlgorithm>,
+	min_depth: i32,
+) -> ScottResult<Option<GraphWrap>> {
+	let (mut dag, floors) = floored_graph(graph, root_id, ids_ignore)?;
+	if mode == InboundMode::Elect && elect_depth(&dag, &floors) < min_depth {
+		return Ok(None);
+	}
+	rewrite_bounds(&mut dag, &floors, mode, magnet_hash)?;
+	Ok(Some(dag))
+}
+
+/// Copy of `graph` cut down to the nodes reachable from `root_id`, each on
+/// its floor.
+fn floored_graph(
+	graph: &GraphWrap,
+	root_id: &str,
+	ids_ignore: &NodeSet,
+) -> ScottResult<(GraphWrap, HashMap<i32, Vec<NodeIndex>>)> {
 	let mut dag = graph.clone();
 	let floors = dag
 		.compute_floors(root_id, ids_ignore)
 		.map_err(ScottError::Parse)?;
 	remove_unfloored_nodes(&mut dag);
-	rewrite_bounds(&mut dag, &floors, mode, allow_hashes)?;
-	Ok(dag)
+	Ok((dag, floors))
+}
+
+/// Depth of the tree of the DAG an `InboundMode::Elect` rewrite yields,
+/// from the floors alone.
+///
+/// Elect fixes keep every node on its floor: the mirrors of an inbound take
+/// its floor, and the main one adopts its children as they are. Only the
+/// virtual nodes of a cobound hang one floor below it. The DAG is then a
+/// tree with one level per floor, and ignoring nodes in it can only cut
+/// branches off.
+fn elect_depth(graph: &GraphWrap, floors: &HashMap<i32, Vec<NodeIndex>>) -> i32 {
+	let Some(&deepest) = floors.keys().max() else {
+		return 0;
+	};
+	let has_cobound = floors[&deepest].iter().any(|node_index| {
+		graph
+			.graph
+			.neighbors(*node_index)
+			.any(|other| graph.graph[other].meta.floor == Some(deepest))
+	});
+	deepest + 1 + has_cobound as i32
 }
 
 fn remove_unfloored_nodes(graph: &mut GraphWrap) {
@@ -208,27 +225,24 @@ fn rewrite_bounds(
 	graph: &mut GraphWrap,
 	floors: &HashMap<i32, Vec<NodeIndex>>,
 	mode: InboundMode,
-	allow_hashes: bool,
+	magnet_hash: Option<DigestAlgorithm>,
 ) -> ScottResult<()> {
 	let mut virtual_counter = 0usize;
 	let mut mirror_counter = 0usize;
+	let mut magnets = Magnets {
+		hash: magnet_hash,
+		trees: MagnetTrees::default(),
+	};
 
-	let mut work_guard = 0usize;
+	// Fixing a bound never creates another one: a cobound fix only drops its
+	// edge, an inbound fix only detaches the inbound node from its parents,
+	// and the virtual and mirror nodes added on the way hang below a single
+	// parent each. So the buckets are collected once and each fix just
+	// removes its own entry.
+	let mut buckets = collect_candidates(graph);
 	loop {
-		if work_guard > 10_000 {
-			return Err(ScottError::Unsupported(
-				"dag rewrite loop exceeded guard limit".to_string(),
-			));
-		}
-		work_guard += 1;
-
-		let buckets = collect_candidates(graph);
-		let cobound_floor = buckets.max_cobound_floor;
-		let inbound_floor = buckets.max_inbound_floor;
-		if cobound_floor.is_none() && inbound_floor.is_none() {
-			break;
-		}
-
+		let cobound_floor = top_floor(&buckets.cobounds);
+		let inbound_floor = top_floor(&buckets.inbounds);
 		let floor = match (cobound_floor, inbound_floor) {
 			(Some(cobound), Some(inbound)) => std::cmp::max(cobound, inbound),
 			(Some(cobound), None) => cobound,
@@ -236,23 +250,29 @@ fn rewrite_bounds(
 			(None, None) => break,
 		};
 
+		// Magnets are frozen once computed and a fix only rewires its own
+		// bound, so the scores of a floor's bounds hold until the floor is
+		// done: they are ranked once and fixed in that order.
 		if cobound_floor == Some(floor) {
-			let bucket = floor_bucket(&buckets.cobounds, floor);
-			if let Some(cobound) = select_cobound(graph, bucket, floor, allow_hashes)? {
-			fix_cobound(graph, cobound, &mut virtual_counter, allow_hashes)?;
-			emit_counts(graph);
+			let bucket = std::mem::take(&mut buckets.cobounds[floor as usize]);
+			let ranked = rank_cobounds(graph, &bucket, &mut magnets)?;
+			for idx in 0..ranked.len() {
+				announce_cobound(graph, &ranked[idx..], floor);
+				fix_cobound(graph, ranked[idx].cobound, &mut virtual_counter, &mut magnets)?;
+				emit_counts(graph);
+			}
 			continue;
 		}
-		}
 
 		if inbound_floor == Some(floor) {
-			let bucket = floor_bucket(&buckets.inbounds, floor);
-			if let Some(inbound) = select_inbound(graph, bucket, floor, allow_hashes)? {
-			fix_inbound(graph, inbound, &mut mirror_counter, mode, allow_hashes)?;
-			emit_counts(graph);
+			let bucket = std::mem::take(&mut buckets.inbounds[floor as usize]);
+			let mut pending = rank_inbounds(graph, bucket, &mut magnets)?;
+			while let Some(inbound) = select_inbound(graph, &mut pending, floor, &mut magnets)? {
+				fix_inbound(graph, inbound, &mut mirror_counter, mode, &mut magnets)?;
+				emit_counts(graph);
+			}
 			continue;
 		}
-		}
 		break;
 	}
 
@@ -267,18 +287,22 @@ fn rewrite_bounds(
 	Ok(())
 }
 
-fn select_cobound(
+/// Cobounds of one floor, best first.
+fn rank_cobounds(
 	graph: &mut GraphWrap,
 	cobounds: &[Cobound],
-	floor: i32,
-	allow_hashes: bool,
-) -> ScottResult<Option<Cobound>> {
-	if cobounds.is_empty() {
-		return Ok(None);
+	magnets: &mut Magnets,
+) -> ScottResult<Vec<CoboundEntry>> {
+	let mut endpoints = Vec::with_capacity(2 * cobounds.len());
+	for cobound in cobounds {
+		if let Some((a, b)) = graph.graph.edge_endpoints(cobound.edge) {
+			endpoints.push(a);
+			endpoints.push(b);
+		}
 	}
-	let trace = trace_enabled();
-	let mut best: Option<CoboundEntry> = None;
-	let mut top: Vec<CoboundEntry> = Vec::new();
+	prepare_magnets(graph, &endpoints, magnets)?;
+
+	let mut ranked = Vec::with_capacity(cobounds.len());
 	for &cobound in cobounds {
 		let (a, b) = graph
 			.graph
@@ -291,124 +315,116 @@ fn select_cobound(
 			.modality
 			.clone();
 		let (a_id, b_id) = edge_key(graph, a, b);
-		let (magnet_a, magnet_a_bytes) = get_magnet_with_key(graph, a, allow_hashes)?;
-		let (magnet_b, magnet_b_bytes) = get_magnet_with_key(graph, b, allow_hashes)?;
-
-		let (magnet_lo, magnet_hi, magnet_lo_bytes, magnet_hi_bytes) =
-			if cmp_magnet_keys(&magnet_a, magnet_a_bytes, &magnet_b, magnet_b_bytes)
-				!= Ordering::Greater
-			{
-				(magnet_a, magnet_b, magnet_a_bytes, magnet_b_bytes)
-			} else {
-				(magnet_b, magnet_a, magnet_b_bytes, magnet_a_bytes)
-			};
+		let magnet_a = get_magnet(graph, a, magnets)?;
+		let magnet_b = get_magnet(graph, b, magnets)?;
+		let (magnet_lo, magnet_hi) = if magnet_a <= magnet_b {
+			(magnet_a, magnet_b)
+		} else {
+			(magnet_b, magnet_a)
+		};
 		let score = CoboundScore {
 			magnet_lo,
 			magnet_hi,
-			magnet_lo_bytes,
-			magnet_hi_bytes,
 			modality,
 			edge_a: a_id,
 			edge_b: b_id,
 		};
-		let entry = CoboundEntry { score, cobound };
-		match best {
-			Some(ref current) => {
-				if cmp_cobound_entry(&entry, current) == Ordering::Less {
-					best = Some(entry.clone());
-				}
-			}
-			None => best = Some(entry.clone()),
-		}
-		if trace {
-			insert_top_cobound(&mut top, entry, 5);
-		}
+		ranked.push(CoboundEntry { score, cobound });
 	}
+	// Stable, so ties keep the first cobound found, as a linear scan would.
+	ranked.sort_by(cmp_cobound_entry);
+	Ok(ranked)
+}
 
-	if trace {
-		emit(
-			"dag_cobound_scores",
-			vec![
-				("floor", Value::Number(floor.into())),
-				("scores", Value::Array(top_cobound_scores(&top, graph))),
-			],
-		);
+/// Trace the choice of `pending[0]` among the cobounds left on `floor`.
+fn announce_cobound(graph: &GraphWrap, pending: &[CoboundEntry], floor: i32) {
+	if !trace_enabled() {
+		return;
 	}
+	let top = &pending[..pending.len().min(5)];
+	emit(
+		"dag_cobound_scores",
+		vec![
+			("floor", Value::Number(floor.into())),
+			("scores", Value::Array(top_cobound_scores(top, graph))),
+		],
+	);
+	let entry = &pending[0];
+	emit(
+		"dag_choice",
+		vec![
+			("floor", Value::Number(floor.into())),
+			("type", Value::String("cobound".to_string())),
+			("score", Value::String(entry.score.as_string())),
+			("choice", edge_repr(graph, entry.cobound.edge)),
+		],
+	);
+}
 
-	if let Some(entry) = best {
-		if trace {
-			emit(
-				"dag_choice",
-				vec![
-					("floor", Value::Number(floor.into())),
-					("type", Value::String("cobound".to_string())),
-					("score", Value::String(entry.score.as_string())),
-					("choice", edge_repr(graph, entry.cobound.edge)),
-				],
-			);
-		}
-		Ok(Some(entry.cobound))
-	} else {
-		Ok(None)
+/// Inbounds of one floor, scored up to their root magnets and sorted on
+/// that prefix.
+fn rank_inbounds(
+	graph: &mut GraphWrap,
+	inbounds: Vec<Inbound>,
+	magnets: &mut Magnets,
+) -> ScottResult<Vec<InboundEntry>> {
+	let nodes: Vec<NodeIndex> = inbounds.iter().map(|inbound| inbound.node).collect();
+	prepare_magnets(graph, &nodes, magnets)?;
+
+	let mut ranked = Vec::with_capacity(inbounds.len());
+	for mut inbound in inbounds {
+		// Fixes on deeper floors may have reordered the inbound node's edges.
+		inbound.edges = upstairs_edges(graph, inbound.node, inbound.floor);
+		let score = InboundScore {
+			arity: inbound.edges.len(),
+			main_magnet: get_magnet(graph, inbound.node, magnets)?,
+			root_magnets: Vec::new(),
+			node_id: graph.graph[inbound.node].id.clone(),
+			edge_keys: inbound_edge_keys(graph, &inbound),
+		};
+		ranked.push(InboundEntry { score, inbound });
 	}
+	ranked.sort_by(|a, b| cmp_inbound_prefix(&a.score, &b.score));
+	Ok(ranked)
 }
 
+/// Take the best of the inbounds `rank_inbounds` left pending on `floor`.
 fn select_inbound(
 	graph: &mut GraphWrap,
-	inbounds: &[Inbound],
+	pending: &mut Vec<InboundEntry>,
 	floor: i32,
-	allow_hashes: bool,
+	magnets: &mut Magnets,
 ) -> ScottResult<Option<Inbound>> {
-	if inbounds.is_empty() {
+	if pending.is_empty() {
 		return Ok(None);
 	}
 	let trace = trace_enabled();
-	let mut best: Option<InboundEntry> = None;
-	let mut top: Vec<InboundEntry> = Vec::new();
-	for inbound in inbounds {
-		let arity = inbound.edges.len();
-		let (main_magnet, main_magnet_bytes) =
-			get_magnet_with_key(graph, inbound.node, allow_hashes)?;
-		let mut root_magnets = Vec::with_capacity(arity);
-		for edge_index in &inbound.edges {
-			let (a, b) = graph
-				.graph
-				.edge_endpoints(*edge_index)
-				.ok_or_else(|| ScottError::Parse("inbound endpoints missing".to_string()))?;
-			let other = if a == inbound.node { b } else { a };
-			let digest = get_magnet_value_digest(graph, other, allow_hashes)?;
-			root_magnets.push(digest);
-		}
-		root_magnets.sort_unstable();
 
-		let node_id = graph.graph[inbound.node].id.clone();
-		let edge_keys = inbound_edge_keys(graph, inbound);
-		let score = InboundScore {
-			arity,
-			main_magnet,
-			main_magnet_bytes,
-			root_magnets,
-			node_id,
-			edge_keys,
-		};
-		let entry = InboundEntry {
-			score,
-			inbound: inbound.clone(),
-		};
-		match best {
-			Some(ref current) => {
-				if cmp_inbound_entry(&entry, current) == Ordering::Less {
-					best = Some(entry.clone());
-				}
-			}
-			None => best = Some(entry.clone()),
+	// Root magnets only break ties on `(arity, main_magnet)`, so only the
+	// inbounds tied with the best one pay for them, when they lead.
+	let tied = pending
+		.iter()
+		.position(|entry| cmp_inbound_prefix(&entry.score, &pending[0].score) != Ordering::Equal)
+		.unwrap_or(pending.len());
+	let scored = if trace { pending.len() } else { tied };
+	for entry in pending[..scored].iter_mut() {
+		if entry.score.root_magnets.is_empty() {
+			entry.score.root_magnets = root_magnets(graph, &entry.inbound, magnets)?;
 		}
-		if trace {
-			insert_top_inbound(&mut top, entry, 5);
+	}
+
+	let mut best = 0usize;
+	for idx in 1..tied {
+		if cmp_inbound_entry(&pending[idx], &pending[best]) == Ordering::Less {
+			best = idx;
 		}
 	}
 
 	if trace {
+		let mut top: Vec<InboundEntry> = Vec::new();
+		for entry in pending.iter() {
+			insert_top_inbound(&mut top, entry.clone(), 5);
+		}
 		emit(
 			"dag_inbound_scores",
 			vec![
@@ -416,39 +432,38 @@ fn select_inbound(
 				("scores", Value::Array(top_inbound_scores(&top))),
 			],
 		);
+		let entry = &pending[best];
+		emit(
+			"dag_choice",
+			vec![
+				("floor", Value::Number(floor.into())),
+				("type", Value::String("inbound".to_string())),
+				("score", inbound_score_value(&entry.score)),
+				("choice", inbound_repr_from_keys(entry.inbound.floor, &entry.score)),
+			],
+		);
 	}
 
-	if let Some(entry) = best {
-		if trace {
-			emit(
-				"dag_choice",
-				vec![
-					("floor", Value::Number(floor.into())),
-					("type", Value::String("inbound".to_string())),
-					("score", inbound_score_value(&entry.score)),
-					("choice", inbound_repr_from_keys(entry.inbound.floor, &entry.score)),
-				],
-			);
-		}
-		Ok(Some(entry.inbound))
-	} else {
-		Ok(None)
-	}
+	Ok(Some(pending.remove(best).inbound))
+}
+
+/// Magnet hash and memoised magnet trees of one DAG rewrite.
+struct Magnets {
+	hash: Option<DigestAlgorithm>,
+	trees: MagnetTrees,
 }
 
 struct CandidateBuckets {
 	cobounds: Vec<Vec<Cobound>>,
 	inbounds: Vec<Vec<Inbound>>,
-	max_cobound_floor: Option<i32>,
-	max_inbound_floor: Option<i32>,
 }
 
-fn floor_bucket<T>(buckets: &[Vec<T>], floor: i32) -> &[T] {
-	if floor < 0 {
-		return &[];
-	}
-	let idx = floor as usize;
-	buckets.get(idx).map(|bucket| bucket.as_slice()).unwrap_or(&[])
+/// Highest floor with a pending bound.
+fn top_floor<T>(buckets: &[Vec<T>]) -> Option<i32> {
+	buckets
+		.iter()
+		.rposition(|bucket| !bucket.is_empty())
+		.map(|idx| idx as i32)
 }
 
 fn ensure_bucket<T>(buckets: &mut Vec<Vec<T>>, floor: i32) -> Option<usize> {
@@ -465,8 +480,6 @@ fn ensure_bucket<T>(buckets: &mut Vec<Vec<T>>, floor: i32) -> Option<usize> {
 fn collect_candidates(graph: &GraphWrap) -> CandidateBuckets {
 	let mut cobounds: Vec<Vec<Cobound>> = Vec::new();
 	let mut inbounds: Vec<Vec<Inbound>> = Vec::new();
-	let mut max_cobound_floor: Option<i32> = None;
-	let mut max_inbound_floor: Option<i32> = None;
 
 	for edge_index in graph.graph.edge_indices() {
 		if let Some((a, b)) = graph.graph.edge_endpoints(edge_index) {
@@ -479,8 +492,6 @@ fn collect_candidates(graph: &GraphWrap) -> CandidateBuckets {
 							edge: edge_index,
 							floor: floor_a,
 						});
-						max_cobound_floor =
-							Some(max_cobound_floor.map_or(floor_a, |f| f.max(floor_a)));
 					}
 				}
 			}
@@ -492,16 +503,7 @@ fn collect_candidates(graph: &GraphWrap) -> CandidateBuckets {
 			Some(floor) => floor,
 			None => continue,
 		};
-		let mut upstairs = Vec::new();
-		for edge_index in graph.graph.edges(node_index).map(|edge| edge.id()) {
-			let (a, b) = graph.graph.edge_endpoints(edge_index).unwrap();
-			let other = if a == node_index { b } else { a };
-			if let Some(other_floor) = graph.graph[other].meta.floor {
-				if other_floor < floor {
-					upstairs.push(edge_index);
-				}
-			}
-		}
+		let upstairs = upstairs_edges(graph, node_index, floor);
 		if upstairs.len() > 1 {
 			if let Some(idx) = ensure_bucket(&mut inbounds, floor) {
 				inbounds[idx].push(Inbound {
@@ -509,25 +511,33 @@ fn collect_candidates(graph: &GraphWrap) -> CandidateBuckets {
 					node: node_index,
 					edges: upstairs,
 				});
-				max_inbound_floor =
-					Some(max_inbound_floor.map_or(floor, |f| f.max(floor)));
 			}
 		}
 	}
 
-	CandidateBuckets {
-		cobounds,
-		inbounds,
-		max_cobound_floor,
-		max_inbound_floor,
+	CandidateBuckets { cobounds, inbounds }
+}
+
+/// Edges linking `node_index` to nodes on a lower floor, in adjacency order.
+fn upstairs_edges(graph: &GraphWrap, node_index: NodeIndex, floor: i32) -> Vec<EdgeIndex> {
+	let mut upstairs = Vec::new();
+	for edge_index in graph.graph.edges(node_index).map(|edge| edge.id()) {
+		let (a, b) = graph.graph.edge_endpoints(edge_index).unwrap();
+		let other = if a == node_index { b } else { a };
+		if let Some(other_floor) = graph.graph[other].meta.floor {
+			if other_floor < floor {
+				upstairs.push(edge_index);
+			}
+		}
 	}
+	upstairs
 }
 
 fn fix_cobound(
 	graph: &mut GraphWrap,
 	cobound: Cobound,
 	virtual_counter: &mut usize,
-	allow_hashes: bool,
+	magnets: &mut Magnets,
 ) -> ScottResult<()> {
 	let (a, b) = graph
 		.graph
@@ -539,12 +549,13 @@ fn fix_cobound(
 		.ok_or_else(|| ScottError::Parse("cobound edge missing".to_string()))?
 		.clone();
 
-	let magnet_a = get_magnet(graph, a, allow_hashes)?;
-	let magnet_b = get_magnet(graph, b, allow_hashes)?;
-	let sep = format!("-{}-", edge.modality);
-	let mut magnets = [magnet_a, magnet_b];
-	magnets.sort();
-	let magnet = format!("{}{}{}", magnets[0], sep, magnets[1]);
+	let magnet_a = get_magnet(graph, a, magnets)?;
+	let magnet_b = get_magnet(graph, b, magnets)?;
+	let magnet = if magnet_a <= magnet_b {
+		Magnet::Cobound(magnet_a, edge.modality.clone(), magnet_b)
+	} else {
+		Magnet::Cobound(magnet_b, edge.modality.clone(), magnet_a)
+	};
 
 	graph.graph.remove_edge(cobound.edge);
 
@@ -555,7 +566,7 @@ fn fix_cobound(
 
 	let mut vmeta = NodeMeta::default();
 	vmeta.is_virtual = true;
-	vmeta.magnet = Some(magnet.clone());
+	vmeta.magnet = Some(magnet);
 	vmeta.floor = Some(cobound.floor + 1);
 	let va = graph.add_node_with_meta(&virtual_a_id, "", vmeta.clone());
 	let vb = graph.add_node_with_meta(&virtual_b_id, "", vmeta);
@@ -568,6 +579,8 @@ fn fix_cobound(
 	edge_b.id = format!("*{}_b", edge.id);
 	graph.add_edge_custom(b, vb, edge_b);
 
+	magnets.trees.invalidate(graph, a);
+	magnets.trees.invalidate(graph, b);
 	Ok(())
 }
 
@@ -576,11 +589,11 @@ fn fix_inbound(
 	inbound: Inbound,
 	mirror_counter: &mut usize,
 	mode: InboundMode,
-	allow_hashes: bool,
+	magnets: &mut Magnets,
 ) -> ScottResult<()> {
 	match mode {
-		InboundMode::Duplicate => fix_inbound_duplicate(graph, inbound, mirror_counter, allow_hashes),
-		InboundMode::Elect => fix_inbound_elect(graph, inbound, mirror_counter, allow_hashes),
+		InboundMode::Duplicate => fix_inbound_duplicate(graph, inbound, mirror_counter, magnets),
+		InboundMode::Elect => fix_inbound_elect(graph, inbound, mirror_counter, magnets),
 	}
 }
 
@@ -588,17 +601,24 @@ fn fix_inbound_duplicate(
 	graph: &mut GraphWrap,
 	inbound: Inbound,
 	mirror_counter: &mut usize,
-	allow_hashes: bool,
+	magnets: &mut Magnets,
 ) -> ScottResult<()> {
 	let arity = inbound.edges.len();
-	let magnet = get_magnet(graph, inbound.node, allow_hashes)?;
+	let magnet = get_magnet(graph, inbound.node, magnets)?;
 	let floor = inbound.floor;
 	let floor_sub = floor + 1;
 	let node_id = graph.graph[inbound.node].id.clone();
 
-	let roots_nodes = collect_roots_by_floor(graph, floor - 1);
-	let ids_ignore = nodes_not_in_subtree(graph, inbound.node, &roots_nodes);
-	let subdag = to_dag_with_mode(graph, &node_id, &ids_ignore, InboundMode::Duplicate, allow_hashes)?;
+	let stub_id = format!("#m{}", *mirror_counter);
+	let shared = match collect_subtree(graph, inbound.node, floor - 1) {
+		Some(subtree) => SharedDag::from_subtree(graph, &subtree, &stub_id, floor_sub)?,
+		None => {
+			let ids_ignore = nodes_not_in_subtree(graph, inbound.node, floor - 1);
+			let subdag = to_dag_with_mode(graph, &node_id, &ids_ignore, InboundMode::Duplicate, magnets.hash)?;
+			SharedDag::from_subdag(subdag, &stub_id, floor_sub)?
+		}
+	};
+	let shared = Arc::new(shared);
 
 	for (i, edge_index) in inbound.edges.iter().enumerate() {
 		let edge = graph
@@ -616,21 +636,16 @@ fn fix_inbound_duplicate(
 		let mut meta = NodeMeta::default();
 		meta.is_mirror = true;
 		meta.arity = Some(arity);
-		meta.magnet = Some(magnet.clone());
+		meta.magnet = Some(Magnet::Key(magnet.clone()));
 		meta.floor = Some(floor);
+		meta.shared = Some(shared.clone());
 		let mirror = graph.add_node_with_meta(&mirror_id, ".", meta);
 
 		graph.graph.remove_edge(*edge_index);
 		let mut edge_to_mirror = edge.clone();
 		edge_to_mirror.id = format!("#{}_{}", edge.id, i);
 		graph.add_edge_custom(other, mirror, edge_to_mirror);
-
-		let suffix = format!("@{}", mirror_id);
-		let root_copy = include_subgraph(graph, &subdag, &suffix, floor_sub)?;
-		let mut edge_to_root = EdgeData::default();
-		edge_to_root.id = format!("{}_link_{}", node_id, i);
-		edge_to_root.modality = "1".to_string();
-		graph.add_edge_custom(mirror, root_copy, edge_to_root);
+		magnets.trees.invalidate(graph, other);
 	}
 
 	*mirror_counter += 1;
@@ -641,10 +656,10 @@ fn fix_inbound_elect(
 	graph: &mut GraphWrap,
 	inbound: Inbound,
 	mirror_counter: &mut usize,
-	allow_hashes: bool,
+	magnets: &mut Magnets,
 ) -> ScottResult<()> {
 	let arity = inbound.edges.len();
-	let magnet = get_magnet(graph, inbound.node, allow_hashes)?;
+	let magnet = get_magnet(graph, inbound.node, magnets)?;
 	let floor = inbound.floor;
 	let node_id = graph.graph[inbound.node].id.clone();
 	let label = graph.graph[inbound.node].label.clone();
@@ -668,7 +683,7 @@ fn fix_inbound_elect(
 		let mut meta = NodeMeta::default();
 		meta.is_mirror = true;
 		meta.arity = Some(arity);
-		meta.magnet = Some(magnet.clone());
+		meta.magnet = Some(Magnet::Key(magnet.clone()));
 		meta.floor = Some(floor);
 
 		let mirror = graph.add_node_with_meta(&mirror_id, &label, meta);
@@ -678,12 +693,17 @@ fn fix_inbound_elect(
 		edge_to_mirror.id = format!("#{}_{}", edge.id, i);
 		graph.add_edge_custom(other, mirror, edge_to_mirror);
 
+		magnets.trees.invalidate(graph, other);
+
 		let other_id = graph.graph[other].id.clone();
-		let tree = to_tree_string(graph, &other_id, &roots_nodes).unwrap_or_default();
+		let tree = to_tree(graph, &other_id, &roots_nodes).ok();
 		candidates.push((tree, mirror));
 	}
 
-	candidates.sort_by(|a, b| a.0.cmp(&b.0));
+	candidates.sort_by(|(a, _), (b, _)| match (a, b) {
+		(Some(a), Some(b)) => cmp_trees(a, b),
+		(a, b) => a.is_some().cmp(&b.is_some()),
+	});
 	let main_mirror = candidates
 		.first()
 		.map(|(_, mirror)| *mirror)
@@ -717,162 +737,378 @@ fn fix_inbound_elect(
 		graph.add_edge_custom(other, main_mirror, edge_to_mirror);
 	}
 
+	magnets.trees.invalidate(graph, inbound.node);
 	graph.remove_node(&node_id);
 	*mirror_counter += 1;
 	Ok(())
 }
 
-fn collect_roots_by_floor(graph: &GraphWrap, max_floor: i32) -> HashSet<String> {
-	let mut roots = HashSet::new();
-	for node_index in graph.graph.node_indices() {
-		if let Some(floor) = graph.graph[node_index].meta.floor {
+fn collect_roots_by_floor(graph: &GraphWrap, max_floor: i32) -> NodeSet {
+	let mut roots = NodeSet::with_bound(graph.key_bound());
+	for node in graph.graph.node_weights() {
+		if let Some(floor) = node.meta.floor {
 			if floor <= max_floor {
-				roots.insert(graph.graph[node_index].id.clone());
+				roots.insert(node.key);
 			}
 		}
 	}
 	roots
 }
 
-fn nodes_not_in_subtree(
-	graph: &GraphWrap,
-	root: NodeIndex,
-	roots_nodes: &HashSet<String>,
-) -> HashSet<String> {
-	let mut keep: HashSet<NodeIndex> = HashSet::new();
+/// Whether `node_index` lies on a floor `<= max_floor`, above the region an
+/// inbound on the next floor hangs over.
+fn is_root_floor(graph: &GraphWrap, node_index: NodeIndex, max_floor: i32) -> bool {
+	graph.graph[node_index]
+		.meta
+		.floor
+		.is_some_and(|floor| floor <= max_floor)
+}
+
+fn nodes_not_in_subtree(graph: &GraphWrap, root: NodeIndex, max_floor: i32) -> NodeSet {
+	let mut keep = vec![false; graph.graph.node_bound()];
 	let mut queue: VecDeque<NodeIndex> = VecDeque::new();
 	queue.push_back(root);
-	keep.insert(root);
+	keep[root.index()] = true;
 
 	while let Some(current) = queue.pop_front() {
 		for neighbor in graph.graph.neighbors(current) {
-			let neighbor_id = graph.graph[neighbor].id.as_str();
-			if roots_nodes.contains(neighbor_id) {
+			if is_root_floor(graph, neighbor, max_floor) {
 				continue;
 			}
-			if keep.insert(neighbor) {
+			if !keep[neighbor.index()] {
+				keep[neighbor.index()] = true;
 				queue.push_back(neighbor);
 			}
 		}
 	}
 
-	let mut ignore = HashSet::new();
+	let mut ignore = NodeSet::with_bound(graph.key_bound());
 	for node_index in graph.graph.node_indices() {
-		if !keep.contains(&node_index) {
-			ignore.insert(graph.graph[node_index].id.clone());
+		if !keep[node_index.index()] {
+			ignore.insert(graph.graph[node_index].key);
 		}
 	}
 	ignore
 }
 
-fn include_subgraph(
-	target: &mut GraphWrap,
-	source: &GraphWrap,
-	suffix: &str,
-	floor_offset: i32,
-) -> ScottResult<NodeIndex> {
-	let mut mapping: HashMap<NodeIndex, NodeIndex> = HashMap::new();
-	let root_index = source
-		.graph
-		.node_indices()
-		.min_by_key(|index| source.graph[*index].meta.floor.unwrap_or(0))
-		.ok_or_else(|| ScottError::Parse("empty subgraph".to_string()))?;
-
-	for node_index in source.graph.node_indices() {
-		let node = &source.graph[node_index];
-		let mut meta = node.meta.clone();
-		meta.floor = meta.floor.map(|floor| floor + floor_offset);
-		let new_id = format!("{}{}", node.id, suffix);
-		let new_index = target.add_node_with_meta(&new_id, &node.label, meta);
-		mapping.insert(node_index, new_index);
+/// The part of a DAG hanging below one node, recorded in place.
+struct Subtree {
+	root: NodeIndex,
+	/// Nodes in index order, with their floor relative to `root`.
+	nodes: Vec<(NodeIndex, i32)>,
+	/// Edges between `nodes`, in index order.
+	edges: Vec<EdgeIndex>,
+}
+
+/// Region below `root` that `nodes_not_in_subtree` would keep, if it is a
+/// tree.
+///
+/// Once every deeper bound is fixed that region has no bound left, so
+/// building its subdag would only clone the whole DAG to keep this tree.
+/// The nodes and edges are listed in the order that subdag would hold them.
+/// Returns `None` when the region still has bounds to rewrite.
+fn collect_subtree(graph: &GraphWrap, root: NodeIndex, max_floor: i32) -> Option<Subtree> {
+	// Sized by the region rather than the whole DAG: inbounds near the top
+	// hang over most of it, but most inbounds hang over a few nodes.
+	let mut floors: HashMap<NodeIndex, i32> = HashMap::new();
+	let mut nodes = vec![(root, 0)];
+	let mut queue: VecDeque<NodeIndex> = VecDeque::new();
+	floors.insert(root, 0);
+	queue.push_back(root);
+
+	while let Some(current) = queue.pop_front() {
+		let next_floor = floors[&current] + 1;
+		for neighbor in graph.graph.neighbors(current) {
+			if is_root_floor(graph, neighbor, max_floor) || floors.contains_key(&neighbor) {
+				continue;
+			}
+			floors.insert(neighbor, next_floor);
+			nodes.push((neighbor, next_floor));
+			queue.push_back(neighbor);
+		}
 	}
 
-	for edge_index in source.graph.edge_indices() {
-		let edge = source.graph.edge_weight(edge_index).unwrap().clone();
-		let (a, b) = source.graph.edge_endpoints(edge_index).unwrap();
-		let na = *mapping.get(&a).unwrap();
-		let nb = *mapping.get(&b).unwrap();
-		target.add_edge_custom(na, nb, edge);
+	let mut edges = Vec::with_capacity(nodes.len());
+	for (node_index, _) in &nodes {
+		for edge in graph.graph.edges(*node_index) {
+			let other = if edge.source() == *node_index { edge.target() } else { edge.source() };
+			if floors.contains_key(&other) && *node_index <= other {
+				edges.push(edge.id());
+			}
+		}
+	}
+	if edges.len() + 1 != nodes.len() {
+		return None;
 	}
+	nodes.sort_unstable_by_key(|(node_index, _)| *node_index);
+	edges.sort_unstable();
+	Some(Subtree { root, nodes, edges })
+}
 
-	mapping
-		.get(&root_index)
-		.copied()
-		.ok_or_else(|| ScottError::Parse("missing root mapping".to_string()))
+/// Sub-DAG below an inbound node, shared by every mirror standing for one of
+/// its parents in `InboundMode::Duplicate`.
+///
+/// `graph` holds the sub-DAG the way a copy below one mirror would look, with
+/// `stub` in place of the mirror. Its trees are built once, on first use,
+/// and reused by every mirror and every copy of those mirrors.
+#[derive(Debug)]
+pub struct SharedDag {
+	pub graph: GraphWrap,
+	pub root: NodeIndex,
+	pub stub: NodeIndex,
+	counts: DagCounts,
+	pub(crate) tree: OnceLock<Tree>,
+	pub(crate) magnet_tree: OnceLock<Tree>,
+	pub(crate) order: OnceLock<Vec<String>>,
 }
 
-fn get_magnet(graph: &mut GraphWrap, node_index: NodeIndex, allow_hashes: bool) -> ScottResult<String> {
-	if let Some(node) = graph.graph.node_weight(node_index) {
-		if let Some(magnet) = node.meta.magnet_cache.as_ref() {
-			if node.meta.magnet_cache_hashed == allow_hashes {
-				return Ok(magnet.clone());
-			}
+impl SharedDag {
+	/// Share `subtree`, laid out as `to_dag_with_mode` would build its subdag.
+	fn from_subtree(
+		graph: &GraphWrap,
+		subtree: &Subtree,
+		stub_id: &str,
+		floor_offset: i32,
+	) -> ScottResult<Self> {
+		let mut shared = GraphWrap::new();
+		let mut mapping: HashMap<NodeIndex, NodeIndex> = HashMap::with_capacity(subtree.nodes.len());
+		for (node_index, floor) in &subtree.nodes {
+			let node = &graph.graph[*node_index];
+			let mut meta = node.meta.clone();
+			meta.floor = Some(floor + floor_offset);
+			meta.magnet_cache = None;
+			meta.magnet_cache_digest = None;
+			meta.magnet_cache_hash = None;
+			let new_index = shared.add_node_with_meta(&node.id, &node.label, meta);
+			mapping.insert(*node_index, new_index);
 		}
+
+		for edge_index in &subtree.edges {
+			let edge = graph
+				.graph
+				.edge_weight(*edge_index)
+				.ok_or_else(|| ScottError::Parse("subtree edge missing".to_string()))?
+				.clone();
+			let (a, b) = graph
+				.graph
+				.edge_endpoints(*edge_index)
+				.ok_or_else(|| ScottError::Parse("subtree endpoints missing".to_string()))?;
+			shared.add_edge_custom(mapping[&a], mapping[&b], edge);
+		}
+
+		let root = mapping
+			.get(&subtree.root)
+			.copied()
+			.ok_or_else(|| ScottError::Parse("missing root mapping".to_string()))?;
+		Ok(Self::link(shared, root, stub_id))
 	}
-	let floor = graph.graph[node_index]
-		.meta
-		.floor
-		.ok_or_else(|| ScottError::Parse("magnet requires floored graph".to_string()))?;
-	let mut ids_ignore = HashSet::new();
-	for other_index in graph.graph.node_indices() {
-		if let Some(other_floor) = graph.graph[other_index].meta.floor {
-			if other_floor <= floor {
-				ids_ignore.insert(graph.graph[other_index].id.clone());
-			}
+
+	/// Share a subdag built by `to_dag_with_mode`.
+	fn from_subdag(mut subdag: GraphWrap, stub_id: &str, floor_offset: i32) -> ScottResult<Self> {
+		let root = subdag
+			.graph
+			.node_indices()
+			.min_by_key(|index| subdag.graph[*index].meta.floor.unwrap_or(0))
+			.ok_or_else(|| ScottError::Parse("empty subgraph".to_string()))?;
+		for node in subdag.graph.node_weights_mut() {
+			node.meta.floor = node.meta.floor.map(|floor| floor + floor_offset);
+		}
+		Ok(Self::link(subdag, root, stub_id))
+	}
+
+	/// Hang `root` below a stub node, the way a copy hangs below its mirror.
+	fn link(mut graph: GraphWrap, root: NodeIndex, stub_id: &str) -> Self {
+		let stub = graph.add_node_with_meta(stub_id, ".", NodeMeta::default());
+		let mut edge = EdgeData::default();
+		edge.modality = "1".to_string();
+		graph.add_edge_custom(stub, root, edge);
+
+		let mut counts = dag_counts(&graph);
+		counts.nodes -= 1;
+		Self {
+			graph,
+			root,
+			stub,
+			counts,
+			tree: OnceLock::new(),
+			magnet_tree: OnceLock::new(),
+			order: OnceLock::new(),
 		}
 	}
-	let node_id = graph.graph[node_index].id.clone();
-	ids_ignore.remove(&node_id);
-	let tree = to_tree_string_for_magnet(graph, &node_id, &ids_ignore)
+}
+
+/// Size of a DAG with every shared sub-DAG counted once per mirror.
+#[derive(Debug, Clone, Copy, Default, PartialEq, Eq)]
+pub struct DagCounts {
+	pub nodes: usize,
+	pub edges: usize,
+	pub virtuals: usize,
+	pub mirrors: usize,
+}
+
+pub fn dag_counts(graph: &GraphWrap) -> DagCounts {
+	let mut counts = DagCounts {
+		nodes: graph.graph.node_count(),
+		edges: graph.graph.edge_count(),
+		..DagCounts::default()
+	};
+	for node in graph.graph.node_weights() {
+		if node.meta.is_virtual {
+			counts.virtuals += 1;
+		}
+		if node.meta.is_mirror {
+			counts.mirrors += 1;
+		}
+		if let Some(shared) = node.meta.shared.as_deref() {
+			counts.nodes += shared.counts.nodes;
+			counts.edges += shared.counts.edges;
+			counts.virtuals += shared.counts.virtuals;
+			counts.mirrors += shared.counts.mirrors;
+		}
+	}
+	counts
+}
+
+fn get_magnet(
+	graph: &mut GraphWrap,
+	node_index: NodeIndex,
+	magnets: &mut Magnets,
+) -> ScottResult<MagnetKey> {
+	if let Some(key) = cached_magnet(graph, node_index, magnets) {
+		return Ok(key);
+	}
+	let floor = magnet_floor(graph, node_index)?;
+	let tree = magnets
+		.trees
+		.tree(graph, node_index, floor)
 		.map_err(ScottError::Parse)?;
-	let magnet = format!("_{}_", tree);
-	let (value, magnet_bytes) = if allow_hashes {
-		let digest = md5::compute(magnet.as_bytes());
-		(format!("_{:x}_", digest), Some(digest.0))
-	} else {
-		(magnet, None)
+	let key = magnet_key(&tree, magnets.hash);
+	store_magnet(graph, node_index, &key, magnets.hash);
+	Ok(key)
+}
+
+/// Compute the magnets of `nodes` that are not cached yet, all at once.
+///
+/// The nodes of one floor hang over disjoint parts of the DAG, so with the
+/// `parallel` feature their trees are built, and their digests computed,
+/// in parallel once the work is large enough.
+fn prepare_magnets(graph: &mut GraphWrap, nodes: &[NodeIndex], magnets: &mut Magnets) -> ScottResult<()> {
+	let mut seen = NodeSet::with_bound(graph.key_bound());
+	let mut roots: Vec<(NodeIndex, i32)> = Vec::new();
+	for &node_index in nodes {
+		if seen.insert(graph.graph[node_index].key) && cached_magnet(graph, node_index, magnets).is_none() {
+			roots.push((node_index, magnet_floor(graph, node_index)?));
+		}
+	}
+	if roots.len() < 2 {
+		return Ok(());
+	}
+	let trees = magnets.trees.trees(graph, &roots).map_err(ScottError::Parse)?;
+	let hash = magnets.hash;
+	#[cfg(feature = "parallel")]
+	let keys: Vec<MagnetKey> = {
+		let work: usize = trees.iter().map(|tree| tree.len()).sum();
+		if work >= PARALLEL_MIN_BYTES {
+			trees.par_iter().map(|tree| magnet_key(tree, hash)).collect()
+		} else {
+			trees.iter().map(|tree| magnet_key(tree, hash)).collect()
+		}
 	};
+	#[cfg(not(feature = "parallel"))]
+	let keys: Vec<MagnetKey> = trees.iter().map(|tree| magnet_key(tree, hash)).collect();
+	for ((node_index, _), key) in roots.into_iter().zip(keys) {
+		store_magnet(graph, node_index, &key, hash);
+	}
+	Ok(())
+}
+
+/// Magnet text hashed by `prepare_magnets` from which it is worth spreading
+/// the digests over the rayon pool.
+#[cfg(feature = "parallel")]
+const PARALLEL_MIN_BYTES: usize = 1 << 16;
+
+fn cached_magnet(graph: &GraphWrap, node_index: NodeIndex, magnets: &Magnets) -> Option<MagnetKey> {
+	let node = graph.graph.node_weight(node_index)?;
+	let magnet = node.meta.magnet_cache.as_ref()?;
+	(node.meta.magnet_cache_hash == magnets.hash).then(|| magnet.clone())
+}
 
+fn magnet_floor(graph: &GraphWrap, node_index: NodeIndex) -> ScottResult<i32> {
+	graph.graph[node_index]
+		.meta
+		.floor
+		.ok_or_else(|| ScottError::Parse("magnet requires floored graph".to_string()))
+}
+
+fn magnet_key(tree: &TreeNode, hash: Option<DigestAlgorithm>) -> MagnetKey {
+	match hash {
+		Some(algorithm) => {
+			let mut hasher = algorithm.hasher();
+			hasher.update(b"_");
+			tree.write(&mut |bytes| hasher.update(bytes));
+			hasher.update(b"_");
+			MagnetKey::Digest(hasher.finish())
+		}
+		None => MagnetKey::Text(format!("_{}_", tree).into()),
+	}
+}
+
+fn store_magnet(
+	graph: &mut GraphWrap,
+	node_index: NodeIndex,
+	key: &MagnetKey,
+	hash: Option<DigestAlgorithm>,
+) {
 	if std::env::var("SCOTT_TRACE_MAGNET").ok().as_deref() == Some("1") {
 		emit(
 			"magnet",
 			vec![
-				("node", Value::String(node_id)),
-				("magnet", Value::String(value.clone())),
+				("node", Value::String(graph.graph[node_index].id.clone())),
+				("magnet", Value::String(key.to_string())),
 			],
 		);
 	}
 	if let Some(node) = graph.graph.node_weight_mut(node_index) {
-		node.meta.magnet_cache = Some(value.clone());
-		node.meta.magnet_cache_bytes = magnet_bytes;
+		node.meta.magnet_cache = Some(key.clone());
 		node.meta.magnet_cache_digest = None;
-		node.meta.magnet_cache_hashed = allow_hashes;
+		node.meta.magnet_cache_hash = hash;
 	}
-	Ok(value)
 }
 
-fn get_magnet_with_key(
+/// Sorted digests of the magnets of the nodes `inbound` hangs from.
+fn root_magnets(
 	graph: &mut GraphWrap,
-	node_index: NodeIndex,
-	allow_hashes: bool,
-) -> ScottResult<(String, Option<[u8; 16]>)> {
-	let value = get_magnet(graph, node_index, allow_hashes)?;
-	let key = graph.graph[node_index].meta.magnet_cache_bytes;
-	Ok((value, key))
+	inbound: &Inbound,
+	magnets: &mut Magnets,
+) -> ScottResult<Vec<[u8; 16]>> {
+	let mut digests = Vec::with_capacity(inbound.edges.len());
+	for edge_index in &inbound.edges {
+		let (a, b) = graph
+			.graph
+			.edge_endpoints(*edge_index)
+			.ok_or_else(|| ScottError::Parse("inbound endpoints missing".to_string()))?;
+		let other = if a == inbound.node { b } else { a };
+		digests.push(get_magnet_value_digest(graph, other, magnets)?);
+	}
+	digests.sort_unstable();
+	Ok(digests)
 }
 
+/// Digest of the rendered magnet text, as the legacy engine orders roots by.
 fn get_magnet_value_digest(
 	graph: &mut GraphWrap,
 	node_index: NodeIndex,
-	allow_hashes: bool,
+	magnets: &mut Magnets,
 ) -> ScottResult<[u8; 16]> {
 	if let Some(node) = graph.graph.node_weight(node_index) {
 		if let Some(digest) = node.meta.magnet_cache_digest {
 			return Ok(digest);
 		}
 	}
-	let value = get_magnet(graph, node_index, allow_hashes)?;
-	let digest = md5::compute(value.as_bytes()).0;
+	let key = get_magnet(graph, node_index, magnets)?;
+	let mut hasher = magnets.hash.unwrap_or(DigestAlgorithm::Md5).hasher();
+	hasher.update(key.to_string().as_bytes());
+	let digest = hasher.finish();
 	if let Some(node) = graph.graph.node_weight_mut(node_index) {
 		node.meta.magnet_cache_digest = Some(digest);
 	}
@@ -880,33 +1116,21 @@ fn get_magnet_value_digest(
 }
 
 fn emit_counts(graph: &GraphWrap) {
-	let (virtuals, mirrors) = count_special_nodes(graph);
+	if !trace_enabled() {
+		return;
+	}
+	let counts = dag_counts(graph);
 	emit(
 		"dag_counts",
 		vec![
-			("nodes", Value::Number(graph.graph.node_count().into())),
-			("edges", Value::Number(graph.graph.edge_count().into())),
-			("virtuals", Value::Number(virtuals.into())),
-			("mirrors", Value::Number(mirrors.into())),
+			("nodes", Value::Number(counts.nodes.into())),
+			("edges", Value::Number(counts.edges.into())),
+			("virtuals", Value::Number(counts.virtuals.into())),
+			("mirrors", Value::Number(counts.mirrors.into())),
 		],
 	);
 }
 
-fn count_special_nodes(graph: &GraphWrap) -> (usize, usize) {
-	let mut virtuals = 0usize;
-	let mut mirrors = 0usize;
-	for node_index in graph.graph.node_indices() {
-		let meta = &graph.graph[node_index].meta;
-		if meta.is_virtual {
-			virtuals += 1;
-		}
-		if meta.is_mirror {
-			mirrors += 1;
-		}
-	}
-	(virtuals, mirrors)
-}
-
 fn trace_enabled() -> bool {
 	std::env::var("SCOTT_TRACE").ok().as_deref() == Some("1")
 }
@@ -1039,7 +1263,7 @@ fn top_cobound_scores(scored: &[CoboundEntry], graph: &GraphWrap) -> Vec<Value>
 fn inbound_score_value(score: &InboundScore) -> Value {
 	Value::Array(vec![
 		Value::Number(score.arity.into()),
-		Value::String(score.main_magnet.clone()),
+		Value::String(score.main_magnet.to_string()),
 		Value::String(join_hex_digests(&score.root_magnets)),
 	])
 }
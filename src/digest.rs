@@ -0,0 +1,96 @@
+use std::sync::OnceLock;
+
+use xxhash_rust::xxh3::Xxh3;
+
+use crate::error::{ScottError, ScottResult};
+
+/// Version of the canonical trace format. Bump it whenever the trace of a
+/// given graph changes.
+pub const TRACE_FORMAT_VERSION: u32 = 1;
+
+/// Hash functions a canonical trace can be streamed into.
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum DigestAlgorithm {
+	Md5,
+	/// XXH3, 128-bit variant. Not cryptographic, but several times faster.
+	Xxh3,
+}
+
+impl DigestAlgorithm {
+	pub fn parse(name: &str) -> ScottResult<Self> {
+		match name.trim().to_ascii_lowercase().as_str() {
+			"md5" => Ok(Self::Md5),
+			"xxh3" | "xxh3_128" | "xxh3-128" | "xxh128" => Ok(Self::Xxh3),
+			_ => Err(ScottError::Unsupported(format!("digest algorithm '{}'", name))),
+		}
+	}
+
+	pub fn name(self) -> &'static str {
+		match self {
+			Self::Md5 => "md5",
+			Self::Xxh3 => "xxh3_128",
+		}
+	}
+
+	/// Trace format of traces whose magnets are hashed with `self`, e.g.
+	/// `1+xxh3_128`. MD5 magnets are the original format, `1`.
+	pub fn trace_format(self) -> String {
+		match self {
+			Self::Md5 => TRACE_FORMAT_VERSION.to_string(),
+			_ => format!("{}+{}", TRACE_FORMAT_VERSION, self.name()),
+		}
+	}
+
+	/// Prefix stamped on traces whose magnets are hashed with `self`, so
+	/// they are never mixed up with traces of another hash: `@` and the
+	/// trace format. MD5 traces stay unstamped for backward compatibility.
+	pub fn trace_stamp(self) -> &'static str {
+		static XXH3_STAMP: OnceLock<String> = OnceLock::new();
+		match self {
+			Self::Md5 => "",
+			Self::Xxh3 => XXH3_STAMP.get_or_init(|| format!("@{}:", self.trace_format())),
+		}
+	}
+
+	pub fn hasher(self) -> Hasher {
+		match self {
+			Self::Md5 => Hasher::Md5(md5::Context::new()),
+			Self::Xxh3 => Hasher::Xxh3(Box::new(Xxh3::new())),
+		}
+	}
+}
+
+/// Incremental state of a `DigestAlgorithm`.
+pub enum Hasher {
+	Md5(md5::Context),
+	Xxh3(Box<Xxh3>),
+}
+
+impl Hasher {
+	pub fn update(&mut self, bytes: &[u8]) {
+		match self {
+			Self::Md5(context) => context.consume(bytes),
+			Self::Xxh3(state) => state.update(bytes),
+		}
+	}
+
+	/// Digest bytes, laid out as Python's `hashlib` and `xxhash` return them.
+	/// Both algorithms are 128 bits wide.
+	pub fn finish(self) -> [u8; 16] {
+		match self {
+			Self::Md5(context) => context.compute().0,
+			Self::Xxh3(state) => state.digest128().to_be_bytes(),
+		}
+	}
+}
+
+#[cfg(test)]
+mod tests {
+	use super::*;
+
+	#[test]
+	fn trace_stamp_follows_the_format_version() {
+		assert_eq!(DigestAlgorithm::Md5.trace_stamp(), "");
+		assert_eq!(DigestAlgorithm::Xxh3.trace_stamp(), format!("@{}+xxh3_128:", TRACE_FORMAT_VERSION));
+	}
+}
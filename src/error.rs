@@ -7,6 +7,8 @@ pub enum ScottError {
 	MissingNode(String),
 	InvalidRule(String),
 	Unsupported(String),
+	/// A value that does not fit the integer type it is stored in.
+	OutOfRange(String),
 }
 
 impl fmt::Display for ScottError {
@@ -17,6 +19,7 @@ impl fmt::Display for ScottError {
 			Self::MissingNode(msg) => write!(f, "missing node: {msg}"),
 			Self::InvalidRule(msg) => write!(f, "invalid rule: {msg}"),
 			Self::Unsupported(msg) => write!(f, "unsupported: {msg}"),
+			Self::OutOfRange(msg) => write!(f, "out of range: {msg}"),
 		}
 	}
 }
@@ -3,28 +3,83 @@ use std::collections::HashMap;
 use petgraph::graph::{EdgeIndex, NodeIndex};
 use petgraph::graph::UnGraph;
 use petgraph::stable_graph::StableUnGraph;
+use petgraph::visit::NodeIndexable;
 use std::collections::{HashSet, VecDeque};
+use std::fmt;
+use std::sync::Arc;
 
+use crate::dag::SharedDag;
+use crate::digest::DigestAlgorithm;
 use crate::error::{ScottError, ScottResult};
 
+/// Key a node's magnet is compared by while bounds are fixed: the digest
+/// of its magnet tree or, without hashes, the `_tree_` text itself. Digests
+/// order like their hex rendering, so keys always order like the text.
+#[derive(Debug, Clone, PartialEq, Eq, PartialOrd, Ord)]
+pub enum MagnetKey {
+	Digest([u8; 16]),
+	Text(Arc<str>),
+}
+
+impl fmt::Display for MagnetKey {
+	fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+		match self {
+			Self::Digest(digest) => {
+				const LUT: &[u8; 16] = b"0123456789abcdef";
+				let mut text = [b'_'; 34];
+				for (idx, byte) in digest.iter().enumerate() {
+					text[1 + 2 * idx] = LUT[(byte >> 4) as usize];
+					text[2 + 2 * idx] = LUT[(byte & 0x0f) as usize];
+				}
+				f.write_str(std::str::from_utf8(&text).unwrap_or_default())
+			}
+			Self::Text(text) => f.write_str(text),
+		}
+	}
+}
+
+/// Magnet written between braces after a virtual or mirror node. Keys are
+/// only rendered to text when the node's label is.
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub enum Magnet {
+	/// Magnet of the inbound node a mirror stands for.
+	Key(MagnetKey),
+	/// Magnets of both ends of a cobound, lowest first, around its modality.
+	Cobound(MagnetKey, String, MagnetKey),
+	Text(String),
+}
+
+impl fmt::Display for Magnet {
+	fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+		match self {
+			Self::Key(key) => write!(f, "{}", key),
+			Self::Cobound(lo, modality, hi) => write!(f, "{}-{}-{}", lo, modality, hi),
+			Self::Text(text) => f.write_str(text),
+		}
+	}
+}
+
 #[derive(Debug, Clone, Default)]
 pub struct NodeMeta {
 	pub is_mirror: bool,
 	pub is_virtual: bool,
 	pub floor: Option<i32>,
-	pub magnet: Option<String>,
-	pub magnet_cache: Option<String>,
-	pub magnet_cache_bytes: Option<[u8; 16]>,
+	pub magnet: Option<Magnet>,
+	pub magnet_cache: Option<MagnetKey>,
 	pub magnet_cache_digest: Option<[u8; 16]>,
-	pub magnet_cache_hashed: bool,
+	pub magnet_cache_hash: Option<DigestAlgorithm>,
 	pub arity: Option<usize>,
 	pub master: Option<String>,
 	pub master_attempts: Vec<String>,
 	pub candidate_score: Option<Vec<String>>,
+	/// Sub-DAG hanging below a mirror, see `SharedDag`.
+	pub shared: Option<Arc<SharedDag>>,
 }
 
 #[derive(Debug, Clone, Default)]
 pub struct NodeData {
+	/// Dense per-graph identifier, see `GraphWrap::key_bound`.
+	pub key: u32,
 	pub id: String,
 	pub label: String,
 	pub meta: NodeMeta,
@@ -40,11 +95,79 @@ pub struct EdgeData {
 	pub data: HashMap<String, String>,
 }
 
+/// Set of node keys (`NodeData::key`), stored as a bitset.
+#[derive(Debug, Clone, Default, PartialEq, Eq)]
+pub struct NodeSet {
+	words: Vec<u64>,
+	len: usize,
+}
+
+impl NodeSet {
+	pub fn new() -> Self {
+		Self::default()
+	}
+
+	/// An empty set able to hold keys below `bound` without growing.
+	pub fn with_bound(bound: usize) -> Self {
+		Self {
+			words: vec![0; bound.div_ceil(64)],
+			len: 0,
+		}
+	}
+
+	pub fn insert(&mut self, key: u32) -> bool {
+		let (word, bit) = (key as usize / 64, 1u64 << (key % 64));
+		if word >= self.words.len() {
+			self.words.resize(word + 1, 0);
+		}
+		if self.words[word] & bit != 0 {
+			return false;
+		}
+		self.words[word] |= bit;
+		self.len += 1;
+		true
+	}
+
+	pub fn remove(&mut self, key: u32) -> bool {
+		let (word, bit) = (key as usize / 64, 1u64 << (key % 64));
+		match self.words.get_mut(word) {
+			Some(slot) if *slot & bit != 0 => {
+				*slot &= !bit;
+				self.len -= 1;
+				true
+			}
+			_ => false,
+		}
+	}
+
+	pub fn contains(&self, key: u32) -> bool {
+		let (word, bit) = (key as usize / 64, 1u64 << (key % 64));
+		self.words.get(word).is_some_and(|slot| slot & bit != 0)
+	}
+
+	pub fn len(&self) -> usize {
+		self.len
+	}
+
+	pub fn is_empty(&self) -> bool {
+		self.len == 0
+	}
+
+	pub fn iter(&self) -> impl Iterator<Item = u32> + '_ {
+		self.words.iter().enumerate().flat_map(|(word, bits)| {
+			(0..64u32)
+				.filter(move |bit| bits & (1u64 << bit) != 0)
+				.map(move |bit| word as u32 * 64 + bit)
+		})
+	}
+}
+
 #[derive(Debug, Default, Clone)]
 pub struct GraphWrap {
 	pub graph: StableUnGraph<NodeData, EdgeData>,
 	id_to_index: HashMap<String, NodeIndex>,
 	edge_count: usize,
+	next_key: u32,
 }
 
 impl GraphWrap {
@@ -53,9 +176,38 @@ impl GraphWrap {
 			graph: StableUnGraph::default(),
 			id_to_index: HashMap::new(),
 			edge_count: 0,
+			next_key: 0,
 		}
 	}
 
+	/// Upper bound on node keys. Keys are handed out in insertion order and
+	/// never reused, so unlike `NodeIndex` slots they stay meaningful across
+	/// clones of the graph and the removals and insertions of a DAG rewrite.
+	pub fn key_bound(&self) -> usize {
+		self.next_key as usize
+	}
+
+	fn take_key(&mut self) -> u32 {
+		let key = self.next_key;
+		self.next_key += 1;
+		key
+	}
+
+	pub fn node_key(&self, id: &str) -> Option<u32> {
+		self.node_data(id).map(|node| node.key)
+	}
+
+	/// Keys of the nodes of `ids` present in the graph.
+	pub fn node_set(&self, ids: &HashSet<String>) -> NodeSet {
+		let mut set = NodeSet::with_bound(self.key_bound());
+		for id in ids {
+			if let Some(key) = self.node_key(id) {
+				set.insert(key);
+			}
+		}
+		set
+	}
+
 	pub fn ensure_node(&mut self, id: &str, label: &str) -> NodeIndex {
 		if let Some(index) = self.id_to_index.get(id) {
 			if !label.is_empty() {
@@ -68,6 +220,7 @@ impl GraphWrap {
 			return *index;
 		}
 		let node = NodeData {
+			key: self.take_key(),
 			id: id.to_string(),
 			label: label.to_string(),
 			meta: NodeMeta::default(),
@@ -101,6 +254,7 @@ impl GraphWrap {
 			return *index;
 		}
 		let node = NodeData {
+			key: self.take_key(),
 			id: id.to_string(),
 			label: label.to_string(),
 			meta,
@@ -130,6 +284,28 @@ impl GraphWrap {
 		true
 	}
 
+	/// Copy of the graph without the slots freed by removals. Nodes and edges
+	/// are added again in order, so the copy iterates over them and links
+	/// its adjacency lists as a graph built from them in the first place.
+	pub fn compacted(&self) -> Self {
+		let mut compact = Self::new();
+		let mut indices: HashMap<NodeIndex, NodeIndex> = HashMap::with_capacity(self.graph.node_count());
+		for index in self.graph.node_indices() {
+			let node = &self.graph[index];
+			let new_index = compact.add_node_with_meta(&node.id, &node.label, node.meta.clone());
+			compact.graph[new_index].data = node.data.clone();
+			indices.insert(index, new_index);
+		}
+		for edge_index in self.graph.edge_indices() {
+			if let Some((a, b)) = self.graph.edge_endpoints(edge_index) {
+				compact.add_edge_custom(indices[&a], indices[&b], self.graph[edge_index].clone());
+			}
+		}
+		// Edge ids handed out later must not collide with the kept ones.
+		compact.edge_count = self.edge_count;
+		compact
+	}
+
 	pub fn to_ungraph(&self) -> UnGraph<(), ()> {
 		let mut graph = UnGraph::default();
 		let mut mapping: HashMap<NodeIndex, petgraph::graph::NodeIndex> = HashMap::new();
@@ -191,7 +367,7 @@ impl GraphWrap {
 	pub fn set_node_magnet(&mut self, id: &str, magnet: &str) -> bool {
 		match self.node_meta_mut(id) {
 			Some(meta) => {
-				meta.magnet = Some(magnet.to_string());
+				meta.magnet = Some(Magnet::Text(magnet.to_string()));
 				true
 			}
 			None => false,
@@ -264,9 +440,8 @@ impl GraphWrap {
 			if let Some(node) = self.graph.node_weight_mut(node_index) {
 				node.meta.floor = None;
 				node.meta.magnet_cache = None;
-				node.meta.magnet_cache_bytes = None;
 				node.meta.magnet_cache_digest = None;
-				node.meta.magnet_cache_hashed = false;
+				node.meta.magnet_cache_hash = None;
 			}
 		}
 	}
@@ -274,7 +449,7 @@ impl GraphWrap {
 	pub fn compute_floors(
 		&mut self,
 		root_id: &str,
-		ids_ignore: &HashSet<String>,
+		ids_ignore: &NodeSet,
 	) -> Result<HashMap<i32, Vec<NodeIndex>>, String> {
 		let root_index = self
 			.node_index(root_id)
@@ -285,8 +460,8 @@ impl GraphWrap {
 		let mut queue: VecDeque<(NodeIndex, i32)> = VecDeque::with_capacity(self.graph.node_count());
 		queue.push_back((root_index, 0));
 
-		let mut seen: HashSet<NodeIndex> = HashSet::with_capacity(self.graph.node_count());
-		seen.insert(root_index);
+		let mut seen = vec![false; self.graph.node_bound()];
+		seen[root_index.index()] = true;
 
 		while let Some((node_index, depth)) = queue.pop_front() {
 			if let Some(node) = self.graph.node_weight_mut(node_index) {
@@ -295,17 +470,17 @@ impl GraphWrap {
 			floors.entry(depth).or_default().push(node_index);
 
 			for neighbor in self.graph.neighbors(node_index) {
-				if seen.contains(&neighbor) {
+				if seen[neighbor.index()] {
 					continue;
 				}
-				let neighbor_id = match self.graph.node_weight(neighbor) {
-					Some(node) => node.id.as_str(),
+				let neighbor_key = match self.graph.node_weight(neighbor) {
+					Some(node) => node.key,
 					None => continue,
 				};
-				if neighbor_id != root_id && ids_ignore.contains(neighbor_id) {
+				if ids_ignore.contains(neighbor_key) {
 					continue;
 				}
-				seen.insert(neighbor);
+				seen[neighbor.index()] = true;
 				queue.push_back((neighbor, depth + 1));
 			}
 		}
@@ -319,7 +494,8 @@ impl GraphWrap {
 		ids_ignore: &HashSet<String>,
 	) -> Result<GraphWrap, String> {
 		let mut graph = self.clone();
-		graph.compute_floors(root_id, ids_ignore)?;
+		let ids_ignore = graph.node_set(ids_ignore);
+		graph.compute_floors(root_id, &ids_ignore)?;
 		Ok(graph)
 	}
 }
@@ -340,6 +516,53 @@ impl Graph {
 		Self { inner }
 	}
 
+	/// Graph with one node per entry of `labels`, named after its position,
+	/// and one edge `src[i] -- dst[i]` of modality `modalities[i]` per `i`.
+	pub fn from_arrays(
+		labels: &[impl AsRef<str>],
+		src: &[usize],
+		dst: &[usize],
+		modalities: &[impl AsRef<str>],
+	) -> ScottResult<Graph> {
+		if src.len() != dst.len() || src.len() != modalities.len() {
+			return Err(ScottError::Parse(format!(
+				"edge arrays differ in length: {} sources, {} targets, {} modalities",
+				src.len(),
+				dst.len(),
+				modalities.len()
+			)));
+		}
+		let mut inner = GraphWrap::new();
+		let indices: Vec<NodeIndex> = labels
+			.iter()
+			.enumerate()
+			.map(|(position, label)| inner.ensure_node(&position.to_string(), label.as_ref()))
+			.collect();
+		for (i, modality) in modalities.iter().enumerate() {
+			let (from, to) = match (indices.get(src[i]), indices.get(dst[i])) {
+				(Some(from), Some(to)) => (*from, *to),
+				_ => {
+					return Err(ScottError::MissingNode(format!(
+						"edge {} joins {} and {}, but there are {} nodes",
+						i,
+						src[i],
+						dst[i],
+						indices.len()
+					)));
+				}
+			};
+			let edge = EdgeData {
+				id: String::new(),
+				modality: modality.as_ref().to_string(),
+				directed: false,
+				meta: HashMap::new(),
+				data: HashMap::new(),
+			};
+			inner.add_edge_custom(from, to, edge);
+		}
+		Ok(Graph::from_wrap(inner))
+	}
+
 	pub fn as_wrap(&self) -> &GraphWrap {
 		&self.inner
 	}
@@ -368,3 +591,52 @@ impl Graph {
 		Ok(Graph::from_wrap(graph))
 	}
 }
+
+#[cfg(test)]
+mod tests {
+	use super::*;
+
+	fn layout(graph: &GraphWrap) -> Vec<(String, Vec<String>)> {
+		graph
+			.graph
+			.node_indices()
+			.map(|index| {
+				let edges = graph.graph.edges(index).map(|edge| edge.weight().id.clone()).collect();
+				(graph.graph[index].id.clone(), edges)
+			})
+			.collect()
+	}
+
+	#[test]
+	fn compacted_graph_is_laid_out_as_a_fresh_build() {
+		let mut graph = GraphWrap::new();
+		for (from, to) in [("a", "b"), ("b", "c"), ("c", "a"), ("c", "d"), ("d", "e")] {
+			graph.add_edge(from, to);
+		}
+		graph.remove_node("b");
+		let e4 = graph.graph.edge_indices().find(|index| graph.graph[*index].id == "e4").unwrap();
+		graph.graph.remove_edge(e4);
+		let grow = |graph: &mut GraphWrap| {
+			let f = graph.ensure_node("f", ".");
+			let a = graph.node_index("a").unwrap();
+			let edge = EdgeData { id: "e6".to_string(), modality: "1".to_string(), ..EdgeData::default() };
+			graph.add_edge_custom(a, f, edge);
+		};
+		let mut compacted = graph.compacted();
+		grow(&mut compacted);
+		// Without compacting, both additions take a freed slot, ahead of the
+		// nodes and edges kept.
+		grow(&mut graph);
+
+		let mut fresh = GraphWrap::new();
+		for id in ["a", "c", "d", "e", "f"] {
+			fresh.ensure_node(id, ".");
+		}
+		for (id, from, to) in [("e3", "c", "a"), ("e5", "d", "e"), ("e6", "a", "f")] {
+			let (from, to) = (fresh.node_index(from).unwrap(), fresh.node_index(to).unwrap());
+			fresh.add_edge_custom(from, to, EdgeData { id: id.to_string(), modality: "1".to_string(), ..EdgeData::default() });
+		}
+		assert_ne!(layout(&graph), layout(&fresh));
+		assert_eq!(layout(&compacted), layout(&fresh));
+	}
+}
@@ -1,10 +1,14 @@
+pub mod adjacency;
 pub mod canonize;
 pub mod cgraph;
 pub mod dag;
+pub mod digest;
 pub mod dot;
 pub mod error;
 pub mod graph;
 pub mod parse;
+pub mod pool;
+pub mod rule;
 pub mod tree;
 
 #[cfg(feature = "python")]
@@ -0,0 +1,97 @@
+//! Thread pool the `parallel` code paths run on.
+//!
+//! Canonization runs on a rayon pool of its own rather than the global one,
+//! so it can be sized next to the caller's own workers. The pool is built on
+//! first use with `SCOTT_NUM_THREADS` threads, or one per core, and can be
+//! resized at any time with `set_num_threads`. Without the `parallel`
+//! feature everything runs on the calling thread. A pool that cannot be
+//! built is reported as an error, never a panic, as the crate runs inside
+//! Python.
+
+#[cfg(feature = "parallel")]
+use std::sync::{Arc, RwLock};
+
+use crate::error::ScottResult;
+#[cfg(feature = "parallel")]
+use crate::error::ScottError;
+
+/// Environment variable sizing the pool until `set_num_threads` is called.
+pub const NUM_THREADS_ENV: &str = "SCOTT_NUM_THREADS";
+
+#[cfg(feature = "parallel")]
+static POOL: RwLock<Option<Arc<rayon::ThreadPool>>> = RwLock::new(None);
+
+/// Resize the pool to `threads` threads; `0` goes back to the default.
+///
+/// Canonizations already running finish on the pool they started on.
+pub fn set_num_threads(threads: usize) -> ScottResult<()> {
+	#[cfg(feature = "parallel")]
+	{
+		let pool = build_pool(threads)?;
+		*POOL.write().unwrap_or_else(|poisoned| poisoned.into_inner()) = Some(pool);
+		Ok(())
+	}
+	#[cfg(not(feature = "parallel"))]
+	{
+		let _ = threads;
+		Ok(())
+	}
+}
+
+/// Number of threads canonization runs on.
+pub fn num_threads() -> ScottResult<usize> {
+	#[cfg(feature = "parallel")]
+	{
+		Ok(pool()?.current_num_threads())
+	}
+	#[cfg(not(feature = "parallel"))]
+	{
+		Ok(1)
+	}
+}
+
+/// Run `op` on the pool, so that its parallel iterators use it.
+pub fn install<R: Send>(op: impl FnOnce() -> ScottResult<R> + Send) -> ScottResult<R> {
+	#[cfg(feature = "parallel")]
+	{
+		pool()?.install(op)
+	}
+	#[cfg(not(feature = "parallel"))]
+	{
+		op()
+	}
+}
+
+#[cfg(feature = "parallel")]
+fn pool() -> ScottResult<Arc<rayon::ThreadPool>> {
+	if let Some(pool) = POOL.read().unwrap_or_else(|poisoned| poisoned.into_inner()).as_ref() {
+		return Ok(pool.clone());
+	}
+	let mut slot = POOL.write().unwrap_or_else(|poisoned| poisoned.into_inner());
+	if let Some(pool) = slot.as_ref() {
+		return Ok(pool.clone());
+	}
+	let pool = build_pool(0)?;
+	*slot = Some(pool.clone());
+	Ok(pool)
+}
+
+/// Threads asked for by `SCOTT_NUM_THREADS`, `0` when unset or invalid.
+#[cfg(feature = "parallel")]
+fn env_num_threads() -> usize {
+	std::env::var(NUM_THREADS_ENV)
+		.ok()
+		.and_then(|value| value.trim().parse().ok())
+		.unwrap_or(0)
+}
+
+#[cfg(feature = "parallel")]
+fn build_pool(threads: usize) -> ScottResult<Arc<rayon::ThreadPool>> {
+	let threads = if threads == 0 { env_num_threads() } else { threads };
+	rayon::ThreadPoolBuilder::new()
+		.num_threads(threads)
+		.thread_name(|index| format!("scott-{}", index))
+		.build()
+		.map(Arc::new)
+		.map_err(|err| ScottError::Unsupported(format!("thread pool: {}", err)))
+}
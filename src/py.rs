@@ -1,18 +1,154 @@
-use pyo3::exceptions::PyValueError;
+use std::borrow::Cow;
+use std::collections::HashMap;
+use std::sync::OnceLock;
+
+use petgraph::graph::EdgeIndex;
+
+use pyo3::exceptions::{PyOverflowError, PyValueError};
 use pyo3::prelude::*;
+use pyo3::pybacked::PyBackedBytes;
+use pyo3::types::{PyByteArray, PyBytes};
 use pyo3::wrap_pyfunction;
 
-use crate::canonize::{canonical_node_order, to_cgraph};
-use crate::graph::Graph;
+use crate::adjacency::adjacency_matrix;
+use crate::canonize::{
+	canonical_digest, canonical_node_order_with_hash, to_cgraph_batch as canonize_batch,
+	to_cgraph_with_hash,
+};
+use crate::digest::DigestAlgorithm;
+use crate::error::ScottError;
+use crate::graph::{EdgeData, Graph};
 use crate::parse::{from_dot, from_dot_str};
+use crate::pool;
 
 #[pyclass]
 pub struct PyGraph {
 	inner: Graph,
+	/// Edge index of each edge id, built on the first edge lookup. Entries
+	/// may outlive their edge, so a hit is checked against the edge id.
+	/// Lookups only take `&self`, so they never clash with the shared borrow
+	/// of a canonization running without the GIL.
+	edge_ids: OnceLock<HashMap<String, EdgeIndex>>,
+}
+
+impl PyGraph {
+	fn new(inner: Graph) -> Self {
+		Self {
+			inner,
+			edge_ids: OnceLock::new(),
+		}
+	}
+
+	fn edge_index(&self, id: &str) -> Option<EdgeIndex> {
+		let wrap = self.inner.as_wrap();
+		let edge_ids = self.edge_ids.get_or_init(|| {
+			wrap.graph
+				.edge_indices()
+				.map(|index| (wrap.graph[index].id.clone(), index))
+				.collect()
+		});
+		edge_ids
+			.get(id)
+			.copied()
+			.filter(|index| wrap.graph.edge_weight(*index).is_some_and(|edge| edge.id == id))
+	}
+
+	fn put_node(&mut self, id: &str, label: &str) {
+		self.inner.ensure_node(id, label);
+		if let Some(node) = self.inner.as_wrap_mut().node_data_mut(id) {
+			if node.label != label {
+				node.label = label.to_string();
+			}
+		}
+	}
+
+	/// Drop the slots freed by a removal. petgraph hands them out again and
+	/// threads a new edge at the head of the adjacency of its ends, while
+	/// traces follow both orders: the graph is made again as a fresh build
+	/// from its remaining nodes and edges would make it.
+	fn compact(&mut self) {
+		self.inner = Graph::from_wrap(self.inner.as_wrap().compacted());
+		self.edge_ids = OnceLock::new();
+	}
+
+	fn put_edge(&mut self, id: &str, id_a: &str, id_b: &str, modality: &str) {
+		// A replaced edge takes the slot it frees, so it keeps its place
+		// once compacted, as it does in `Graph.E`.
+		let replaced = self.detach_edge(id);
+		let a = self.inner.ensure_node(id_a, ".");
+		let b = self.inner.ensure_node(id_b, ".");
+		let edge = EdgeData {
+			id: id.to_string(),
+			modality: modality.to_string(),
+			..EdgeData::default()
+		};
+		let index = self.inner.as_wrap_mut().add_edge_custom(a, b, edge);
+		if let Some(edge_ids) = self.edge_ids.get_mut() {
+			edge_ids.insert(id.to_string(), index);
+		}
+		if replaced {
+			self.compact();
+		}
+	}
+
+	/// Remove edge `id` without compacting; false if there was no such edge.
+	fn detach_edge(&mut self, id: &str) -> bool {
+		match self.edge_index(id) {
+			Some(index) => {
+				self.inner.as_wrap_mut().graph.remove_edge(index);
+				if let Some(edge_ids) = self.edge_ids.get_mut() {
+					edge_ids.remove(id);
+				}
+				true
+			}
+			None => false,
+		}
+	}
 }
 
 #[pymethods]
 impl PyGraph {
+	/// Add node `id`, or relabel it if it exists.
+	fn add_node(&mut self, id: &str, label: &str) {
+		self.put_node(id, label);
+	}
+
+	fn add_nodes(&mut self, nodes: Vec<(String, String)>) {
+		for (id, label) in nodes {
+			self.put_node(&id, &label);
+		}
+	}
+
+	/// Add edge `id` between `id_a` and `id_b`, replacing any edge of that
+	/// id. Missing endpoints are added with label `"."`.
+	fn add_edge(&mut self, id: &str, id_a: &str, id_b: &str, modality: &str) {
+		self.put_edge(id, id_a, id_b, modality);
+	}
+
+	fn add_edges(&mut self, edges: Vec<(String, String, String, String)>) {
+		for (id, id_a, id_b, modality) in edges {
+			self.put_edge(&id, &id_a, &id_b, &modality);
+		}
+	}
+
+	/// Remove node `id` and its edges; false if there was no such node.
+	fn remove_node(&mut self, id: &str) -> bool {
+		let removed = self.inner.as_wrap_mut().remove_node(id);
+		if removed {
+			self.compact();
+		}
+		removed
+	}
+
+	/// Remove edge `id`; false if there was no such edge.
+	fn remove_edge(&mut self, id: &str) -> bool {
+		let removed = self.detach_edge(id);
+		if removed {
+			self.compact();
+		}
+		removed
+	}
+
 	#[getter]
 	fn node_count(&self) -> usize {
 		self.inner.as_wrap().graph.node_count()
@@ -48,6 +184,33 @@ impl PyGraph {
 		}
 		edges
 	}
+
+	fn node_ids(&self) -> Vec<String> {
+		let wrap = self.inner.as_wrap();
+		wrap.graph.node_indices().map(|index| wrap.graph[index].id.clone()).collect()
+	}
+
+	/// Label of node `id`, `None` if there is no such node.
+	fn node_label(&self, id: &str) -> Option<String> {
+		self.inner.as_wrap().node_data(id).map(|node| node.label.clone())
+	}
+
+	fn edge_ids(&self) -> Vec<String> {
+		let wrap = self.inner.as_wrap();
+		wrap.graph.edge_indices().map(|index| wrap.graph[index].id.clone()).collect()
+	}
+
+	/// Endpoints and modality of edge `id`, `None` if there is no such edge.
+	fn edge(&self, id: &str) -> Option<(String, String, String)> {
+		let index = self.edge_index(id)?;
+		let wrap = self.inner.as_wrap();
+		let (a, b) = wrap.graph.edge_endpoints(index)?;
+		Some((
+			wrap.graph[a].id.clone(),
+			wrap.graph[b].id.clone(),
+			wrap.graph[index].modality.clone(),
+		))
+	}
 }
 
 #[pyclass]
@@ -74,16 +237,20 @@ fn map_err(err: impl ToString) -> PyErr {
 	PyValueError::new_err(err.to_string())
 }
 
+fn parse_hash(hash: Option<&str>) -> PyResult<DigestAlgorithm> {
+	DigestAlgorithm::parse(hash.unwrap_or("md5")).map_err(map_err)
+}
+
 #[pyfunction]
-fn parse_dot(path: &str) -> PyResult<PyGraph> {
-	let graph = from_dot(path).map_err(map_err)?;
-	Ok(PyGraph { inner: graph })
+fn parse_dot(py: Python<'_>, path: &str) -> PyResult<PyGraph> {
+	let graph = py.detach(|| from_dot(path)).map_err(map_err)?;
+	Ok(PyGraph::new(graph))
 }
 
 #[pyfunction]
-fn parse_dot_string(content: &str) -> PyResult<PyGraph> {
-	let graph = from_dot_str(content).map_err(map_err)?;
-	Ok(PyGraph { inner: graph })
+fn parse_dot_string(py: Python<'_>, content: &str) -> PyResult<PyGraph> {
+	let graph = py.detach(|| from_dot_str(content)).map_err(map_err)?;
+	Ok(PyGraph::new(graph))
 }
 
 #[pyfunction]
@@ -95,72 +262,359 @@ fn graph_from_edges(nodes: Vec<(String, String)>, edges: Vec<(String, String, St
 	for (id_a, id_b, modality) in edges {
 		graph.add_edge_with_modality(&id_a, &id_b, &modality);
 	}
-	Ok(PyGraph { inner: graph })
+	Ok(PyGraph::new(graph))
+}
+
+/// Integer array as handed over by `scott.graph`: its native-endian bytes,
+/// item size and signedness.
+type IntArray = (PyBackedBytes, usize, bool);
+
+fn decode_codes(what: &str, (data, itemsize, signed): &IntArray) -> PyResult<Vec<usize>> {
+	if !matches!(itemsize, 1 | 2 | 4 | 8) || data.len() % itemsize != 0 {
+		return Err(map_err(format!("{}: unsupported item size {}", what, itemsize)));
+	}
+	data.chunks_exact(*itemsize)
+		.enumerate()
+		.map(|(i, chunk)| {
+			let value = read_int(chunk, *signed);
+			usize::try_from(value)
+				.map_err(|_| map_err(format!("{}[{}] is negative or too large: {}", what, i, value)))
+		})
+		.collect()
+}
+
+fn read_int(chunk: &[u8], signed: bool) -> i128 {
+	// `chunk` is exactly one item long, so the conversions cannot fail.
+	match (chunk.len(), signed) {
+		(1, true) => i8::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+		(2, true) => i16::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+		(4, true) => i32::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+		(8, true) => i64::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+		(1, false) => u8::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+		(2, false) => u16::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+		(4, false) => u32::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+		_ => u64::from_ne_bytes(chunk.try_into().unwrap()) as i128,
+	}
+}
+
+/// Names of `codes`: `names[code]`, or the code itself without `names`.
+fn resolve_codes<'a>(what: &str, codes: &[usize], names: Option<&'a [String]>) -> PyResult<Vec<Cow<'a, str>>> {
+	match names {
+		None => Ok(codes.iter().map(|code| Cow::Owned(code.to_string())).collect()),
+		Some(names) => codes
+			.iter()
+			.map(|code| {
+				names
+					.get(*code)
+					.map(|name| Cow::Borrowed(name.as_str()))
+					.ok_or_else(|| map_err(format!("{} code {} has no name ({} names)", what, code, names.len())))
+			})
+			.collect(),
+	}
+}
+
+/// Graph built from integer arrays, see `scott.graph.Graph.from_arrays`.
+#[pyfunction]
+#[pyo3(signature = (src, dst, node_labels, edge_modalities=None, label_names=None, modality_names=None))]
+fn graph_from_arrays(
+	py: Python<'_>,
+	src: IntArray,
+	dst: IntArray,
+	node_labels: IntArray,
+	edge_modalities: Option<IntArray>,
+	label_names: Option<Vec<String>>,
+	modality_names: Option<Vec<String>>,
+) -> PyResult<PyGraph> {
+	let src = decode_codes("src", &src)?;
+	let dst = decode_codes("dst", &dst)?;
+	let label_codes = decode_codes("node_labels", &node_labels)?;
+	let labels = resolve_codes("label", &label_codes, label_names.as_deref())?;
+	let modalities = match edge_modalities {
+		Some(edge_modalities) => {
+			let modality_codes = decode_codes("edge_modalities", &edge_modalities)?;
+			resolve_codes("modality", &modality_codes, modality_names.as_deref())?
+		}
+		None => vec![Cow::Borrowed("1"); src.len()],
+	};
+	let graph = py
+		.detach(|| Graph::from_arrays(&labels, &src, &dst, &modalities))
+		.map_err(map_err)?;
+	Ok(PyGraph::new(graph))
 }
 
 #[pyfunction]
 fn to_cgraph_py(
+	py: Python<'_>,
 	graph: &PyGraph,
 	candidate_rule: Option<&str>,
 	branch_rule: Option<&str>,
 	allow_hashes: Option<bool>,
 	compress: Option<bool>,
 	compact: Option<bool>,
+	hash: Option<&str>,
 ) -> PyResult<PyCGraph> {
+	let hash = parse_hash(hash)?;
 	let candidate_rule = candidate_rule.unwrap_or("$degree");
 	let branch_rule = branch_rule.unwrap_or("$depth > tree.parent_modality > $lexic");
 	let allow_hashes = allow_hashes.unwrap_or(true);
 	let compress = compress.unwrap_or(true);
 	let compact = compact.unwrap_or(false);
 
-	let cgraph = to_cgraph(
-		&graph.inner,
-		candidate_rule,
-		branch_rule,
-		allow_hashes,
-		compress,
-		compact,
-	)
-	.map_err(map_err)?;
+	let cgraph = py
+		.detach(|| {
+			to_cgraph_with_hash(
+				&graph.inner,
+				candidate_rule,
+				branch_rule,
+				allow_hashes,
+				compress,
+				compact,
+				hash,
+			)
+		})
+		.map_err(map_err)?;
 
 	Ok(PyCGraph {
 		value: cgraph.to_string(),
 	})
 }
 
+/// Canonize a list of graphs without holding the GIL.
+///
+/// Returns one item per input graph, in order: a `PyCGraph` on success or a
+/// `ValueError` instance when that graph failed.
 #[pyfunction]
-#[pyo3(signature = (graph, candidate_rule=None, branch_rule=None, allow_hashes=None, compact=None))]
+#[pyo3(signature = (graphs, candidate_rule=None, branch_rule=None, allow_hashes=None, compress=None, compact=None, hash=None))]
+fn to_cgraph_batch(
+	py: Python<'_>,
+	graphs: Vec<Py<PyGraph>>,
+	candidate_rule: Option<&str>,
+	branch_rule: Option<&str>,
+	allow_hashes: Option<bool>,
+	compress: Option<bool>,
+	compact: Option<bool>,
+	hash: Option<&str>,
+) -> PyResult<Vec<Py<PyAny>>> {
+	let hash = parse_hash(hash)?;
+	let candidate_rule = candidate_rule.unwrap_or("$degree");
+	let branch_rule = branch_rule.unwrap_or("$depth > tree.parent_modality > $lexic");
+	let allow_hashes = allow_hashes.unwrap_or(true);
+	let compress = compress.unwrap_or(true);
+	let compact = compact.unwrap_or(false);
+
+	let borrowed: Vec<PyRef<'_, PyGraph>> = graphs.iter().map(|graph| graph.borrow(py)).collect();
+	let inners: Vec<&Graph> = borrowed.iter().map(|graph| &graph.inner).collect();
+
+	let results = py.detach(|| {
+		canonize_batch(
+			&inners,
+			candidate_rule,
+			branch_rule,
+			allow_hashes,
+			compress,
+			compact,
+			hash,
+		)
+	});
+
+	let mut output = Vec::with_capacity(results.len());
+	for result in results {
+		let item = match result {
+			Ok(cgraph) => Py::new(
+				py,
+				PyCGraph {
+					value: cgraph.to_string(),
+				},
+			)?
+			.into_any(),
+			Err(err) => map_err(err).into_value(py).into_any(),
+		};
+		output.push(item);
+	}
+	Ok(output)
+}
+
+#[pyfunction]
+#[pyo3(signature = (graph, candidate_rule=None, branch_rule=None, allow_hashes=None, compact=None, hash=None))]
 fn canonical_node_order_py(
+	py: Python<'_>,
 	graph: &PyGraph,
 	candidate_rule: Option<&str>,
 	branch_rule: Option<&str>,
 	allow_hashes: Option<bool>,
 	compact: Option<bool>,
+	hash: Option<&str>,
 ) -> PyResult<Vec<String>> {
+	let hash = parse_hash(hash)?;
 	let candidate_rule = candidate_rule.unwrap_or("$degree");
 	let branch_rule = branch_rule.unwrap_or("$depth > tree.parent_modality > $lexic");
 	let allow_hashes = allow_hashes.unwrap_or(true);
 	let compact = compact.unwrap_or(false);
 
-	let order = canonical_node_order(
-		&graph.inner,
-		candidate_rule,
-		branch_rule,
-		allow_hashes,
-		compact,
-	)
-	.map_err(map_err)?;
+	let order = py
+		.detach(|| {
+			canonical_node_order_with_hash(
+				&graph.inner,
+				candidate_rule,
+				branch_rule,
+				allow_hashes,
+				compact,
+				hash,
+			)
+		})
+		.map_err(map_err)?;
 
 	Ok(order)
 }
 
+/// Digest of the canonical trace, streamed into the hasher without building it.
+#[pyfunction]
+#[pyo3(signature = (graph, algorithm=None, candidate_rule=None, branch_rule=None, allow_hashes=None, compress=None, compact=None, hash=None))]
+fn canonical_digest_py(
+	py: Python<'_>,
+	graph: &PyGraph,
+	algorithm: Option<&str>,
+	candidate_rule: Option<&str>,
+	branch_rule: Option<&str>,
+	allow_hashes: Option<bool>,
+	compress: Option<bool>,
+	compact: Option<bool>,
+	hash: Option<&str>,
+) -> PyResult<Py<PyBytes>> {
+	let algorithm = DigestAlgorithm::parse(algorithm.unwrap_or("md5")).map_err(map_err)?;
+	let hash = parse_hash(hash)?;
+	let candidate_rule = candidate_rule.unwrap_or("$degree");
+	let branch_rule = branch_rule.unwrap_or("$depth > tree.parent_modality > $lexic");
+	let allow_hashes = allow_hashes.unwrap_or(true);
+	let compress = compress.unwrap_or(true);
+	let compact = compact.unwrap_or(false);
+
+	let digest = py
+		.detach(|| {
+			canonical_digest(
+				&graph.inner,
+				candidate_rule,
+				branch_rule,
+				allow_hashes,
+				compress,
+				compact,
+				hash,
+				algorithm,
+			)
+		})
+		.map_err(map_err)?;
+
+	Ok(PyBytes::new(py, &digest).unbind())
+}
+
+/// Matrix values as native-endian `dtype` items.
+fn encode_values(values: &[i32], dtype: &str) -> PyResult<Vec<u8>> {
+	match dtype {
+		"int32" => Ok(values.iter().flat_map(|value| value.to_ne_bytes()).collect()),
+		"uint8" => values
+			.iter()
+			.map(|value| {
+				u8::try_from(*value).map_err(|_| map_err(format!("value {} does not fit in uint8", value)))
+			})
+			.collect(),
+		_ => Err(map_err(format!("unsupported dtype '{}', expected int32 or uint8", dtype))),
+	}
+}
+
+/// Adjacency matrix of `graph`, canonical and stabilized when `canonic`.
+///
+/// Returns `(size, values, None, None)` with the dense row-major values when
+/// `dense`, else the CSR arrays `(size, data, indices, indptr)`, indices as
+/// int32 and indptr as int64. Values are of `dtype`, `int32` or `uint8`.
+/// Raises `OverflowError` when a modality does not fit in 32 bits.
+#[pyfunction]
+#[pyo3(signature = (graph, canonic=true, dense=true, dtype=None, candidate_rule=None, branch_rule=None, allow_hashes=None, compact=None, hash=None))]
+fn adjacency_matrix_py(
+	py: Python<'_>,
+	graph: &PyGraph,
+	canonic: bool,
+	dense: bool,
+	dtype: Option<&str>,
+	candidate_rule: Option<&str>,
+	branch_rule: Option<&str>,
+	allow_hashes: Option<bool>,
+	compact: Option<bool>,
+	hash: Option<&str>,
+) -> PyResult<(usize, Py<PyByteArray>, Option<Py<PyByteArray>>, Option<Py<PyByteArray>>)> {
+	let hash = parse_hash(hash)?;
+	let dtype = dtype.unwrap_or("int32");
+	let candidate_rule = candidate_rule.unwrap_or("$degree");
+	let branch_rule = branch_rule.unwrap_or("$depth > tree.parent_modality > $lexic");
+	let allow_hashes = allow_hashes.unwrap_or(true);
+	let compact = compact.unwrap_or(false);
+
+	let adjacency = py
+		.detach(|| {
+			adjacency_matrix(
+				&graph.inner,
+				canonic,
+				candidate_rule,
+				branch_rule,
+				allow_hashes,
+				compact,
+				hash,
+			)
+		})
+		.map_err(|err| match err {
+			ScottError::OutOfRange(_) => PyOverflowError::new_err(err.to_string()),
+			_ => map_err(err),
+		})?;
+
+	let size = adjacency.size();
+	if dense {
+		let values = encode_values(&adjacency.to_dense(), dtype)?;
+		return Ok((size, PyByteArray::new(py, &values).unbind(), None, None));
+	}
+	let (data, indices, indptr) = adjacency.to_csr();
+	let data = encode_values(&data, dtype)?;
+	let indices: Vec<u8> = indices.iter().flat_map(|index| index.to_ne_bytes()).collect();
+	let indptr: Vec<u8> = indptr.iter().flat_map(|offset| offset.to_ne_bytes()).collect();
+	Ok((
+		size,
+		PyByteArray::new(py, &data).unbind(),
+		Some(PyByteArray::new(py, &indices).unbind()),
+		Some(PyByteArray::new(py, &indptr).unbind()),
+	))
+}
+
+/// Resize the thread pool canonization runs on; `0` restores the default.
+#[pyfunction]
+fn set_num_threads(threads: usize) -> PyResult<()> {
+	pool::set_num_threads(threads).map_err(map_err)
+}
+
+/// Number of threads canonization runs on.
+#[pyfunction]
+fn get_num_threads() -> PyResult<usize> {
+	pool::num_threads().map_err(map_err)
+}
+
+/// Trace format of traces built with magnet hash `hash`.
+#[pyfunction]
+#[pyo3(signature = (hash=None))]
+fn trace_format(hash: Option<&str>) -> PyResult<String> {
+	Ok(parse_hash(hash)?.trace_format())
+}
+
 pub fn init_module(_py: Python<'_>, m: &Bound<'_, PyModule>) -> PyResult<()> {
 	m.add_class::<PyGraph>()?;
 	m.add_class::<PyCGraph>()?;
 	m.add_function(wrap_pyfunction!(parse_dot, m)?)?;
 	m.add_function(wrap_pyfunction!(parse_dot_string, m)?)?;
 	m.add_function(wrap_pyfunction!(graph_from_edges, m)?)?;
+	m.add_function(wrap_pyfunction!(graph_from_arrays, m)?)?;
 	m.add_function(wrap_pyfunction!(to_cgraph_py, m)?)?;
+	m.add_function(wrap_pyfunction!(to_cgraph_batch, m)?)?;
 	m.add_function(wrap_pyfunction!(canonical_node_order_py, m)?)?;
+	m.add_function(wrap_pyfunction!(canonical_digest_py, m)?)?;
+	m.add_function(wrap_pyfunction!(adjacency_matrix_py, m)?)?;
+	m.add_function(wrap_pyfunction!(trace_format, m)?)?;
+	m.add_function(wrap_pyfunction!(set_num_threads, m)?)?;
+	m.add_function(wrap_pyfunction!(get_num_threads, m)?)?;
 	Ok(())
 }
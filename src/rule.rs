@@ -0,0 +1,305 @@
+use std::collections::VecDeque;
+
+use petgraph::graph::NodeIndex;
+use petgraph::visit::{EdgeRef, NodeIndexable};
+
+use crate::error::{ScottError, ScottResult};
+use crate::graph::GraphWrap;
+
+/// One component of a candidate score. Columns of a compiled rule always
+/// hold the same variant, so the derived ordering only ever compares like
+/// with like (integers numerically, labels lexicographically).
+#[derive(Debug, Clone, PartialEq, Eq, PartialOrd, Ord)]
+pub enum ScoreValue {
+	Int(i64),
+	Text(String),
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+enum Term {
+	Degree,
+	Label,
+	Bounds,
+	NDegree(usize),
+	Refine,
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+struct Attribute {
+	term: Term,
+	negate: bool,
+}
+
+/// A compiled candidate rule such as `$label > $degree > graph.n_degree(id_node, 1)`.
+///
+/// Each `>`-separated attribute is evaluated for every node at once; the
+/// score of a node is the tuple of its attribute values, compared
+/// lexicographically like the legacy engine does.
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub struct CandidateRule {
+	attributes: Vec<Attribute>,
+}
+
+impl CandidateRule {
+	pub fn parse(rule: &str) -> ScottResult<Self> {
+		let mut attributes = Vec::new();
+		for raw in rule.split('>') {
+			attributes.push(parse_attribute(raw.trim(), rule)?);
+		}
+		Ok(Self { attributes })
+	}
+
+	/// Score every node of `graph`, in `node_indices()` order.
+	pub fn score_nodes(&self, graph: &GraphWrap) -> Vec<(NodeIndex, Vec<ScoreValue>)> {
+		let nodes: Vec<NodeIndex> = graph.graph.node_indices().collect();
+		let mut scores: Vec<Vec<ScoreValue>> = (0..nodes.len())
+			.map(|_| Vec::with_capacity(self.attributes.len() + 1))
+			.collect();
+
+		for attribute in &self.attributes {
+			match attribute.term {
+				Term::Label => {
+					for (score, node_index) in scores.iter_mut().zip(&nodes) {
+						score.push(ScoreValue::Text(graph.graph[*node_index].label.clone()));
+					}
+				}
+				Term::Degree => {
+					let degrees = degree_column(graph, &nodes);
+					push_int_column(&mut scores, &degrees, attribute.negate);
+				}
+				Term::NDegree(order) => {
+					let n_degrees = n_degree_column(graph, &nodes, order);
+					push_int_column(&mut scores, &n_degrees, attribute.negate);
+				}
+				Term::Bounds => {
+					let (inbounds, cobounds) = bounds_columns(graph, &nodes);
+					// Legacy scores `$bounds` as (-inbounds, -cobounds): fewer bounds win.
+					push_int_column(&mut scores, &inbounds, !attribute.negate);
+					push_int_column(&mut scores, &cobounds, !attribute.negate);
+				}
+				Term::Refine => {
+					let (sizes, colours) = refine_columns(graph, &nodes);
+					// Smallest colour class first, then the highest canonical colour.
+					push_int_column(&mut scores, &sizes, !attribute.negate);
+					push_int_column(&mut scores, &colours, attribute.negate);
+				}
+			}
+		}
+
+		nodes.into_iter().zip(scores).collect()
+	}
+}
+
+fn parse_attribute(raw: &str, rule: &str) -> ScottResult<Attribute> {
+	let (negate, body) = match raw.strip_prefix('-') {
+		Some(rest) => (true, rest.trim()),
+		None => (false, raw),
+	};
+	let compact: String = body.chars().filter(|ch| !ch.is_whitespace()).collect();
+	let term = match compact.as_str() {
+		"$degree" | "graph.degree(id_node)" | "len(graph.R[id_node])" => Term::Degree,
+		"$label" | "graph.V[id_node].label" | "node.label" => Term::Label,
+		"$bounds" => Term::Bounds,
+		"$refine" | "$colour" | "$color" => Term::Refine,
+		_ => match parse_n_degree(&compact) {
+			Some(order) => Term::NDegree(order),
+			None => {
+				return Err(ScottError::InvalidRule(format!(
+					"unknown attribute '{}' in candidate rule '{}'",
+					raw, rule
+				)))
+			}
+		},
+	};
+	if negate && term == Term::Label {
+		return Err(ScottError::InvalidRule(format!(
+			"cannot negate non-numeric attribute '{}' in candidate rule '{}'",
+			raw, rule
+		)));
+	}
+	Ok(Attribute { term, negate })
+}
+
+fn parse_n_degree(compact: &str) -> Option<usize> {
+	let args = compact
+		.strip_prefix("graph.n_degree(")
+		.or_else(|| compact.strip_prefix("$n_degree("))?
+		.strip_suffix(')')?;
+	let mut parts = args.split(',');
+	let first = parts.next()?;
+	let order = if first == "id_node" {
+		parts.next().unwrap_or("0")
+	} else {
+		first
+	};
+	if parts.next().is_some() {
+		return None;
+	}
+	order.parse().ok()
+}
+
+fn push_int_column(scores: &mut [Vec<ScoreValue>], column: &[i64], negate: bool) {
+	for (score, value) in scores.iter_mut().zip(column) {
+		let value = if negate { -*value } else { *value };
+		score.push(ScoreValue::Int(value));
+	}
+}
+
+fn degree_column(graph: &GraphWrap, nodes: &[NodeIndex]) -> Vec<i64> {
+	nodes
+		.iter()
+		.map(|node_index| graph.graph.neighbors(*node_index).count() as i64)
+		.collect()
+}
+
+/// `n_degree(v, k)` sums the degree of the end node of every walk of length
+/// `0..=k` starting at `v`. Walk sums obey `W_j(v) = sum(W_{j-1}(u), u ~ v)`,
+/// so the whole column costs `k` sweeps over the edges.
+fn n_degree_column(graph: &GraphWrap, nodes: &[NodeIndex], order: usize) -> Vec<i64> {
+	let bound = graph.graph.node_bound();
+	let mut walk = vec![0i64; bound];
+	for node_index in nodes {
+		walk[node_index.index()] = graph.graph.neighbors(*node_index).count() as i64;
+	}
+	let mut total = walk.clone();
+	let mut next = vec![0i64; bound];
+	for _ in 0..order {
+		for node_index in nodes {
+			let mut sum = 0i64;
+			for neighbor in graph.graph.neighbors(*node_index) {
+				sum = sum.saturating_add(walk[neighbor.index()]);
+			}
+			next[node_index.index()] = sum;
+		}
+		std::mem::swap(&mut walk, &mut next);
+		for node_index in nodes {
+			let slot = node_index.index();
+			total[slot] = total[slot].saturating_add(walk[slot]);
+		}
+	}
+	nodes.iter().map(|node_index| total[node_index.index()]).collect()
+}
+
+/// Number of inbounds and cobounds found when flooring the graph from each node.
+fn bounds_columns(graph: &GraphWrap, nodes: &[NodeIndex]) -> (Vec<i64>, Vec<i64>) {
+	let bound = graph.graph.node_bound();
+	let mut floors: Vec<Option<u32>> = vec![None; bound];
+	let mut queue: VecDeque<NodeIndex> = VecDeque::with_capacity(nodes.len());
+	let mut inbounds = Vec::with_capacity(nodes.len());
+	let mut cobounds = Vec::with_capacity(nodes.len());
+
+	for root in nodes {
+		floors.iter_mut().for_each(|floor| *floor = None);
+		floors[root.index()] = Some(0);
+		queue.push_back(*root);
+		while let Some(current) = queue.pop_front() {
+			let next_floor = floors[current.index()].map(|floor| floor + 1);
+			for neighbor in graph.graph.neighbors(current) {
+				if floors[neighbor.index()].is_none() {
+					floors[neighbor.index()] = next_floor;
+					queue.push_back(neighbor);
+				}
+			}
+		}
+
+		let mut cobound_count = 0i64;
+		for edge_index in graph.graph.edge_indices() {
+			if let Some((a, b)) = graph.graph.edge_endpoints(edge_index) {
+				let floor_a = floors[a.index()];
+				if floor_a.is_some() && floor_a == floors[b.index()] {
+					cobound_count += 1;
+				}
+			}
+		}
+
+		let mut inbound_count = 0i64;
+		for node_index in nodes {
+			let floor = match floors[node_index.index()] {
+				Some(floor) => floor,
+				None => continue,
+			};
+			let upstairs = graph
+				.graph
+				.neighbors(*node_index)
+				.filter(|neighbor| matches!(floors[neighbor.index()], Some(other) if other < floor))
+				.count();
+			if upstairs > 1 {
+				inbound_count += 1;
+			}
+		}
+
+		inbounds.push(inbound_count);
+		cobounds.push(cobound_count);
+	}
+
+	(inbounds, cobounds)
+}
+
+/// Size of each node's stable colour class, and the colour itself.
+fn refine_columns(graph: &GraphWrap, nodes: &[NodeIndex]) -> (Vec<i64>, Vec<i64>) {
+	let colours = stable_colours(graph, nodes);
+	let mut sizes = vec![0i64; nodes.len()];
+	for colour in &colours {
+		sizes[*colour] += 1;
+	}
+	let class_sizes = colours.iter().map(|colour| sizes[*colour]).collect();
+	let colours = colours.into_iter().map(|colour| colour as i64).collect();
+	(class_sizes, colours)
+}
+
+/// Iterated colour refinement (1-WL) over labels and edge modalities.
+///
+/// Colours start as label ranks. Each round recolours a node by its own
+/// colour plus the sorted multiset of `(modality, neighbour colour)` pairs,
+/// until the number of classes stops growing. Colours are ranks of sorted
+/// signatures, so they do not depend on node ids or insertion order.
+pub fn stable_colours(graph: &GraphWrap, nodes: &[NodeIndex]) -> Vec<usize> {
+	let mut colour = vec![0usize; graph.graph.node_bound()];
+
+	let mut labels: Vec<&str> = nodes
+		.iter()
+		.map(|node_index| graph.graph[*node_index].label.as_str())
+		.collect();
+	labels.sort_unstable();
+	labels.dedup();
+	for node_index in nodes {
+		let label = graph.graph[*node_index].label.as_str();
+		colour[node_index.index()] = labels.binary_search(&label).unwrap_or(0);
+	}
+	let mut classes = labels.len();
+
+	loop {
+		let signatures: Vec<(usize, Vec<(&str, usize)>)> = nodes
+			.iter()
+			.map(|node_index| {
+				let mut neighbourhood: Vec<(&str, usize)> = graph
+					.graph
+					.edges(*node_index)
+					.map(|edge| {
+						let other = if edge.source() == *node_index {
+							edge.target()
+						} else {
+							edge.source()
+						};
+						(edge.weight().modality.as_str(), colour[other.index()])
+					})
+					.collect();
+				neighbourhood.sort_unstable();
+				(colour[node_index.index()], neighbourhood)
+			})
+			.collect();
+
+		let mut ranks: Vec<&(usize, Vec<(&str, usize)>)> = signatures.iter().collect();
+		ranks.sort_unstable();
+		ranks.dedup();
+		if ranks.len() == classes {
+			break;
+		}
+		classes = ranks.len();
+		for (node_index, signature) in nodes.iter().zip(&signatures) {
+			colour[node_index.index()] = ranks.binary_search(&signature).unwrap_or(0);
+		}
+	}
+
+	nodes.iter().map(|node_index| colour[node_index.index()]).collect()
+}
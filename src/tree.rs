@@ -1,165 +1,681 @@
+use std::cmp::Ordering;
 use std::collections::HashMap;
 use std::collections::HashSet;
+use std::fmt::{self, Write as _};
 use std::sync::Arc;
 
 use petgraph::graph::NodeIndex;
+use petgraph::visit::NodeIndexable;
+use xxhash_rust::xxh3::xxh3_128;
 
-use crate::graph::GraphWrap;
+use crate::dag::SharedDag;
+use crate::graph::{GraphWrap, Magnet, NodeSet};
+
+#[cfg(feature = "parallel")]
+use rayon::prelude::*;
+
+/// One subtree of a tree string, kept as structure instead of text.
+///
+/// A leaf renders as its label, any other node as
+/// `(child:modality, ...)label` with its children in canonical order.
+/// Subtrees are hash-consed: within one build, equal subtrees share one
+/// `Tree`, and `hash` is a 128-bit Merkle hash of the structure, so equal
+/// subtrees from different builds are recognised without walking them.
+#[derive(Debug)]
+pub struct TreeNode {
+	label: String,
+	leaf: bool,
+	children: Vec<(Arc<str>, Tree)>,
+	depth: i32,
+	len: usize,
+	hash: u128,
+}
+
+pub type Tree = Arc<TreeNode>;
+
+impl TreeNode {
+	pub fn depth(&self) -> i32 {
+		self.depth
+	}
+
+	/// Length in bytes of the tree string.
+	pub fn len(&self) -> usize {
+		self.len
+	}
+
+	pub fn is_empty(&self) -> bool {
+		self.len == 0
+	}
+
+	pub fn hash(&self) -> u128 {
+		self.hash
+	}
+
+	/// Stream the tree string into `sink`, in order, without building it.
+	/// The pieces are borrowed from the tree itself.
+	pub fn write<'t>(&'t self, sink: &mut impl FnMut(&'t [u8])) {
+		let mut cursor = Cursor::new(self);
+		while let Some(piece) = cursor.next() {
+			match piece {
+				Piece::Bytes(bytes) => {
+					if !bytes.is_empty() {
+						sink(bytes);
+					}
+				}
+				Piece::Tree(tree) => cursor.enter(tree),
+			}
+		}
+	}
+
+	pub fn render(&self) -> String {
+		let mut out = Vec::with_capacity(self.len);
+		self.write(&mut |bytes| out.extend_from_slice(bytes));
+		String::from_utf8(out).unwrap_or_else(|err| String::from_utf8_lossy(err.as_bytes()).into_owned())
+	}
+
+	/// The `step`-th piece of this node's tree string.
+	fn piece(&self, step: usize) -> Option<Piece<'_>> {
+		if self.leaf {
+			return (step == 0).then(|| Piece::Bytes(self.label.as_bytes()));
+		}
+		let body = 4 * self.children.len();
+		match step {
+			0 => Some(Piece::Bytes(b"(")),
+			step if step <= body => {
+				let (child, part) = ((step - 1) / 4, (step - 1) % 4);
+				let (modality, tree) = &self.children[child];
+				Some(match part {
+					0 if child == 0 => Piece::Bytes(b""),
+					0 => Piece::Bytes(b", "),
+					1 => Piece::Tree(tree),
+					2 => Piece::Bytes(b":"),
+					_ => Piece::Bytes(modality.as_bytes()),
+				})
+			}
+			step if step == body + 1 => Some(Piece::Bytes(b")")),
+			step if step == body + 2 => Some(Piece::Bytes(self.label.as_bytes())),
+			_ => None,
+		}
+	}
+}
+
+impl fmt::Display for TreeNode {
+	fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+		f.write_str(&self.render())
+	}
+}
+
+enum Piece<'t> {
+	Bytes(&'t [u8]),
+	Tree(&'t TreeNode),
+}
+
+/// Walks the pieces of a tree string. A `Piece::Tree` is only expanded if
+/// the caller `enter`s it, so equal subtrees can be stepped over.
+struct Cursor<'t> {
+	start: Option<&'t TreeNode>,
+	stack: Vec<(&'t TreeNode, usize)>,
+}
+
+impl<'t> Cursor<'t> {
+	fn new(tree: &'t TreeNode) -> Self {
+		Self {
+			start: Some(tree),
+			stack: Vec::with_capacity(tree.depth.max(1) as usize),
+		}
+	}
+
+	fn next(&mut self) -> Option<Piece<'t>> {
+		if let Some(tree) = self.start.take() {
+			return Some(Piece::Tree(tree));
+		}
+		while let Some((tree, step)) = self.stack.last_mut() {
+			let tree: &'t TreeNode = tree;
+			let piece = tree.piece(*step);
+			*step += 1;
+			match piece {
+				Some(piece) => return Some(piece),
+				None => {
+					self.stack.pop();
+				}
+			}
+		}
+		None
+	}
+
+	fn enter(&mut self, tree: &'t TreeNode) {
+		self.stack.push((tree, 0));
+	}
+
+	/// Next non-empty run of bytes, starting from `piece`.
+	fn bytes(&mut self, mut piece: Option<Piece<'t>>) -> Option<&'t [u8]> {
+		loop {
+			match piece? {
+				Piece::Bytes(bytes) if !bytes.is_empty() => return Some(bytes),
+				Piece::Bytes(_) => {}
+				Piece::Tree(tree) => self.enter(tree),
+			}
+			piece = self.next();
+		}
+	}
+}
+
+fn same_tree(a: &TreeNode, b: &TreeNode) -> bool {
+	std::ptr::eq(a, b) || (a.hash == b.hash && a.len == b.len)
+}
+
+/// Order two trees as their tree strings would compare.
+///
+/// Both strings are streamed side by side; whenever both sides reach a
+/// subtree at the same offset and the subtrees are equal, it is skipped
+/// whole, so the cost is bounded by the structure that actually differs.
+pub fn cmp_trees(a: &TreeNode, b: &TreeNode) -> Ordering {
+	if same_tree(a, b) {
+		return Ordering::Equal;
+	}
+	if a.leaf && b.leaf {
+		return a.label.cmp(&b.label);
+	}
+	let mut left = Cursor::new(a);
+	let mut right = Cursor::new(b);
+	let mut left_bytes: &[u8] = &[];
+	let mut right_bytes: &[u8] = &[];
+	loop {
+		if left_bytes.is_empty() && right_bytes.is_empty() {
+			let (left_piece, right_piece) = (left.next(), right.next());
+			if let (Some(Piece::Tree(x)), Some(Piece::Tree(y))) = (&left_piece, &right_piece) {
+				if same_tree(x, y) {
+					continue;
+				}
+			}
+			match (left.bytes(left_piece), right.bytes(right_piece)) {
+				(None, None) => return Ordering::Equal,
+				(None, Some(_)) => return Ordering::Less,
+				(Some(_), None) => return Ordering::Greater,
+				(Some(x), Some(y)) => {
+					left_bytes = x;
+					right_bytes = y;
+				}
+			}
+		} else if left_bytes.is_empty() {
+			let piece = left.next();
+			match left.bytes(piece) {
+				Some(bytes) => left_bytes = bytes,
+				None => return Ordering::Less,
+			}
+		} else if right_bytes.is_empty() {
+			let piece = right.next();
+			match right.bytes(piece) {
+				Some(bytes) => right_bytes = bytes,
+				None => return Ordering::Greater,
+			}
+		}
+
+		let n = left_bytes.len().min(right_bytes.len());
+		match left_bytes[..n].cmp(&right_bytes[..n]) {
+			Ordering::Equal => {}
+			other => return other,
+		}
+		left_bytes = &left_bytes[n..];
+		right_bytes = &right_bytes[n..];
+	}
+}
+
+/// Hash-consing table for the trees of one build.
+///
+/// Nodes are looked up by label and child identity, so the Merkle hash is
+/// only computed once per distinct subtree.
+#[derive(Default)]
+struct TreeBuilder {
+	interned: HashMap<u128, Vec<Tree>>,
+	modalities: HashMap<String, Arc<str>>,
+	buffer: Vec<u8>,
+}
+
+impl TreeBuilder {
+	fn modality(&mut self, modality: &str) -> Arc<str> {
+		if let Some(existing) = self.modalities.get(modality) {
+			return existing.clone();
+		}
+		let arc: Arc<str> = Arc::from(modality);
+		self.modalities.insert(modality.to_string(), arc.clone());
+		arc
+	}
+
+	fn node(&mut self, label: String, leaf: bool, children: Vec<(Arc<str>, Tree)>) -> Tree {
+		let buffer = &mut self.buffer;
+		buffer.clear();
+		buffer.push(leaf as u8);
+		buffer.extend_from_slice(&(label.len() as u64).to_le_bytes());
+		buffer.extend_from_slice(label.as_bytes());
+		for (modality, child) in &children {
+			buffer.extend_from_slice(&(modality.len() as u64).to_le_bytes());
+			buffer.extend_from_slice(modality.as_bytes());
+			buffer.extend_from_slice(&child.hash.to_le_bytes());
+		}
+		let hash = xxh3_128(buffer);
+
+		let bucket = self.interned.entry(hash).or_default();
+		for existing in bucket.iter() {
+			let equal = existing.leaf == leaf
+				&& existing.label == label
+				&& existing.children.len() == children.len()
+				&& existing
+					.children
+					.iter()
+					.zip(&children)
+					.all(|((a_mod, a), (b_mod, b))| a_mod == b_mod && Arc::ptr_eq(a, b));
+			if equal {
+				return existing.clone();
+			}
+		}
+
+		let (depth, len) = if leaf {
+			(1, label.len())
+		} else {
+			let depth = 1 + children.iter().map(|(_, child)| child.depth).max().unwrap_or(0);
+			let mut len = 2 + label.len() + 2 * children.len().saturating_sub(1);
+			for (modality, child) in &children {
+				len += child.len + 1 + modality.len();
+			}
+			(depth, len)
+		};
+		let tree = Arc::new(TreeNode {
+			label,
+			leaf,
+			children,
+			depth,
+			len,
+			hash,
+		});
+		bucket.push(tree.clone());
+		tree
+	}
+}
 
 fn format_label(graph: &GraphWrap, node_index: NodeIndex) -> String {
 	let node = &graph.graph[node_index];
 	let label = node.label.as_str();
-	let magnet = node.meta.magnet.as_deref().unwrap_or("");
 	if node.meta.is_mirror {
 		let arity = node.meta.arity.unwrap_or(0);
-		let mut out = String::with_capacity(label.len() + magnet.len() + 8);
+		let mut out = String::with_capacity(label.len() + 48);
 		out.push_str(label);
 		out.push('#');
 		out.push_str(&arity.to_string());
-		out.push('{');
-		out.push_str(magnet);
-		out.push('}');
+		push_magnet(&mut out, node.meta.magnet.as_ref());
 		out
 	} else if node.meta.is_virtual {
-		let mut out = String::with_capacity(label.len() + magnet.len() + 4);
+		let mut out = String::with_capacity(label.len() + 80);
 		out.push_str(label);
 		out.push('*');
-		out.push('{');
-		out.push_str(magnet);
-		out.push('}');
+		push_magnet(&mut out, node.meta.magnet.as_ref());
 		out
 	} else {
 		label.to_string()
 	}
 }
 
+fn push_magnet(out: &mut String, magnet: Option<&Magnet>) {
+	out.push('{');
+	if let Some(magnet) = magnet {
+		let _ = write!(out, "{}", magnet);
+	}
+	out.push('}');
+}
+
+pub fn to_tree(graph: &GraphWrap, root_id: &str, ids_ignore: &NodeSet) -> Result<Tree, String> {
+	let root_index = root_index(graph, root_id)?;
+	build_tree(&mut TreeBuilder::default(), graph, root_index, None, ids_ignore, true, None)
+}
+
+/// Magnet tree of `root_id`: the tree below it that never enters a floor
+/// `<= floor`. Children are ordered without their modality.
+pub fn to_tree_for_magnet(graph: &GraphWrap, root_id: &str, floor: i32) -> Result<Tree, String> {
+	let root_index = root_index(graph, root_id)?;
+	MagnetTrees::default().tree(graph, root_index, floor)
+}
+
+/// Magnet trees of the nodes of one DAG rewrite.
+///
+/// Bounds are fixed from the deepest floor up, so once the magnets of a
+/// floor are asked for, the floors below it form a forest: every node hangs
+/// below its single upstairs neighbour. Subtrees are thus built bottom-up,
+/// keyed by node key, and every magnet above reuses them instead of walking
+/// the graph again.
+///
+/// A memoised subtree only depends on the nodes below it, so when a fix
+/// rewires a node, `invalidate` drops that node and its ancestors and
+/// nothing else. As every ancestor of a memoised subtree is built from it,
+/// that walk stops at the first node without one.
+#[derive(Default)]
+pub struct MagnetTrees {
+	builder: TreeBuilder,
+	subtrees: Vec<Option<Tree>>,
+}
+
+impl MagnetTrees {
+	/// Magnet tree of `root`, never entering a floor `<= floor`.
+	pub fn tree(&mut self, graph: &GraphWrap, root: NodeIndex, floor: i32) -> Result<Tree, String> {
+		self.reserve(graph);
+		build_magnet_tree(&mut self.builder, &mut self.subtrees, graph, root, floor)
+	}
+
+	/// Magnet trees of several `(root, floor)`, in order.
+	///
+	/// The roots of one floor hang over disjoint parts of the forest below
+	/// it, so with the `parallel` feature and a large enough DAG each one is
+	/// built on its own, against the subtrees memoised so far, and the
+	/// subtrees it built are memoised afterwards.
+	pub fn trees(&mut self, graph: &GraphWrap, roots: &[(NodeIndex, i32)]) -> Result<Vec<Tree>, String> {
+		#[cfg(feature = "parallel")]
+		{
+			if roots.len() > 1 && graph.graph.node_count() >= PARALLEL_MIN_NODES {
+				self.reserve(graph);
+				let base = self.subtrees.as_slice();
+				let built: Vec<(Tree, HashMap<usize, Tree>)> = roots
+					.par_iter()
+					.map(|&(root, floor)| {
+						let mut memo = SubtreeOverlay {
+							base,
+							built: HashMap::new(),
+						};
+						let tree = build_magnet_tree(&mut TreeBuilder::default(), &mut memo, graph, root, floor)?;
+						Ok((tree, memo.built))
+					})
+					.collect::<Result<_, String>>()?;
+				let mut trees = Vec::with_capacity(built.len());
+				for (tree, subtrees) in built {
+					for (key, subtree) in subtrees {
+						self.subtrees[key] = Some(subtree);
+					}
+					trees.push(tree);
+				}
+				return Ok(trees);
+			}
+			roots
+				.iter()
+				.map(|&(root, floor)| self.tree(graph, root, floor))
+				.collect()
+		}
+		#[cfg(not(feature = "parallel"))]
+		{
+			roots
+				.iter()
+				.map(|&(root, floor)| self.tree(graph, root, floor))
+				.collect()
+		}
+	}
+
+	/// Forget the subtrees depending on `node_index`, once its neighbours
+	/// changed.
+	pub fn invalidate(&mut self, graph: &GraphWrap, node_index: NodeIndex) {
+		let mut stack = vec![node_index];
+		while let Some(current) = stack.pop() {
+			let node = &graph.graph[current];
+			let memoised = self
+				.subtrees
+				.get_mut(node.key as usize)
+				.and_then(Option::take)
+				.is_some();
+			if !memoised && current != node_index {
+				continue;
+			}
+			let floor = node.meta.floor;
+			for neighbor in graph.graph.neighbors(current) {
+				if is_below(floor, graph.graph[neighbor].meta.floor) {
+					stack.push(neighbor);
+				}
+			}
+		}
+	}
+
+	fn reserve(&mut self, graph: &GraphWrap) {
+		if self.subtrees.len() < graph.key_bound() {
+			self.subtrees.resize(graph.key_bound(), None);
+		}
+	}
+}
+
+/// DAG size from which the magnets of a floor are built in parallel.
+#[cfg(feature = "parallel")]
+const PARALLEL_MIN_NODES: usize = 2048;
+
+/// Memoised magnet subtrees, by node key.
+trait SubtreeMemo {
+	fn get(&self, key: usize) -> Option<&Tree>;
+	fn set(&mut self, key: usize, tree: Tree);
+}
+
+impl SubtreeMemo for Vec<Option<Tree>> {
+	fn get(&self, key: usize) -> Option<&Tree> {
+		self[key].as_ref()
+	}
+
+	fn set(&mut self, key: usize, tree: Tree) {
+		self[key] = Some(tree);
+	}
+}
+
+/// Subtrees built by one of several magnets built at once, over the ones
+/// memoised before.
+#[cfg(feature = "parallel")]
+struct SubtreeOverlay<'a> {
+	base: &'a [Option<Tree>],
+	built: HashMap<usize, Tree>,
+}
+
+#[cfg(feature = "parallel")]
+impl SubtreeMemo for SubtreeOverlay<'_> {
+	fn get(&self, key: usize) -> Option<&Tree> {
+		self.built.get(&key).or_else(|| self.base[key].as_ref())
+	}
+
+	fn set(&mut self, key: usize, tree: Tree) {
+		self.built.insert(key, tree);
+	}
+}
+
+fn build_magnet_tree(
+	builder: &mut TreeBuilder,
+	memo: &mut impl SubtreeMemo,
+	graph: &GraphWrap,
+	root: NodeIndex,
+	floor: i32,
+) -> Result<Tree, String> {
+	let mut stack = vec![(root, false)];
+	while let Some((node_index, expanded)) = stack.pop() {
+		let threshold = if node_index == root {
+			Some(floor)
+		} else {
+			graph.graph[node_index].meta.floor
+		};
+		if expanded {
+			let tree = magnet_node(builder, memo, graph, node_index, threshold, node_index != root)?;
+			if node_index == root {
+				return Ok(tree);
+			}
+			memo.set(graph.graph[node_index].key as usize, tree);
+			continue;
+		}
+		stack.push((node_index, true));
+		for neighbor in graph.graph.neighbors(node_index) {
+			let neighbor_node = &graph.graph[neighbor];
+			if is_below(neighbor_node.meta.floor, threshold) && memo.get(neighbor_node.key as usize).is_none() {
+				stack.push((neighbor, false));
+			}
+		}
+	}
+	Err("failed to build magnet tree".to_string())
+}
+
+/// Tree of `node_index` over the already built subtrees of its children.
+fn magnet_node(
+	builder: &mut TreeBuilder,
+	memo: &impl SubtreeMemo,
+	graph: &GraphWrap,
+	node_index: NodeIndex,
+	threshold: Option<i32>,
+	has_parent: bool,
+) -> Result<Tree, String> {
+	let label = format_label(graph, node_index);
+	if has_parent && degree(graph, node_index) == 1 {
+		return Ok(builder.node(label, true, Vec::new()));
+	}
+
+	let offset = graph.graph[node_index].meta.shared.is_some() as usize;
+	let mut children: Vec<(usize, &str, Tree)> = Vec::new();
+	for (position, neighbor) in graph.graph.neighbors(node_index).enumerate() {
+		let neighbor_node = &graph.graph[neighbor];
+		if !is_below(neighbor_node.meta.floor, threshold) {
+			continue;
+		}
+		let modality = graph
+			.graph
+			.find_edge(node_index, neighbor)
+			.and_then(|edge_index| graph.graph.edge_weight(edge_index))
+			.map(|edge| edge.modality.as_str())
+			.unwrap_or("1");
+		let child = match memo.get(neighbor_node.key as usize) {
+			Some(child) => child.clone(),
+			None => builder.node("?".to_string(), true, Vec::new()),
+		};
+		children.push((position + offset, modality, child));
+	}
+	if let Some(shared) = graph.graph[node_index].meta.shared.as_deref() {
+		children.push((0, "1", shared_tree(shared, false)?));
+	}
+	children.sort_by(|(a_pos, _, a), (b_pos, _, b)| {
+		a.depth
+			.cmp(&b.depth)
+			.then_with(|| cmp_trees(a, b))
+			.then_with(|| a_pos.cmp(b_pos))
+	});
+
+	let children = children
+		.into_iter()
+		.map(|(_, modality, child)| (builder.modality(modality), child))
+		.collect();
+	Ok(builder.node(label, false, children))
+}
+
+/// Whether a neighbour on `floor` hangs below a node whose children must lie
+/// on floors above `threshold`.
+fn is_below(floor: Option<i32>, threshold: Option<i32>) -> bool {
+	matches!((floor, threshold), (Some(floor), Some(threshold)) if floor > threshold)
+}
+
 pub fn to_tree_string(
 	graph: &GraphWrap,
 	root_id: &str,
-	ids_ignore: &HashSet<String>,
+	ids_ignore: &NodeSet,
 ) -> Result<String, String> {
-	let (tree, _depth) = to_tree_string_with_depth_order(graph, root_id, ids_ignore, true)?;
-	Ok(tree)
+	Ok(to_tree(graph, root_id, ids_ignore)?.render())
 }
 
 pub fn to_tree_string_for_magnet(
 	graph: &GraphWrap,
 	root_id: &str,
-	ids_ignore: &HashSet<String>,
+	floor: i32,
 ) -> Result<String, String> {
-	let (tree, _depth) = to_tree_string_with_depth_order(graph, root_id, ids_ignore, false)?;
-	Ok(tree)
+	Ok(to_tree_for_magnet(graph, root_id, floor)?.render())
 }
 
 pub fn to_tree_string_with_depth(
 	graph: &GraphWrap,
 	root_id: &str,
-	ids_ignore: &HashSet<String>,
+	ids_ignore: &NodeSet,
 ) -> Result<(String, i32), String> {
-	to_tree_string_with_depth_order(graph, root_id, ids_ignore, true)
+	let tree = to_tree(graph, root_id, ids_ignore)?;
+	Ok((tree.render(), tree.depth))
 }
 
-fn to_tree_string_with_depth_order(
-	graph: &GraphWrap,
-	root_id: &str,
-	ids_ignore: &HashSet<String>,
-	include_modality: bool,
-) -> Result<(String, i32), String> {
-	let root_index = graph
+fn root_index(graph: &GraphWrap, root_id: &str) -> Result<NodeIndex, String> {
+	graph
 		.node_index(root_id)
-		.ok_or_else(|| format!("unknown root id '{}'", root_id))?;
+		.ok_or_else(|| format!("unknown root id '{}'", root_id))
+}
 
+/// Tree below `root_index`, entered from `root_parent`.
+///
+/// Children are ordered by `(depth, modality, tree string)`, or by
+/// `(depth, tree string)` without `include_modality`, then by neighbour
+/// position. When `sorted_children` is given, it receives the ordered
+/// children of every expanded node; a node listed among its own children
+/// stands for its shared sub-DAG.
+fn build_tree(
+	builder: &mut TreeBuilder,
+	graph: &GraphWrap,
+	root_index: NodeIndex,
+	root_parent: Option<NodeIndex>,
+	ids_ignore: &NodeSet,
+	include_modality: bool,
+	mut sorted_children: Option<&mut Vec<Vec<NodeIndex>>>,
+) -> Result<Tree, String> {
 	let node_count = graph.graph.node_count();
-	let mut visited: HashSet<NodeIndex> = HashSet::with_capacity(node_count);
-	let mut out: HashMap<NodeIndex, (Arc<str>, i32)> = HashMap::with_capacity(node_count);
-	let mut intern: HashMap<Arc<str>, Arc<str>> = HashMap::with_capacity(node_count);
-	let mut stack: Vec<(NodeIndex, Option<NodeIndex>, bool, Vec<(usize, NodeIndex, String)>)> =
+	let node_bound = graph.graph.node_bound();
+	let mut visited = vec![false; node_bound];
+	let mut out: Vec<Option<Tree>> = vec![None; node_bound];
+	let mut stack: Vec<(NodeIndex, Option<NodeIndex>, bool, Vec<(usize, NodeIndex, &str)>)> =
 		Vec::with_capacity(node_count);
 
-	stack.push((root_index, None, false, Vec::new()));
+	stack.push((root_index, root_parent, false, Vec::new()));
 
 	while let Some((node_index, parent, expanded, mut children)) = stack.pop() {
 		if expanded {
 			let label = format_label(graph, node_index);
-			let is_leaf = parent.is_some() && graph.graph.neighbors(node_index).count() == 1;
+			let is_leaf = parent.is_some() && degree(graph, node_index) == 1;
 			if is_leaf {
-				let arc = interned_arc(&mut intern, label);
-				out.insert(node_index, (arc, 1));
+				out[node_index.index()] = Some(builder.node(label, true, Vec::new()));
 				continue;
 			}
 
-			let mut child_outputs: Vec<(usize, NodeIndex, String, i32, Arc<str>)> =
-				Vec::with_capacity(children.len());
+			let mut child_outputs: Vec<(usize, NodeIndex, &str, Tree)> =
+				Vec::with_capacity(children.len() + 1);
 			for (position, child_index, modality) in &children {
-				let (child_str, child_depth) = match out.get(child_index) {
-					Some((value, depth)) => (value.clone(), *depth),
-					None => (Arc::<str>::from("?"), 1),
+				let child = match &out[child_index.index()] {
+					Some(child) => child.clone(),
+					None => builder.node("?".to_string(), true, Vec::new()),
 				};
-				child_outputs.push((*position, *child_index, modality.clone(), child_depth, child_str));
+				child_outputs.push((*position, *child_index, *modality, child));
+			}
+			if let Some(shared) = graph.graph[node_index].meta.shared.as_deref() {
+				child_outputs.push((0, node_index, "1", shared_tree(shared, include_modality)?));
 			}
 			if include_modality {
-				child_outputs.sort_by(
-					|(a_pos, _a_idx, a_mod, a_depth, a_str),
-					  (b_pos, _b_idx, b_mod, b_depth, b_str)| {
-						let key_a = (*a_depth, a_mod, a_str);
-						let key_b = (*b_depth, b_mod, b_str);
-						key_a.cmp(&key_b).then_with(|| a_pos.cmp(b_pos))
-					},
-				);
+				child_outputs.sort_by(|(a_pos, _, a_mod, a), (b_pos, _, b_mod, b)| {
+					a.depth
+						.cmp(&b.depth)
+						.then_with(|| a_mod.cmp(b_mod))
+						.then_with(|| cmp_trees(a, b))
+						.then_with(|| a_pos.cmp(b_pos))
+				});
 			} else {
-				child_outputs.sort_by(
-					|(a_pos, _a_idx, _a_mod, a_depth, a_str),
-					  (b_pos, _b_idx, _b_mod, b_depth, b_str)| {
-						let key_a = (*a_depth, a_str);
-						let key_b = (*b_depth, b_str);
-						key_a.cmp(&key_b).then_with(|| a_pos.cmp(b_pos))
-					},
-				);
+				child_outputs.sort_by(|(a_pos, _, _, a), (b_pos, _, _, b)| {
+					a.depth
+						.cmp(&b.depth)
+						.then_with(|| cmp_trees(a, b))
+						.then_with(|| a_pos.cmp(b_pos))
+				});
 			}
 
-			let node_str = build_node_string(&label, &child_outputs);
-			let depth = if child_outputs.is_empty() {
-				1
-			} else {
-				1 + child_outputs
-					.iter()
-					.map(|(_, _, _, depth, _)| *depth)
-					.max()
-					.unwrap_or(0)
-			};
-			let arc = interned_arc(&mut intern, node_str);
-			out.insert(node_index, (arc, depth));
+			if let Some(sorted_children) = sorted_children.as_deref_mut() {
+				sorted_children[node_index.index()] =
+					child_outputs.iter().map(|(_, child_index, _, _)| *child_index).collect();
+			}
+			let children = child_outputs
+				.into_iter()
+				.map(|(_, _, modality, child)| (builder.modality(modality), child))
+				.collect();
+			out[node_index.index()] = Some(builder.node(label, false, children));
 			continue;
 		}
 
-		if visited.contains(&node_index) {
+		if visited[node_index.index()] {
 			continue;
 		}
-		visited.insert(node_index);
+		visited[node_index.index()] = true;
 
-		for (position, neighbor) in graph.graph.neighbors(node_index).enumerate() {
-			if Some(neighbor) == parent {
-				continue;
-			}
-			let neighbor_id = match graph.graph.node_weight(neighbor) {
-				Some(node) => node.id.as_str(),
-				None => continue,
-			};
-			if neighbor_id != root_id && ids_ignore.contains(neighbor_id) {
-				continue;
-			}
-			if visited.contains(&neighbor) {
-				continue;
-			}
-			let modality = graph
-				.graph
-				.find_edge(node_index, neighbor)
-				.and_then(|edge_index| graph.graph.edge_weight(edge_index))
-				.map(|edge| edge.modality.as_str())
-				.unwrap_or("1")
-				.to_string();
-			children.push((position, neighbor, modality));
-		}
+		collect_children(graph, node_index, parent, root_index, ids_ignore, &visited, &mut children);
 
 		let mut child_nodes: Vec<NodeIndex> = Vec::with_capacity(children.len());
 		for (_, child, _) in &children {
@@ -171,18 +687,73 @@ fn to_tree_string_with_depth_order(
 		}
 	}
 
-	out.get(&root_index)
-		.map(|(tree, depth)| (tree.to_string(), *depth))
+	out[root_index.index()]
+		.take()
 		.ok_or_else(|| "failed to build tree string".to_string())
 }
 
-fn interned_arc(intern: &mut HashMap<Arc<str>, Arc<str>>, value: String) -> Arc<str> {
-	if let Some(existing) = intern.get(value.as_str()) {
-		return existing.clone();
+/// Tree of `shared` below its mirror, built on first use.
+fn shared_tree(shared: &SharedDag, include_modality: bool) -> Result<Tree, String> {
+	let cache = if include_modality { &shared.tree } else { &shared.magnet_tree };
+	if let Some(tree) = cache.get() {
+		return Ok(tree.clone());
+	}
+	let tree = build_tree(
+		&mut TreeBuilder::default(),
+		&shared.graph,
+		shared.root,
+		Some(shared.stub),
+		&NodeSet::new(),
+		include_modality,
+		None,
+	)?;
+	Ok(cache.get_or_init(|| tree).clone())
+}
+
+/// Children of `node_index` in the traversal rooted at `root_index`, as
+/// `(neighbour position, child, modality)`.
+fn collect_children<'g>(
+	graph: &'g GraphWrap,
+	node_index: NodeIndex,
+	parent: Option<NodeIndex>,
+	root_index: NodeIndex,
+	ids_ignore: &NodeSet,
+	visited: &[bool],
+	children: &mut Vec<(usize, NodeIndex, &'g str)>,
+) {
+	// The link to a shared sub-DAG is the last edge added to its mirror, so it
+	// comes first among the mirror's neighbours.
+	let offset = graph.graph[node_index].meta.shared.is_some() as usize;
+	for (position, neighbor) in graph.graph.neighbors(node_index).enumerate() {
+		let position = position + offset;
+		if Some(neighbor) == parent {
+			continue;
+		}
+		let neighbor_key = match graph.graph.node_weight(neighbor) {
+			Some(node) => node.key,
+			None => continue,
+		};
+		if neighbor != root_index && ids_ignore.contains(neighbor_key) {
+			continue;
+		}
+		if visited[neighbor.index()] {
+			continue;
+		}
+		let modality = graph
+			.graph
+			.find_edge(node_index, neighbor)
+			.and_then(|edge_index| graph.graph.edge_weight(edge_index))
+			.map(|edge| edge.modality.as_str())
+			.unwrap_or("1");
+		children.push((position, neighbor, modality));
 	}
-	let arc: Arc<str> = Arc::from(value);
-	intern.insert(arc.clone(), arc.clone());
-	arc
+}
+
+/// Number of neighbours of `node_index`, counting the link to its shared
+/// sub-DAG if it has one.
+fn degree(graph: &GraphWrap, node_index: NodeIndex) -> usize {
+	let node = &graph.graph[node_index];
+	graph.graph.neighbors(node_index).count() + node.meta.shared.is_some() as usize
 }
 
 /// Return the canonical DFS traversal order of original node IDs.
@@ -190,118 +761,50 @@ fn interned_arc(intern: &mut HashMap<Arc<str>, Arc<str>>, value: String) -> Arc<
 pub fn to_tree_node_order(
 	graph: &GraphWrap,
 	root_id: &str,
-	ids_ignore: &HashSet<String>,
+	ids_ignore: &NodeSet,
 ) -> Result<Vec<String>, String> {
-	let root_index = graph
-		.node_index(root_id)
-		.ok_or_else(|| format!("unknown root id '{}'", root_id))?;
+	let root_index = root_index(graph, root_id)?;
+	render_order(graph, root_index, None, ids_ignore)
+}
 
+fn render_order(
+	graph: &GraphWrap,
+	root_index: NodeIndex,
+	root_parent: Option<NodeIndex>,
+	ids_ignore: &NodeSet,
+) -> Result<Vec<String>, String> {
 	let node_count = graph.graph.node_count();
-	let mut visited: HashSet<NodeIndex> = HashSet::with_capacity(node_count);
-	let mut out: HashMap<NodeIndex, (Arc<str>, i32)> = HashMap::with_capacity(node_count);
-	let mut intern: HashMap<Arc<str>, Arc<str>> = HashMap::with_capacity(node_count);
-	// We collect (node_index, sorted_child_indices) for each expanded node
-	let mut sorted_children_map: HashMap<NodeIndex, Vec<NodeIndex>> = HashMap::with_capacity(node_count);
-	let mut stack: Vec<(NodeIndex, Option<NodeIndex>, bool, Vec<(usize, NodeIndex, String)>)> =
-		Vec::with_capacity(node_count);
-
-	stack.push((root_index, None, false, Vec::new()));
-
-	while let Some((node_index, parent, expanded, mut children)) = stack.pop() {
-		if expanded {
-			let label = format_label(graph, node_index);
-			let is_leaf = parent.is_some() && graph.graph.neighbors(node_index).count() == 1;
-			if is_leaf {
-				let arc = interned_arc(&mut intern, label);
-				out.insert(node_index, (arc, 1));
-				sorted_children_map.insert(node_index, Vec::new());
-				continue;
-			}
-
-			let mut child_outputs: Vec<(usize, NodeIndex, String, i32, Arc<str>)> =
-				Vec::with_capacity(children.len());
-			for (position, child_index, modality) in &children {
-				let (child_str, child_depth) = match out.get(child_index) {
-					Some((value, depth)) => (value.clone(), *depth),
-					None => (Arc::<str>::from("?"), 1),
-				};
-				child_outputs.push((*position, *child_index, modality.clone(), child_depth, child_str));
-			}
-			child_outputs.sort_by(
-				|(a_pos, _a_idx, a_mod, a_depth, a_str),
-				  (b_pos, _b_idx, b_mod, b_depth, b_str)| {
-					let key_a = (*a_depth, a_mod, a_str);
-					let key_b = (*b_depth, b_mod, b_str);
-					key_a.cmp(&key_b).then_with(|| a_pos.cmp(b_pos))
-				},
-			);
-
-			let sorted_child_indices: Vec<NodeIndex> = child_outputs.iter().map(|(_, idx, _, _, _)| *idx).collect();
-			sorted_children_map.insert(node_index, sorted_child_indices);
-
-			let node_str = build_node_string(&label, &child_outputs);
-			let depth = if child_outputs.is_empty() {
-				1
-			} else {
-				1 + child_outputs
-					.iter()
-					.map(|(_, _, _, depth, _)| *depth)
-					.max()
-					.unwrap_or(0)
-			};
-			let arc = interned_arc(&mut intern, node_str);
-			out.insert(node_index, (arc, depth));
-			continue;
-		}
-
-		if visited.contains(&node_index) {
-			continue;
-		}
-		visited.insert(node_index);
-
-		for (position, neighbor) in graph.graph.neighbors(node_index).enumerate() {
-			if Some(neighbor) == parent {
-				continue;
-			}
-			let neighbor_id = match graph.graph.node_weight(neighbor) {
-				Some(node) => node.id.as_str(),
-				None => continue,
-			};
-			if neighbor_id != root_id && ids_ignore.contains(neighbor_id) {
-				continue;
-			}
-			if visited.contains(&neighbor) {
-				continue;
-			}
-			let modality = graph
-				.graph
-				.find_edge(node_index, neighbor)
-				.and_then(|edge_index| graph.graph.edge_weight(edge_index))
-				.map(|edge| edge.modality.as_str())
-				.unwrap_or("1")
-				.to_string();
-			children.push((position, neighbor, modality));
-		}
-
-		let mut child_nodes: Vec<NodeIndex> = Vec::with_capacity(children.len());
-		for (_, child, _) in &children {
-			child_nodes.push(*child);
-		}
-		stack.push((node_index, parent, true, children));
-		for child in child_nodes.into_iter().rev() {
-			stack.push((child, Some(node_index), false, Vec::new()));
-		}
-	}
+	// We collect the sorted child indices of each expanded node
+	let mut sorted_children_map: Vec<Vec<NodeIndex>> = vec![Vec::new(); graph.graph.node_bound()];
+	build_tree(
+		&mut TreeBuilder::default(),
+		graph,
+		root_index,
+		root_parent,
+		ids_ignore,
+		true,
+		Some(&mut sorted_children_map),
+	)?;
 
 	// DFS over sorted_children_map to produce canonical order.
 	// Mirror and virtual nodes are excluded.
-	// Duplicated nodes in the DAG have IDs like "13@#m0_1";
-	// we extract the original ID (part before '@') and deduplicate.
+	// Duplicated nodes appear once per mirror, under their original ID
+	// (the part before any '@'); only the first occurrence is kept.
 	let mut order = Vec::with_capacity(node_count);
 	let mut seen = HashSet::with_capacity(node_count);
-	let mut dfs_stack = vec![root_index];
-	while let Some(node_index) = dfs_stack.pop() {
+	let mut dfs_stack = vec![(root_index, false)];
+	while let Some((node_index, into_shared)) = dfs_stack.pop() {
 		let node = &graph.graph[node_index];
+		if into_shared {
+			if let Some(shared) = node.meta.shared.as_deref() {
+				for original_id in shared_order(shared)? {
+					if seen.insert(original_id.clone()) {
+						order.push(original_id.clone());
+					}
+				}
+			}
+			continue;
+		}
 		if !node.meta.is_mirror && !node.meta.is_virtual {
 			let original_id = if let Some(pos) = node.id.find('@') {
 				node.id[..pos].to_string()
@@ -312,40 +815,184 @@ pub fn to_tree_node_order(
 				order.push(original_id);
 			}
 		}
-		if let Some(children) = sorted_children_map.get(&node_index) {
-			for child in children.iter().rev() {
-				dfs_stack.push(*child);
-			}
+		for child in sorted_children_map[node_index.index()].iter().rev() {
+			dfs_stack.push((*child, *child == node_index));
 		}
 	}
 
 	Ok(order)
 }
 
-fn build_node_string(
-	label: &str,
-	children: &[(usize, NodeIndex, String, i32, Arc<str>)],
-) -> String {
-	let mut capacity = label.len() + 2;
-	if !children.is_empty() {
-		for (idx, (_, _, modality, _, child_str)) in children.iter().enumerate() {
-			if idx > 0 {
-				capacity += 2;
+fn shared_order(shared: &SharedDag) -> Result<&[String], String> {
+	if shared.order.get().is_none() {
+		let order = render_order(&shared.graph, shared.root, Some(shared.stub), &NodeSet::new())?;
+		let _ = shared.order.set(order);
+	}
+	Ok(shared.order.get().map(Vec::as_slice).unwrap_or_default())
+}
+
+#[cfg(test)]
+mod tests {
+	use super::*;
+	use crate::dag::{to_dag_with_mode, InboundMode};
+	use crate::digest::DigestAlgorithm;
+
+	fn rng(seed: u64) -> impl FnMut(usize) -> usize {
+		let mut state = seed;
+		move |bound: usize| {
+			state = state.wrapping_mul(6364136223846793005).wrapping_add(1442695040888963407);
+			((state >> 33) as usize) % bound
+		}
+	}
+
+	/// The tree string of `tree`, spelled out from its structure.
+	fn spelled(tree: &TreeNode) -> String {
+		if tree.leaf {
+			return tree.label.clone();
+		}
+		let children: Vec<String> = tree
+			.children
+			.iter()
+			.map(|(modality, child)| format!("{}:{}", spelled(child), modality))
+			.collect();
+		format!("({}){}", children.join(", "), tree.label)
+	}
+
+	/// `tree` and all its subtrees, each distinct `Tree` once.
+	fn subtrees(tree: &Tree, out: &mut Vec<Tree>) {
+		if out.iter().any(|seen| Arc::ptr_eq(seen, tree)) {
+			return;
+		}
+		out.push(tree.clone());
+		for (_, child) in &tree.children {
+			subtrees(child, out);
+		}
+	}
+
+	/// Pseudo-random tree built straight through `builder`. Labels and
+	/// modalities are prefixes of one another, and children are drawn from
+	/// the subtrees built so far, so siblings are often equal.
+	fn random_tree(builder: &mut TreeBuilder, seed: u64, size: usize) -> Tree {
+		const LABELS: [&str; 5] = ["", "A", "AB", "B", "*{$1}"];
+		const MODALITIES: [&str; 3] = ["1", "12", "2"];
+		let mut next = rng(seed);
+		let mut built: Vec<Tree> = Vec::new();
+		for _ in 0..size {
+			let label = LABELS[next(LABELS.len())].to_string();
+			let tree = if built.is_empty() || next(3) == 0 {
+				builder.node(label, true, Vec::new())
+			} else {
+				let children = (0..1 + next(3))
+					.map(|_| {
+						let modality = builder.modality(MODALITIES[next(MODALITIES.len())]);
+						(modality, built[next(built.len())].clone())
+					})
+					.collect();
+				builder.node(label, false, children)
+			};
+			built.push(tree);
+		}
+		built.pop().unwrap()
+	}
+
+	/// Pseudo-random connected graph with labels and modalities that are
+	/// prefixes of one another.
+	fn random_graph(seed: u64, size: usize) -> GraphWrap {
+		let mut next = rng(seed);
+		let mut graph = GraphWrap::new();
+		for i in 0..size {
+			graph.ensure_node(&i.to_string(), ["C", "CC", "O"][next(3)]);
+		}
+		let modality = |next: &mut dyn FnMut(usize) -> usize| ["1", "1", "12", "2"][next(4)];
+		for i in 1..size {
+			let parent = next(i);
+			let m = modality(&mut next);
+			graph.add_edge_with_modality(&parent.to_string(), &i.to_string(), m);
+		}
+		for _ in 0..size / 3 {
+			let (a, b) = (next(size).to_string(), next(size).to_string());
+			let (a_index, b_index) = (graph.node_index(&a).unwrap(), graph.node_index(&b).unwrap());
+			if a != b && graph.graph.find_edge(a_index, b_index).is_none() {
+				let m = modality(&mut next);
+				graph.add_edge_with_modality(&a, &b, m);
+			}
+		}
+		graph
+	}
+
+	fn written(tree: &TreeNode) -> Vec<u8> {
+		let mut out = Vec::new();
+		tree.write(&mut |bytes| out.extend_from_slice(bytes));
+		out
+	}
+
+	fn check_strings(trees: &[Tree]) {
+		for tree in trees {
+			let spelled = spelled(tree);
+			assert_eq!(tree.render(), spelled);
+			assert_eq!(written(tree), spelled.as_bytes());
+			assert_eq!(tree.len(), spelled.len());
+		}
+	}
+
+	fn check_order(trees: &[Tree]) {
+		let rendered: Vec<String> = trees.iter().map(|tree| tree.render()).collect();
+		for (a, a_str) in trees.iter().zip(&rendered) {
+			for (b, b_str) in trees.iter().zip(&rendered) {
+				assert_eq!(cmp_trees(a, b), a_str.cmp(b_str), "{} vs {}", a_str, b_str);
 			}
-			capacity += child_str.len() + 1 + modality.len();
 		}
 	}
-	let mut out = String::with_capacity(capacity);
-	out.push('(');
-	for (idx, (_, _, modality, _, child_str)) in children.iter().enumerate() {
-		if idx > 0 {
-			out.push_str(", ");
+
+	#[test]
+	fn random_trees_compare_as_their_strings() {
+		for seed in 0..60 {
+			let mut trees = Vec::new();
+			// Two builds of the same trees: equal by hash, not by pointer.
+			for builder in [&mut TreeBuilder::default(), &mut TreeBuilder::default()] {
+				for offset in 0..4 {
+					let tree = random_tree(builder, seed * 4 + offset, 6 + (seed as usize % 7));
+					subtrees(&tree, &mut trees);
+				}
+			}
+			check_strings(&trees);
+			check_order(&trees);
+		}
+	}
+
+	#[test]
+	fn equal_siblings_are_skipped_whole() {
+		let (mut left, mut right) = (TreeBuilder::default(), TreeBuilder::default());
+		let build = |builder: &mut TreeBuilder, last: &str| {
+			let one = builder.modality("1");
+			let a = builder.node("A".to_string(), true, Vec::new());
+			let ab = builder.node("AB".to_string(), true, Vec::new());
+			let inner = builder.node("X".to_string(), false, vec![(one.clone(), a.clone()), (one.clone(), ab)]);
+			let last = builder.node(last.to_string(), true, Vec::new());
+			builder.node("R".to_string(), false, vec![(one.clone(), inner.clone()), (one.clone(), inner), (one, last)])
+		};
+		let trees = vec![build(&mut left, "A"), build(&mut right, "A"), build(&mut right, "AB"), build(&mut left, "")];
+		assert!(!Arc::ptr_eq(&trees[0], &trees[1]));
+		assert_eq!(trees[0].hash(), trees[1].hash());
+		check_strings(&trees);
+		check_order(&trees);
+	}
+
+	#[test]
+	fn graph_trees_compare_as_their_strings() {
+		for seed in 0..12 {
+			let graph = random_graph(seed, 5 + seed as usize % 5);
+			let mut trees = Vec::new();
+			for root in 0..graph.graph.node_count() {
+				let root = root.to_string();
+				subtrees(&to_tree(&graph, &root, &NodeSet::new()).unwrap(), &mut trees);
+				for mode in [InboundMode::Duplicate, InboundMode::Elect] {
+					let dag = to_dag_with_mode(&graph, &root, &NodeSet::new(), mode, Some(DigestAlgorithm::Md5)).unwrap();
+					subtrees(&to_tree(&dag, &root, &NodeSet::new()).unwrap(), &mut trees);
+				}
+			}
+			check_strings(&trees);
+			check_order(&trees);
 		}
-		out.push_str(child_str.as_ref());
-		out.push(':');
-		out.push_str(modality);
 	}
-	out.push(')');
-	out.push_str(label);
-	out
 }
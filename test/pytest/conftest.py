@@ -1,8 +1,22 @@
 import os
 import sys
 
+import pytest
+
 TEST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 REPO_ROOT = os.path.dirname(TEST_DIR)
 for path in (TEST_DIR, REPO_ROOT):
 	if path not in sys.path:
 		sys.path.insert(0, path)
+
+
+def legacy_backend():
+	from scott._backend import resolve_backend
+	try:
+		return resolve_backend()[0] == "py"
+	except ImportError:
+		return False
+
+
+rust_only = pytest.mark.skipif(legacy_backend(), reason="needs the Rust backend")
+legacy_only = pytest.mark.skipif(not legacy_backend(), reason="checks the legacy backend")
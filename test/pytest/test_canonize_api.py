@@ -0,0 +1,172 @@
+"""Tests for the scott.canonize entry points."""
+
+import os
+
+import pytest
+
+from conftest import legacy_backend, legacy_only, rust_only
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DOT_DIR = os.path.join(REPO_ROOT, "data/isotest/cfi-rigid-t2-dot")
+
+
+def _load(name):
+	import scott
+	return scott.parse.from_dot(file_path=os.path.join(DOT_DIR, name))[0]
+
+
+@pytest.mark.unit
+def test_to_cgraph_batch_matches_single():
+	import scott
+	names = [
+		"cfi-rigid-t2-0016-04-1.dot",
+		"cfi-rigid-t2-0020-01-1.dot",
+		"cfi-rigid-t2-0016-04-2.dot",
+	]
+	graphs = [_load(name) for name in names]
+	batch = scott.canonize.to_cgraph_batch(graphs)
+	assert len(batch) == len(graphs)
+	for graph, cgraph in zip(graphs, batch):
+		assert str(cgraph) == str(scott.canonize.to_cgraph(graph))
+	assert str(batch[0]) == str(batch[2])
+
+
+@pytest.mark.unit
+def test_to_cgraph_batch_reports_errors_per_item():
+	import scott
+	graphs = [_load("cfi-rigid-t2-0016-04-1.dot"), _load("cfi-rigid-t2-0016-04-2.dot")]
+	batch = scott.canonize.to_cgraph_batch(graphs, candidate_rule="$unknown")
+	assert len(batch) == 2
+	assert all(isinstance(item, Exception) for item in batch)
+
+
+@pytest.mark.unit
+def test_compound_candidate_rule():
+	import scott
+	rule = "$label > $degree > graph.n_degree(id_node, 1) > $bounds"
+	g = _load("cfi-rigid-t2-0020-02-1.dot")
+	h = _load("cfi-rigid-t2-0020-02-2.dot")
+	e = _load("cfi-rigid-t2-0020-01-1.dot")
+	t_g = str(scott.canonize.to_cgraph(g, candidate_rule=rule))
+	t_h = str(scott.canonize.to_cgraph(h, candidate_rule=rule))
+	t_e = str(scott.canonize.to_cgraph(e, candidate_rule=rule))
+	assert t_g == t_h
+	assert t_g != t_e
+
+
+@rust_only
+@pytest.mark.unit
+def test_refine_keeps_isomorphism_invariance():
+	import scott
+	g = _load("cfi-rigid-t2-0020-02-1.dot")
+	h = _load("cfi-rigid-t2-0020-02-2.dot")
+	e = _load("cfi-rigid-t2-0020-01-1.dot")
+	t_g = str(scott.canonize.to_cgraph(g, refine=True))
+	t_h = str(scott.canonize.to_cgraph(h, refine=True))
+	t_e = str(scott.canonize.to_cgraph(e, refine=True))
+	assert t_g == t_h
+	assert t_g != t_e
+	assert t_g == str(scott.canonize.to_cgraph(g, candidate_rule="$degree > $refine"))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("algorithm", ["md5", "sha256"])
+@pytest.mark.parametrize("compress", [True, False])
+def test_canonical_digest_matches_trace_hash(algorithm, compress):
+	import hashlib
+	import scott
+	g = _load("cfi-rigid-t2-0020-02-1.dot")
+	h = _load("cfi-rigid-t2-0020-02-2.dot")
+	trace = str(scott.canonize.to_cgraph(g, compress=compress))
+	digest = scott.canonize.canonical_digest(g, algorithm=algorithm, compress=compress)
+	assert digest == hashlib.new(algorithm, trace.encode()).digest()
+	assert digest == scott.canonize.canonical_digest(h, algorithm=algorithm, compress=compress)
+
+
+@pytest.mark.unit
+def test_canonical_digest_xxh3_is_native_only():
+	import scott
+	g = _load("cfi-rigid-t2-0020-02-1.dot")
+	h = _load("cfi-rigid-t2-0020-02-2.dot")
+	if legacy_backend():
+		with pytest.raises(ValueError):
+			scott.canonize.canonical_digest(g, algorithm="xxh3_128")
+		return
+	digest = scott.canonize.canonical_digest(g, algorithm="xxh3_128")
+	assert len(digest) == 16
+	assert digest == scott.canonize.canonical_digest(h, algorithm="xxh3_128")
+
+
+@rust_only
+@pytest.mark.unit
+def test_magnet_hash_stamps_trace_format():
+	import hashlib
+	import scott
+	g = _load("cfi-rigid-t2-0020-02-1.dot")
+	h = _load("cfi-rigid-t2-0020-02-2.dot")
+	md5_trace = str(scott.canonize.to_cgraph(g))
+	xxh3_trace = str(scott.canonize.to_cgraph(g, hash="xxh3_128"))
+	assert scott.canonize.trace_format() == "1"
+	assert scott.canonize.trace_format("xxh3_128") == "1+xxh3_128"
+	assert not md5_trace.startswith("@")
+	assert xxh3_trace.startswith("@1+xxh3_128:")
+	assert xxh3_trace != md5_trace
+	assert xxh3_trace == str(scott.canonize.to_cgraph(h, hash="xxh3_128"))
+	digest = scott.canonize.canonical_digest(g, hash="xxh3_128")
+	assert digest == hashlib.md5(xxh3_trace.encode()).digest()
+	with pytest.raises(ValueError):
+		scott.canonize.to_cgraph(g, hash="sha1")
+
+
+@legacy_only
+@pytest.mark.unit
+def test_rust_only_options_raise_on_legacy():
+	import scott
+	g = _load("cfi-rigid-t2-0020-02-1.dot")
+	with pytest.raises(ValueError):
+		scott.canonize.to_cgraph(g, refine=True)
+	with pytest.raises(ValueError):
+		scott.canonize.to_cgraph(g, hash="xxh3_128")
+	with pytest.raises(ValueError):
+		scott.canonize.trace_format("xxh3_128")
+	assert scott.canonize.trace_format() == "1"
+
+
+@pytest.mark.unit
+def test_num_threads_keeps_traces():
+	import scott
+	graphs = [_load("cfi-rigid-t2-0016-04-1.dot"), _load("cfi-rigid-t2-0020-01-1.dot")]
+	reference = [str(cgraph) for cgraph in scott.canonize.to_cgraph_batch(graphs)]
+	try:
+		scott.set_num_threads(1)
+		assert scott.get_num_threads() == 1
+		assert [str(cgraph) for cgraph in scott.canonize.to_cgraph_batch(graphs)] == reference
+		assert [str(scott.canonize.to_cgraph(graph)) for graph in graphs] == reference
+	finally:
+		scott.set_num_threads(0)
+	with pytest.raises(ValueError):
+		scott.set_num_threads(-1)
+
+
+def _tree(edges, labels):
+	import scott
+	graph = scott.structs.graph.Graph()
+	nodes = {id_node: scott.structs.node.Node(id_node, label) for id_node, label in labels.items()}
+	graph.add_nodes(list(nodes.values()))
+	for i, (a, b) in enumerate(edges):
+		graph.add_edge(scott.structs.edge.Edge(str(i), nodes[a], nodes[b]))
+	return graph
+
+
+@pytest.mark.unit
+def test_tree_traces_ignore_numbering():
+	import scott
+	labels = {"1": "C", "2": "C", "3": "O", "4": "N", "5": "C", "6": "H"}
+	g = _tree([("1", "2"), ("2", "3"), ("2", "4"), ("4", "5"), ("5", "6")], labels)
+	relabel = {"1": "6", "2": "4", "3": "1", "4": "3", "5": "2", "6": "5"}
+	h = _tree(
+		[(relabel[a], relabel[b]) for a, b in [("5", "6"), ("2", "4"), ("1", "2"), ("4", "5"), ("2", "3")]],
+		{relabel[id_node]: label for id_node, label in labels.items()},
+	)
+	for compress in (True, False):
+		assert str(scott.canonize.to_cgraph(g, compress=compress)) == str(scott.canonize.to_cgraph(h, compress=compress))
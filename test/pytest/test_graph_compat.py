@@ -4,6 +4,8 @@ import os
 
 import pytest
 
+from conftest import legacy_backend, rust_only
+
 REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
@@ -81,6 +83,48 @@ def test_adjacency_matrix_basic():
 	assert A[0][2] == 0
 
 
+@pytest.mark.unit
+def test_adjacency_matrix_list_keeps_large_modalities():
+	"""Modalities beyond 32 bits stay exact Python integers in list form."""
+	import scott as st
+
+	g = st.graph.Graph()
+	g.add_nodes([st.graph.Node("1", "A"), st.graph.Node("2", "B")])
+	g.add_edge(st.graph.Edge("e1", "1", "2", modality=3 * 10**9))
+	if not legacy_backend():
+		g.as_rs()
+	assert g.adjacency_matrix() == [[0, 3 * 10**9], [3 * 10**9, 0]]
+
+
+@rust_only
+@pytest.mark.unit
+@pytest.mark.parametrize(
+	"modality, value",
+	[
+		("99999999999999999999", 99999999999999999999),
+		("1_000", 1000),
+		(" -7 ", -7),
+		# Not an integer to Python: the sum of its code points.
+		("1__0", ord("1") + 2 * ord("_") + ord("0")),
+	],
+)
+def test_adjacency_matrix_list_reads_modalities_as_python(modality, value):
+	"""The native list matrix reads modalities as the Python builder does."""
+	import scott as st
+
+	def build():
+		g = st.graph.Graph()
+		g.add_nodes([st.graph.Node("1", "A"), st.graph.Node("2", "B")])
+		g.add_edge(st.graph.Edge("e1", "1", "2", modality=modality))
+		return g
+
+	rs_backed = build()
+	rs_backed.as_rs()
+	expected = [[0, value], [value, 0]]
+	assert build().adjacency_matrix() == expected
+	assert rs_backed.adjacency_matrix() == expected
+
+
 @pytest.mark.unit
 def test_adjacency_matrix_canonical_isomorphic():
 	"""Isomorphic graphs must produce the same canonical adjacency matrix."""
@@ -109,3 +153,210 @@ def test_adjacency_matrix_canonical_non_isomorphic():
 	)[0]
 
 	assert g.adjacency_matrix(canonic=True) != h.adjacency_matrix(canonic=True)
+
+
+@pytest.mark.unit
+def test_graph_from_arrays():
+	"""from_arrays builds the same graph as the Node/Edge API."""
+	import array
+	import scott as st
+
+	g = st.graph.Graph.from_arrays(
+		array.array("i", [0, 0, 0]),
+		array.array("i", [1, 2, 3]),
+		array.array("B", [0, 1, 2, 2]),
+		array.array("b", [1, 0, 0]),
+		label_names=["C", "O", "H"],
+		modality_names=["1", "2"],
+	)
+	assert len(g.V) == 4
+	assert len(g.E) == 3
+	assert g.V["1"].label == "O"
+	assert sorted(edge.modality for edge in g.E.values()) == ["1", "1", "2"]
+
+	h = st.graph.Graph()
+	nodes = [st.graph.Node(str(i), label) for i, label in enumerate("COHH")]
+	h.add_nodes(nodes)
+	h.add_edge(st.graph.Edge("1", nodes[0], nodes[1], modality=2))
+	h.add_edge(st.graph.Edge("2", nodes[0], nodes[2]))
+	h.add_edge(st.graph.Edge("3", nodes[0], nodes[3]))
+	assert str(st.canonize.to_cgraph(g)) == str(st.canonize.to_cgraph(h))
+
+	# Plain lists work too, and codes are their own names by default.
+	k = st.graph.Graph.from_arrays([0], [1], [6, 8])
+	assert [node.label for node in k.V.values()] == ["6", "8"]
+	assert [edge.modality for edge in k.E.values()] == ["1"]
+
+	with pytest.raises(ValueError):
+		st.graph.Graph.from_arrays([0], [2], [6, 8])
+	with pytest.raises(TypeError):
+		st.graph.Graph.from_arrays(array.array("d", [0.0]), [1], [6, 8])
+
+
+@pytest.mark.unit
+def test_mutations_reach_rust_graph():
+	"""Mutating a canonized graph gives the trace of the mutated graph."""
+	import scott as st
+
+	def build(labels, edges):
+		graph = st.graph.Graph()
+		graph.add_nodes([st.graph.Node(i, label) for i, label in enumerate(labels)])
+		graph.add_edges([st.graph.Edge(id_edge, a, b, m) for id_edge, a, b, m in edges])
+		return graph
+
+	g = build("CCO", [("1", 0, 1, 1), ("2", 1, 2, 2)])
+	first = str(st.canonize.to_cgraph(g))
+	g.add_node(st.graph.Node(3, "N"))
+	g.add_edge(st.graph.Edge("3", 0, 3, 1))
+	grown = build("CCON", [("1", 0, 1, 1), ("2", 1, 2, 2), ("3", 0, 3, 1)])
+	assert str(st.canonize.to_cgraph(g)) == str(st.canonize.to_cgraph(grown))
+	assert len(g.V) == 4 and len(g.E) == 3
+
+	g.remove_node(3)
+	assert str(st.canonize.to_cgraph(g)) == first
+	g.remove_edge("2")
+	assert "2" not in g.E
+	with pytest.raises(KeyError):
+		g.remove_edge("2")
+
+	parsed = st.parse.from_dot(
+		file_path=os.path.join(REPO_ROOT, "data/isotest/cfi-rigid-t2-dot/cfi-rigid-t2-0016-04-1.dot"),
+	)[0]
+	trace = str(st.canonize.to_cgraph(parsed))
+	edge = next(iter(parsed.E.values()))
+	parsed.remove_edge(edge.id)
+	assert str(st.canonize.to_cgraph(parsed)) != trace
+	parsed.add_edge(edge)
+	assert str(st.canonize.to_cgraph(parsed)) == trace
+
+
+@rust_only
+@pytest.mark.unit
+def test_mutated_graph_traces_as_rebuilt():
+	"""A graph mutated in place canonizes as one built afresh from V and E."""
+	import scott as st
+
+	g = st.parse.from_dot(
+		file_path=os.path.join(REPO_ROOT, "data/isotest/cfi-rigid-t2-dot/cfi-rigid-t2-0016-04-1.dot"),
+	)[0]
+	st.canonize.to_cgraph(g)
+	edges = list(g.E.values())
+	# Re-added at the end, then replaced in place with its ends swapped.
+	g.remove_edge(edges[0].id)
+	g.add_edge(edges[0])
+	g.add_edge(st.graph.Edge(edges[3].id, edges[3].id_b, edges[3].id_a, edges[3].modality))
+	node = next(iter(g.V.values()))
+	around = [edge for edge in g.E.values() if node.id in (edge.id_a, edge.id_b)]
+	g.remove_node(node.id)
+	g.add_node(node)
+	g.add_edges(around)
+
+	def assert_as_rebuilt(g):
+		fresh = st.graph.Graph()
+		fresh.add_nodes(list(g.V.values()))
+		fresh.add_edges(list(g.E.values()))
+		assert g.as_rs().node_labels() == fresh.as_rs().node_labels()
+		assert g.as_rs().edges() == fresh.as_rs().edges()
+		for compact in (False, True):
+			assert str(st.canonize.to_cgraph(g, compact=compact)) == str(st.canonize.to_cgraph(fresh, compact=compact))
+
+	assert_as_rebuilt(g)
+
+	# Edges added before their ends, once the Rust graph exists.
+	h = st.graph.Graph()
+	h.add_nodes([st.graph.Node("x", "C"), st.graph.Node("y", "O")])
+	h.add_edge(st.graph.Edge("e1", "x", "y"))
+	h.as_rs()
+	h.add_edge(st.graph.Edge("e2", "a", "b", 2))
+	h.add_edge(st.graph.Edge("e3", "x", "a"))
+	h.add_node(st.graph.Node("c", "N"))
+	h.add_node(st.graph.Node("a", "C"))
+	h.add_node(st.graph.Node("b", "S"))
+	h.add_edge(st.graph.Edge("e4", "b", "c"))
+	assert list(h.V) == ["x", "y", "a", "b", "c"]
+	assert h.V["b"].label == "S"
+	assert_as_rebuilt(h)
+
+
+@rust_only
+@pytest.mark.unit
+def test_parsed_graph_views():
+	"""V and E of a parsed graph read through to Rust and keep their entries."""
+	from collections.abc import Mapping
+	import scott as st
+
+	g = st.parse.from_dot(
+		file_path=os.path.join(REPO_ROOT, "data/isotest/cfi-rigid-t2-dot/cfi-rigid-t2-0016-04-1.dot"),
+	)[0]
+	assert isinstance(g.V, Mapping) and isinstance(g.E, Mapping)
+	st.canonize.to_cgraph(g)
+	assert len(g.V) == g.as_rs().node_count
+	assert len(g.E) == g.as_rs().edge_count
+
+	node_id = next(iter(g.V))
+	assert g.V[node_id] is g.V[node_id]
+	assert node_id in g.V and "missing" not in g.V
+	assert g.V.get("missing") is None
+	edge = next(iter(g.E.values()))
+	assert edge.id_a in g.V and edge.id_b in g.V
+	assert sorted(g.V) == sorted(node.id for node in g.V.values())
+
+
+@pytest.mark.unit
+def test_node_edge_slots_and_interning():
+	from scott.graph import Node, Edge
+
+	a = Node("1", "C")
+	b = Node("2", "".join(["C"]))
+	assert a.label is b.label
+	assert Edge("1", a, b, 1).modality is Edge("2", b, a, "1").modality
+	with pytest.raises(AttributeError):
+		a.charge = 0
+
+
+@pytest.mark.unit
+def test_graph_batch_keeps_traces():
+	import scott as st
+
+	mols = st.parse.from_sdf(file_path=os.path.join(REPO_ROOT, "data/molecule/cafeine.sdf"))
+	mols += st.parse.from_sdf(file_path=os.path.join(REPO_ROOT, "data/molecule/simple.sdf"))
+	cfi = st.parse.from_dot(
+		file_path=os.path.join(REPO_ROOT, "data/isotest/cfi-rigid-t2-dot/cfi-rigid-t2-0016-04-1.dot"),
+	)
+	batch = st.graph.GraphBatch(mols + cfi)
+	assert len(batch) == 3
+	assert batch.node_offsets[-1] == sum(len(g.V) for g in mols + cfi)
+	assert batch.edge_offsets[-1] == sum(len(g.E) for g in mols + cfi)
+	assert set(batch.modalities) == {"1", "2"}
+	for graph, stored in zip(mols + cfi, batch):
+		assert str(st.canonize.to_cgraph(stored)) == str(st.canonize.to_cgraph(graph))
+	assert len(batch[-1].V) == len(cfi[0].V)
+
+
+@pytest.mark.unit
+def test_adjacency_matrix_formats():
+	"""The NumPy and CSR forms hold the same canonical matrix as the lists."""
+	np = pytest.importorskip("numpy")
+	import scott
+
+	g = scott.parse.from_dot(
+		file_path=os.path.join(REPO_ROOT, "data/isotest/cfi-rigid-t2-dot/cfi-rigid-t2-0020-01-1.dot"),
+	)[0]
+	h = scott.parse.from_dot(
+		file_path=os.path.join(REPO_ROOT, "data/isotest/cfi-rigid-t2-dot/cfi-rigid-t2-0020-01-2.dot"),
+	)[0]
+	A = g.adjacency_matrix(canonic=True)
+	dense = g.adjacency_matrix(canonic=True, format="numpy")
+	assert dense.dtype == np.int32
+	assert dense.tolist() == A
+	assert np.array_equal(dense, h.adjacency_matrix(canonic=True, format="numpy"))
+	assert g.adjacency_matrix(canonic=True, format="numpy", dtype="uint8").tolist() == A
+
+	data, indices, indptr = g.adjacency_matrix(canonic=True, format="csr")
+	assert indptr[0] == 0 and indptr[-1] == len(data) == len(indices) == 2 * len(g.E)
+	rebuilt = np.zeros_like(dense)
+	rebuilt[np.repeat(np.arange(len(A)), np.diff(indptr)), indices] = data
+	assert np.array_equal(rebuilt, dense)
+
+	with pytest.raises(ValueError):
+		g.adjacency_matrix(format="coo")
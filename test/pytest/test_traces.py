@@ -0,0 +1,30 @@
+"""Pin canonical traces to the ones recorded before the Rust rewrites."""
+
+import json
+import os
+
+import pytest
+
+from conftest import rust_only
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_DIR = os.path.join(REPO_ROOT, "data")
+
+# str(to_cgraph(g, compress=..., compact=...)) as returned at the baseline
+# commit, for every (compress, compact) combination.
+with open(os.path.join(DATA_DIR, "golden_traces.json")) as fp:
+	GOLDEN_TRACES = json.load(fp)
+
+
+@rust_only
+@pytest.mark.unit
+@pytest.mark.parametrize(
+	"golden",
+	GOLDEN_TRACES,
+	ids=["{graph}-compress={compress}-compact={compact}".format(**golden) for golden in GOLDEN_TRACES],
+)
+def test_trace_matches_golden(golden):
+	import scott
+	graph = scott.parse.from_dot(file_path=os.path.join(DATA_DIR, golden["graph"]))[0]
+	cgraph = scott.canonize.to_cgraph(graph, compress=golden["compress"], compact=golden["compact"])
+	assert str(cgraph) == golden["trace"]